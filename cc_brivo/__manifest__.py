@@ -6,14 +6,14 @@
     'author': 'Ready Element LLC',
     'maintainer': 'Ready Element LLC',
     'contributors': ["Ready Element LLC"],
-
+    
     "depends": [
         "web",
         "ksc_club_cloud"
     ],
     "license": "Other proprietary",
     "category": "sales",
-
+    
     "summary": """Adds models and views for Brivo integration""",
     'data': [
         # Security
@@ -21,12 +21,33 @@
         # Wizards
         'wizard/assign_brivo_group_wizard.xml',
         'wizard/manage_suspended_status_wizard.xml',
+        'wizard/start_brivo_onboarding_wizard.xml',
+        'wizard/start_brivo_batch_wizard.xml',
         # Views
         'views/club_system_settings.xml',
         'views/sale_order_template.xml',
+        'views/sale_order.xml',
+        'views/brivo_account.xml',
         'views/res_partner.xml',
+        'views/brivo_job.xml',
+        'views/brivo_group_reassignment.xml',
+        'views/brivo_reconciliation.xml',
+        'views/brivo_event.xml',
+        'views/brivo_api_metric.xml',
+        'views/brivo_onboarding.xml',
+        'views/brivo_checkin.xml',
+        'views/brivo_batch.xml',
         # Crons
-        'data/cron/cron_sync_brivo_groups.xml'
+        'data/cron/cron_sync_brivo_groups.xml',
+        'data/cron/cron_process_brivo_jobs.xml',
+        'data/cron/cron_process_brivo_group_reassignments.xml',
+        'data/cron/cron_reconcile_brivo.xml',
+        'data/cron/cron_process_brivo_events.xml',
+        'data/cron/cron_process_brivo_onboardings.xml',
+        'data/cron/cron_suspend_overdue_brivo_members.xml',
+        'data/cron/cron_import_brivo_checkins.xml',
+        'data/cron/cron_process_brivo_batches.xml',
+        'data/cron/cron_delete_abandoned_brivo_users.xml'
     ],
     "assets": {},
     'installable': True,
@@ -0,0 +1,57 @@
+import json
+import logging
+from odoo import http
+from odoo.http import request
+from ..utils import const
+
+_logger = logging.getLogger(__name__)
+
+class BrivoWebhookController(http.Controller):
+
+  @http.route('/cc_brivo/events', type='http', auth='public', methods=['POST'], csrf=False, save_session=False)
+  def brivo_events(self, **kwargs):
+    '''
+      Receive Brivo event subscription calls. A call is authenticated by the HMAC of its body
+      keyed with the webhook secret of a Brivo account (the system settings or a `brivo.account`),
+      or by that secret sent in a header, which also tells which account the events come from.
+      The secret is never part of the URL, so that it stays out of the access logs. Events are
+      only stored here; they are applied in batches by the Brivo event cron.
+    '''
+    body = request.httprequest.get_data()
+    headers = request.httprequest.headers
+    account = request.env['brivo.account'].sudo()._get_account_by_webhook(
+      body,
+      signature=headers.get(const.BRIVO_WEBHOOK_SIGNATURE_HEADER),
+      token=headers.get(const.BRIVO_WEBHOOK_TOKEN_HEADER)
+    )
+    
+    if account is None:
+      _logger.warning('Brivo Webhook: Rejected a call with an invalid signature or token')
+      return request.make_json_response({ 'error': 'Forbidden' }, status=403)
+    
+    try:
+      payload = json.loads(body or b'null')
+    except ValueError:
+      return request.make_json_response({ 'error': 'Invalid JSON' }, status=400)
+    
+    events = payload if isinstance(payload, list) else [payload]
+    if not all(isinstance(e, dict) for e in events):
+      return request.make_json_response({ 'error': 'Invalid event' }, status=400)
+    
+    received = request.env['brivo.event'].sudo().receive(events, account.id)
+    
+    return request.make_json_response({ 'received': received })
+  
+  
+  @http.route('/cc_brivo/metrics', type='http', auth='user', methods=['GET'])
+  def brivo_metrics(self, **kwargs):
+    '''
+      Expose the Brivo API metrics in the Prometheus text format to administrators.
+    '''
+    if not request.env.user.has_group('base.group_system'):
+      return request.make_response('Forbidden', status=403)
+    
+    return request.make_response(
+      request.env['brivo.api.metric'].export_prometheus(),
+      headers=[('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')]
+    )
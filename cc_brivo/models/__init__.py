@@ -1,5 +1,18 @@
+from . import brivo_account
 from . import club_system_settings
 from . import res_partner
 from . import brivo_groups
 from . import sale_order_template
-from . import sale_order
\ No newline at end of file
+from . import sale_order
+from . import brivo_auth_token
+from . import brivo_job
+
+from . import brivo_group_reassignment
+from . import brivo_reconciliation
+from . import brivo_rate_bucket
+from . import brivo_event
+from . import brivo_api_metric
+from . import ir_http
+from . import brivo_onboarding
+from . import brivo_checkin
+from . import brivo_batch
\ No newline at end of file
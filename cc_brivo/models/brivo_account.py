@@ -0,0 +1,211 @@
+import hashlib
+import hmac
+import logging
+from ..utils.brivo import brivo_auth, brivo_connection, BrivoConnection, BrivoSettings, SETTINGS_FIELDS
+from ..utils import const
+from ...ksc_club_cloud.utils.notifications import NotificationFeedback
+from odoo import models, fields, api, tools
+from odoo.exceptions import ValidationError
+
+_logger = logging.getLogger(__name__)
+
+def account_param(key, account_id):
+  '''
+    Returns the system parameter `key` of a Brivo account, `key` itself for the account of
+    the system settings so that its existing parameters are kept.
+  '''
+  return f'{key}.{account_id}' if account_id else key
+
+class BrivoConnectionMixin(models.AbstractModel):
+  _name = 'brivo.connection.mixin'
+  _description = 'Credentials and connection settings of a Brivo account.'
+  
+  '''
+    Brivo API Fields
+  '''
+  brivo_app_client_id = fields.Char(string='Brivo App Client ID')
+  brivo_app_client_secret = fields.Char(string='Brivo App Client Secret')
+  brivo_access_username = fields.Char(string='Brivo Admin ID')
+  brivo_access_password = fields.Char(string='Brivo Access Pasword')
+  brivo_api_key = fields.Char(string='Brivo API Key')
+  
+  '''
+    Brivo Connection Fields
+  '''
+  brivo_http_pool_size = fields.Integer(string='Brivo Connection Pool Size', default=const.BRIVO_HTTP_POOL_SIZE)
+  brivo_connect_timeout = fields.Float(string='Brivo Connect Timeout (s)', default=const.BRIVO_CONNECT_TIMEOUT)
+  brivo_read_timeout = fields.Float(string='Brivo Read Timeout (s)', default=const.BRIVO_READ_TIMEOUT)
+  brivo_rate_limit = fields.Float(string='Brivo Rate Limit (calls/s)', default=const.BRIVO_RATE_LIMIT,
+                                  help='Calls per second shared by all workers. Set to 0 to disable the limit.')
+  brivo_rate_burst = fields.Integer(string='Brivo Rate Burst', default=const.BRIVO_RATE_BURST)
+  brivo_slow_call_ms = fields.Integer(string='Brivo Slow Call Threshold (ms)', default=const.BRIVO_SLOW_CALL_MS,
+                                     help='Brivo calls slower than this are logged as warnings.')
+  brivo_webhook_token = fields.Char(string='Brivo Webhook Token', copy=False,
+                                    help='Secret of the event subscription to /cc_brivo/events. Calls must carry the '
+                                         'HMAC-SHA256 of their body keyed with it in the X-Brivo-Signature header, or '
+                                         'the secret itself in the X-Brivo-Webhook-Token header. '
+                                         'Events are rejected while it is empty.')
+  
+  @api.model_create_multi
+  def create(self, vals_list):
+    records = super().create(vals_list)
+    self.env.registry.clear_cache()
+    return records
+  
+  def write(self, vals):
+    '''
+      Invalidate the cached Brivo settings, in every worker, once they changed. The cache
+      is cleared after the write, so that no concurrent read caches the old values again.
+    '''
+    res = super().write(vals)
+    if not set(vals).isdisjoint(self._brivo_cached_fields()):
+      self.env.registry.clear_cache()
+    return res
+  
+  def unlink(self):
+    res = super().unlink()
+    self.env.registry.clear_cache()
+    return res
+  
+  def _brivo_cached_fields(self):
+    '''
+      Return the fields whose values are cached by `_get_brivo_settings`.
+    '''
+    return SETTINGS_FIELDS
+  
+  def _brivo_connection(self):
+    '''
+      Return a `BrivoConnection` to the account configured by this record, built from its
+      current credentials.
+    '''
+    self.ensure_one()
+    record = self.sudo()
+    return BrivoConnection(self.env.registry, BrivoSettings(**{ f: record[f] for f in SETTINGS_FIELDS }))
+  
+  def action_test_brivo_connection(self):
+    self.ensure_one()
+    
+    res = brivo_auth(self._brivo_connection())
+    
+    if res.get('status', None) == 'FAILURE':
+      return NotificationFeedback.notification_feedback(self.env,
+                                                        'Brivo Test Connection',
+                                                        'The Brivo test connection failed.',
+                                                        'danger')
+    else:
+      return NotificationFeedback.notification_feedback(self.env,
+                                                        'Brivo Test Connection',
+                                                        'The Brivo test connection was successful.',
+                                                        'success')
+
+class BrivoAccount(models.Model):
+  _name = 'brivo.account'
+  _inherit = 'brivo.connection.mixin'
+  _description = 'Brivo account of one or more companies, besides the account of the system settings.'
+  _order = 'sequence, id'
+  
+  '''
+    Partners of the companies of an account are routed to it, along with their jobs, group
+    memberships and Brivo batch operations. Partners of other companies, or of no company,
+    use the account of the system settings.
+    
+    Each account has its own access token, HTTP connection pool, rate budget and circuit
+    breaker, all keyed by its credentials.
+  '''
+  name = fields.Char(required=True)
+  sequence = fields.Integer(default=10)
+  active = fields.Boolean(default=True)
+  company_ids = fields.Many2many('res.company', string='Companies',
+                                help='Companies whose members are provisioned in this Brivo account.')
+  
+  @api.model_create_multi
+  def create(self, vals_list):
+    records = super().create(vals_list)
+    self._route_partners(records.company_ids)
+    return records
+  
+  def write(self, vals):
+    # The partners of the companies removed from these accounts are routed too
+    previous = self.with_context(active_test=False).company_ids
+    res = super().write(vals)
+    if 'company_ids' in vals or 'active' in vals:
+      self._route_partners(previous | self.with_context(active_test=False).company_ids)
+    return res
+  
+  def _brivo_cached_fields(self):
+    # The companies of the accounts are cached by `_get_account_by_company`
+    return super()._brivo_cached_fields() + ['company_ids', 'active']
+  
+  @api.model
+  def _route_partners(self, companies):
+    '''
+      Route the partners of `companies` that have no Brivo user yet to the current account of
+      their company. Partners already provisioned stay on the account their Brivo user was
+      created in.
+    '''
+    account_by_company = self._get_account_by_company()
+    partners = self.env['res.partner'].with_context(active_test=False).search([
+      ('company_id', 'in', companies.ids),
+      ('brivo_id', 'in', [0, False])
+    ])
+    for company, company_partners in partners.grouped('company_id').items():
+      company_partners.with_context(skip_brivo_call_on_write=True).write({ 'brivo_account_id': account_by_company.get(company.id, False) })
+  
+  @api.constrains('company_ids', 'active')
+  def _check_company_ids(self):
+    for rec in self.filtered('active'):
+      others = self.search([('id', '!=', rec.id), ('company_ids', 'in', rec.company_ids.ids)], limit=1)
+      if others:
+        raise ValidationError(f'The companies of {rec.name} are already linked to the Brivo account {others.name}.')
+  
+  @api.model
+  @tools.ormcache('account_id')
+  def _get_brivo_settings(self, account_id):
+    '''
+      Return an immutable snapshot of the settings of an account, cached per database so
+      that Brivo calls do not query the accounts. The cache is cleared when an account changes.
+    '''
+    record = self.sudo().with_context(active_test=False).browse(account_id)
+    return BrivoSettings(**{ f: record[f] for f in SETTINGS_FIELDS })
+  
+  @api.model
+  @tools.ormcache()
+  def _get_account_by_company(self):
+    '''
+      Return a dict mapping company IDs to the ID of their active Brivo account.
+    '''
+    return { company.id: rec.id for rec in self.sudo().search([]) for company in rec.company_ids }
+  
+  @api.model
+  def _get_account_ids(self):
+    '''
+      Return the accounts to run per-account crons on: False for the account of the system
+      settings, then the IDs of the active accounts.
+    '''
+    return [False] + self.sudo().search([]).ids
+  
+  @api.model
+  def _get_account_by_webhook(self, body, signature=None, token=None):
+    '''
+      Return the account that sent a webhook call: a brivo.account, an empty recordset for the
+      account of the system settings, or None when the call is not authenticated.
+      Input:
+        - body. The raw body of the call.
+        - signature. The hex HMAC-SHA256 of `body` keyed with the webhook secret, optionally
+          prefixed with `sha256=`.
+        - token. The webhook secret itself, for subscriptions that cannot sign their calls.
+    '''
+    if signature:
+      signature = signature.strip().lower().removeprefix('sha256=')
+    
+    for account_id in self._get_account_ids():
+      secret = brivo_connection(self.env, account_id).settings.brivo_webhook_token
+      if not secret:
+        continue
+      if signature:
+        expected = hmac.new(secret.encode('utf-8'), body, hashlib.sha256).hexdigest()
+        if hmac.compare_digest(signature, expected):
+          return self.browse(account_id)
+      elif token and hmac.compare_digest(token, secret):
+        return self.browse(account_id)
+    return None
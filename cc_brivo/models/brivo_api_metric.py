@@ -0,0 +1,90 @@
+from odoo import models, fields, api
+from ..utils import const
+from ..utils.metrics import flush
+
+class BrivoApiMetric(models.Model):
+  _name = 'brivo.api.metric'
+  _description = 'Counters and latency histograms of the calls to the Brivo API, per endpoint.'
+  _order = 'total_time desc'
+  
+  '''
+    Rows are accumulated with raw SQL by `utils/metrics.py`, which every Odoo worker
+    flushes periodically. Times are in milliseconds.
+  '''
+  method = fields.Char(required=True, readonly=True)
+  endpoint = fields.Char(required=True, readonly=True)
+  call_count = fields.Integer(readonly=True)
+  error_count = fields.Integer(readonly=True)
+  retry_count = fields.Integer(readonly=True)
+  total_time = fields.Float(readonly=True)
+  max_time = fields.Float(readonly=True)
+  # Floats rather than integers, the totals outgrow 32 bits
+  bytes_sent = fields.Float(readonly=True, digits=(16, 0))
+  bytes_received = fields.Float(readonly=True, digits=(16, 0))
+  buckets = fields.Json(readonly=True, help='Call counts per latency bucket, see BRIVO_LATENCY_BUCKETS_MS.')
+  status_counts = fields.Json(readonly=True)
+  avg_time = fields.Float(compute='_compute_latency', string='Average (ms)')
+  p95_time = fields.Float(compute='_compute_latency', string='P95 (ms)', help='Upper bound of the latency bucket holding the 95th percentile.')
+  
+  _sql_constraints = [
+    ('method_endpoint_uniq', 'unique(method, endpoint)', 'There can only be one Brivo API metric per endpoint.')
+  ]
+  
+  @api.depends('call_count', 'total_time', 'buckets', 'max_time')
+  def _compute_latency(self):
+    for rec in self:
+      rec.avg_time = rec.total_time / rec.call_count if rec.call_count else 0.0
+      rec.p95_time = rec._percentile(0.95)
+  
+  def _percentile(self, quantile):
+    self.ensure_one()
+    buckets = self.buckets or []
+    target = sum(buckets) * quantile
+    seen = 0
+    for bound, count in zip(const.BRIVO_LATENCY_BUCKETS_MS, buckets):
+      seen += count
+      if target and seen >= target:
+        return bound
+    return self.max_time if buckets else 0.0
+  
+  @api.model
+  def export_prometheus(self):
+    '''
+      Returns all metrics in the Prometheus text exposition format.
+    '''
+    flush(self.env.registry)
+    metrics = self.sudo().search([])
+    bounds = [str(b / 1000) for b in const.BRIVO_LATENCY_BUCKETS_MS] + ['+Inf']
+    lines = [
+      '# TYPE brivo_api_calls_total counter',
+      '# TYPE brivo_api_errors_total counter',
+      '# TYPE brivo_api_retries_total counter',
+      '# TYPE brivo_api_bytes_sent_total counter',
+      '# TYPE brivo_api_bytes_received_total counter',
+      '# TYPE brivo_api_responses_total counter',
+      '# TYPE brivo_api_call_duration_seconds histogram'
+    ]
+    for rec in metrics:
+      labels = f'method="{rec.method}",endpoint="{rec.endpoint}"'
+      lines.append(f'brivo_api_calls_total{{{labels}}} {rec.call_count}')
+      lines.append(f'brivo_api_errors_total{{{labels}}} {rec.error_count}')
+      lines.append(f'brivo_api_retries_total{{{labels}}} {rec.retry_count}')
+      lines.append(f'brivo_api_bytes_sent_total{{{labels}}} {int(rec.bytes_sent)}')
+      lines.append(f'brivo_api_bytes_received_total{{{labels}}} {int(rec.bytes_received)}')
+      for status, count in sorted((rec.status_counts or {}).items()):
+        lines.append(f'brivo_api_responses_total{{{labels},status="{status}"}} {count}')
+      
+      cumulative = 0
+      for bound, count in zip(bounds, rec.buckets or [0] * len(bounds)):
+        cumulative += count
+        lines.append(f'brivo_api_call_duration_seconds_bucket{{{labels},le="{bound}"}} {cumulative}')
+      lines.append(f'brivo_api_call_duration_seconds_sum{{{labels}}} {rec.total_time / 1000}')
+      lines.append(f'brivo_api_call_duration_seconds_count{{{labels}}} {rec.call_count}')
+    
+    return '\n'.join(lines) + '\n'
+  
+  def action_flush(self):
+    flush(self.env.registry)
+  
+  def action_reset(self):
+    self.sudo().unlink()
@@ -0,0 +1,34 @@
+from odoo import models, fields, api
+from ..utils.token_manager import token_stats
+
+class BrivoAuthToken(models.Model):
+  _name = 'brivo.auth.token'
+  _description = 'Brivo OAuth tokens shared between Odoo workers, one per credential set.'
+  
+  '''
+    Rows are read and written with raw SQL by `utils/token_manager.py` so that
+    token refreshes are serialized across workers through a row lock.
+  '''
+  credential_key = fields.Char(required=True, index=True, readonly=True)
+  access_token = fields.Char(readonly=True)
+  refresh_token = fields.Char(readonly=True)
+  expires_at = fields.Datetime(readonly=True)
+  lifetime = fields.Integer(readonly=True, help='Lifetime of the access token in seconds.')
+  refresh_count = fields.Integer(readonly=True, help='Number of refresh-token grants.')
+  password_grant_count = fields.Integer(readonly=True, help='Number of password grants.')
+  
+  _sql_constraints = [
+    ('credential_key_uniq', 'unique(credential_key)', 'There can only be one Brivo token per credential set.')
+  ]
+  
+  @api.model
+  def get_token_stats(self):
+    '''
+      Return the token cache counters of this worker process, together with the
+      refresh counters shared by all workers.
+    '''
+    stats = token_stats()
+    tokens = self.search([])
+    stats['shared_refreshes'] = sum(tokens.mapped('refresh_count'))
+    stats['shared_password_grants'] = sum(tokens.mapped('password_grant_count'))
+    return stats
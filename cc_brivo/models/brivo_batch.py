@@ -0,0 +1,232 @@
+import logging
+import time
+from odoo import models, fields, api
+from odoo.exceptions import UserError
+from ..utils import const
+
+_logger = logging.getLogger(__name__)
+
+# Operations a Brivo batch can run: the model whose records are sharded, the domain of the
+# records covered, and the method of that model run on each chunk of records
+BATCH_KINDS = {
+  'refresh_state': ('res.partner', [('brivo_id', 'not in', [0, False])], '_refresh_brivo_state'),
+  'push_users': ('res.partner', [('brivo_id', 'not in', [0, False])], '_enqueue_brivo_sync')
+}
+
+class BrivoBatch(models.Model):
+  _name = 'brivo.batch'
+  _description = 'Sharded background run of a Brivo operation, shared by the Brivo batch crons.'
+  _order = 'id desc'
+  
+  '''
+    The records of a batch are split into shards of consecutive IDs. Every batch cron claims
+    a shard with SKIP LOCKED, runs the operation on its next chunk of records and commits the
+    cursor of the shard with it. Several crons thus work on a batch at the same time, never
+    on the same shard, and a batch interrupted by a restart continues where it stopped.
+    More workers are added by copying the Process Brivo Batches crons.
+  '''
+  kind = fields.Selection([
+    ('refresh_state', 'Refresh Brivo State'),
+    ('push_users', 'Push Changed Partners to Brivo')
+  ], required=True, readonly=True)
+  state = fields.Selection([
+    ('running', 'Running'),
+    ('stopped', 'Stopped'),
+    ('done', 'Done'),
+    ('failed', 'Failed')
+  ], default='running', required=True, index=True, readonly=True)
+  shard_ids = fields.One2many('brivo.batch.shard', 'batch_id', readonly=True)
+  
+  total_count = fields.Integer(compute='_compute_progress')
+  done_count = fields.Integer(compute='_compute_progress')
+  failed_shard_count = fields.Integer(string='Failed Shards', compute='_compute_progress')
+  progress = fields.Float(compute='_compute_progress')
+  failure_summary = fields.Text(compute='_compute_failure_summary')
+  
+  def init(self):
+    '''
+      Allow one running batch per kind, so that two runs of an operation never overlap.
+    '''
+    self.env.cr.execute('''
+      CREATE UNIQUE INDEX IF NOT EXISTS brivo_batch_running_kind_uniq
+          ON brivo_batch (kind)
+       WHERE state = 'running'
+    ''')
+  
+  def _compute_progress(self):
+    Shard = self.env['brivo.batch.shard']
+    sums = { batch.id: (total, done) for batch, total, done in Shard._read_group(
+      [('batch_id', 'in', self.ids)], ['batch_id'], ['record_count:sum', 'done_count:sum']) }
+    failed = { batch.id: count for batch, count in Shard._read_group(
+      [('batch_id', 'in', self.ids), ('state', '=', 'failed')], ['batch_id'], ['__count']) }
+    
+    for rec in self:
+      total, done = sums.get(rec.id, (0, 0))
+      rec.total_count = total
+      rec.done_count = done
+      rec.failed_shard_count = failed.get(rec.id, 0)
+      rec.progress = 100.0 * done / total if total else 100.0
+  
+  def _compute_failure_summary(self):
+    for rec in self:
+      errors = self.env['brivo.batch.shard']._read_group(
+        [('batch_id', '=', rec.id), ('state', '=', 'failed')], ['error'], ['__count'])
+      rec.failure_summary = '\n'.join(f'{count} x {error}' for error, count in errors) or False
+  
+  @api.model
+  def _get_batch_records(self, kind):
+    '''
+      Return the records covered by a batch of `kind`.
+    '''
+    model, domain, _method = BATCH_KINDS[kind]
+    return self.env[model].search(domain, order='id')
+  
+  @api.model
+  def start(self, kind):
+    '''
+      Create a batch running `kind` over its records, split into shards of
+      `BRIVO_BATCH_SHARD_SIZE` records, and wake the batch crons.
+    '''
+    label = dict(self._fields['kind'].selection)[kind]
+    if self.search_count([('kind', '=', kind), ('state', '=', 'running')]):
+      raise UserError(f'A Brivo batch "{label}" is already running.')
+    
+    ids = self._get_batch_records(kind).ids
+    if not ids:
+      raise UserError(f'There is nothing to process for "{label}".')
+    
+    rec = self.create({ 'kind': kind })
+    size = const.BRIVO_BATCH_SHARD_SIZE
+    self.env['brivo.batch.shard'].create([
+      { 'batch_id': rec.id, 'start_id': shard[0], 'end_id': shard[-1], 'cursor': shard[0] - 1, 'record_count': len(shard) }
+      for shard in (ids[i:i + size] for i in range(0, len(ids), size))
+    ])
+    _logger.info(f'Brivo Batch: Scheduled "{label}" for {len(ids)} records in {len(rec.shard_ids)} shards')
+    self._trigger_crons()
+    return rec
+  
+  def action_stop(self):
+    '''
+      Stop running batches once the chunks in progress are committed.
+    '''
+    self.filtered(lambda r: r.state == 'running').write({ 'state': 'stopped' })
+  
+  def action_resume(self):
+    '''
+      Resume stopped or failed batches from the cursors of their shards. Failed shards are
+      retried from their last committed chunk.
+    '''
+    to_resume = self.filtered(lambda r: r.state in ('stopped', 'failed'))
+    for rec in to_resume:
+      if self.search_count([('kind', '=', rec.kind), ('state', '=', 'running')]):
+        raise UserError(f'Another Brivo batch "{dict(self._fields["kind"].selection)[rec.kind]}" is running.')
+      rec.shard_ids.filtered(lambda s: s.state == 'failed').write({ 'state': 'pending', 'attempts': 0, 'error': False })
+      rec.state = 'running'
+    self._trigger_crons()
+  
+  @api.model
+  def _trigger_crons(self):
+    '''
+      Wake every batch cron, so that they share the shards.
+    '''
+    for cron in self.env['ir.cron'].sudo().search([('model_id.model', '=', self._name)]):
+      cron._trigger()
+  
+  @api.model
+  def cron_process_brivo_batches(self):
+    '''
+      Process the shards of running batches chunk by chunk, until they are all claimed or
+      the time budget is spent. Each chunk is committed with the cursor of its shard.
+    '''
+    deadline = time.time() + const.BRIVO_JOB_CRON_TIME_BUDGET
+    Shard = self.env['brivo.batch.shard']
+    
+    while time.time() < deadline:
+      shard = Shard._claim_shard()
+      if not shard:
+        break
+      
+      shard._run_chunk()
+      self.env.cr.commit()
+    
+    self.search([('state', '=', 'running')])._finalize()
+  
+  def _finalize(self):
+    for rec in self:
+      if rec.shard_ids.filtered(lambda s: s.state == 'pending'):
+        continue
+      
+      rec.state = 'failed' if rec.failed_shard_count else 'done'
+      _logger.info(f'Brivo Batch: "{dict(self._fields["kind"].selection)[rec.kind]}" finished, '
+                   f'{rec.done_count} records processed, {rec.failed_shard_count} shards failed')
+
+class BrivoBatchShard(models.Model):
+  _name = 'brivo.batch.shard'
+  _description = 'Range of record IDs of a Brivo batch, processed by one cron worker at a time.'
+  _order = 'id'
+  
+  batch_id = fields.Many2one('brivo.batch', required=True, index=True, ondelete='cascade')
+  start_id = fields.Integer(string='First ID', readonly=True)
+  end_id = fields.Integer(string='Last ID', readonly=True)
+  cursor = fields.Integer(readonly=True, help='ID of the last record processed, committed with each chunk.')
+  record_count = fields.Integer(string='Records', readonly=True)
+  done_count = fields.Integer(string='Processed', readonly=True)
+  state = fields.Selection([
+    ('pending', 'Pending'),
+    ('done', 'Done'),
+    ('failed', 'Failed')
+  ], default='pending', required=True, index=True)
+  attempts = fields.Integer(readonly=True)
+  error = fields.Char()
+  
+  @api.model
+  def _claim_shard(self):
+    '''
+      Lock a pending shard of a running batch until the next commit, skipping the ones other
+      workers hold.
+    '''
+    self.env.cr.execute('''
+      SELECT s.id
+        FROM brivo_batch_shard s
+        JOIN brivo_batch b ON b.id = s.batch_id
+       WHERE b.state = 'running'
+         AND s.state = 'pending'
+       ORDER BY s.id
+       LIMIT 1
+         FOR UPDATE OF s SKIP LOCKED
+    ''')
+    return self.browse([row[0] for row in self.env.cr.fetchall()])
+  
+  def _run_chunk(self):
+    '''
+      Run the operation of the batch on the next `BRIVO_BATCH_CHUNK_SIZE` records of this
+      shard, and move its cursor past them. A chunk that raises is rolled back to a savepoint,
+      keeping the shard locked, and retried by a later claim; the shard fails after
+      `BRIVO_BATCH_MAX_ATTEMPTS` attempts.
+    '''
+    self.ensure_one()
+    model, domain, method = BATCH_KINDS[self.batch_id.kind]
+    records = self.env[model].search(domain + [('id', '>', self.cursor), ('id', '<=', self.end_id)],
+                                     order='id', limit=const.BRIVO_BATCH_CHUNK_SIZE)
+    
+    if records:
+      try:
+        with self.env.cr.savepoint():
+          getattr(records, method)()
+      except Exception as err:
+        _logger.exception(f'Brivo Batch: Chunk after ID {self.cursor} of shard {self.id} raised an error')
+        self.env.invalidate_all()
+        attempts = self.attempts + 1
+        self.write({
+          'attempts': attempts,
+          'error': str(err) or repr(err),
+          'state': 'failed' if attempts >= const.BRIVO_BATCH_MAX_ATTEMPTS else 'pending'
+        })
+        return
+    
+    self.write({
+      'cursor': records[-1].id if records else self.end_id,
+      'done_count': self.done_count + len(records),
+      'state': 'pending' if len(records) == const.BRIVO_BATCH_CHUNK_SIZE else 'done',
+      'error': False
+    })
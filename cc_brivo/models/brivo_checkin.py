@@ -0,0 +1,188 @@
+import json
+import logging
+import time
+from datetime import datetime, timedelta, timezone
+from psycopg2.extras import execute_values
+from odoo import models, fields, api
+from ..utils import const
+from ..utils.brivo import brivo_connection, brivo_list_access_events
+from ..utils.locks import advisory_lock
+from .brivo_account import account_param
+
+_logger = logging.getLogger(__name__)
+
+class BrivoCheckin(models.Model):
+  _name = 'brivo.checkin'
+  _description = 'Door access events imported from Brivo, for attendance reporting.'
+  _order = 'occurred desc'
+  # Rows are inserted in bulk by the import and never edited
+  _log_access = False
+  
+  event_key = fields.Char(required=True, readonly=True, help='Brivo event ID, used to ignore events imported twice.')
+  account_id = fields.Many2one('brivo.account', string='Brivo Account', readonly=True, index=True, ondelete='cascade',
+                               help='Empty for the events of the account of the system settings.')
+  occurred = fields.Datetime(required=True, readonly=True, index=True)
+  occurred_date = fields.Date(string='Day', required=True, readonly=True)
+  partner_id = fields.Many2one('res.partner', string='Member', readonly=True, ondelete='set null')
+  brivo_user_id = fields.Integer(readonly=True)
+  door_id = fields.Integer(readonly=True)
+  door_name = fields.Char(string='Door', readonly=True)
+  granted = fields.Boolean(readonly=True)
+  
+  def init(self):
+    '''
+      Index the check-ins for per-member and per-day reports, and import each event of a
+      Brivo account once. Event IDs are only unique within their account.
+    '''
+    self.env.cr.execute('''
+      CREATE UNIQUE INDEX IF NOT EXISTS brivo_checkin_account_event_key_uniq
+          ON brivo_checkin ((COALESCE(account_id, 0)), event_key)
+    ''')
+    self.env.cr.execute('''
+      CREATE INDEX IF NOT EXISTS brivo_checkin_partner_occurred_index
+          ON brivo_checkin (partner_id, occurred)
+       WHERE partner_id IS NOT NULL
+    ''')
+    self.env.cr.execute('''
+      CREATE INDEX IF NOT EXISTS brivo_checkin_occurred_date_partner_index
+          ON brivo_checkin (occurred_date, partner_id)
+    ''')
+  
+  @api.model
+  def cron_import_brivo_checkins(self):
+    '''
+      Import the new access events of every Brivo account, skipping the accounts another
+      worker is importing.
+    '''
+    deadline = time.time() + const.BRIVO_JOB_CRON_TIME_BUDGET
+    for account_id in self.env['brivo.account']._get_account_ids():
+      with advisory_lock(self.env.cr, 'brivo.checkins.import', account_id or 0) as acquired:
+        if not acquired:
+          _logger.info(f'Brivo Check-in Import: Account {account_id or "default"} is being imported by another worker')
+          continue
+        self._import_checkins(account_id, deadline)
+  
+  @api.model
+  def _import_checkins(self, account_id, deadline):
+    '''
+      Import the access events of a Brivo account newer than its watermark, page by page.
+      Each page is inserted with one statement and committed; events imported twice are ignored.
+      
+      The watermark only moves once every page was read, since Brivo does not guarantee the
+      order of the pages. Until then, the offset reached is committed with each page as the
+      cursor of the window, so that an import running out of time resumes where it stopped
+      and a backlog larger than one run still progresses.
+    '''
+    ICP = self.env['ir.config_parameter'].sudo()
+    watermark_key = account_param(const.IR_CONFIG_CHECKINS_WATERMARK, account_id)
+    cursor_key = account_param(const.IR_CONFIG_CHECKINS_CURSOR, account_id)
+    cursor = json.loads(ICP.get_param(cursor_key) or '{}')
+    watermark = ICP.get_param(watermark_key)
+    
+    if cursor:
+      since = datetime.fromisoformat(cursor['since'])
+      newest = cursor['newest'] and datetime.fromisoformat(cursor['newest'])
+      offset = cursor['offset']
+    else:
+      if watermark:
+        since = datetime.fromisoformat(watermark) - timedelta(seconds=const.BRIVO_CHECKIN_OVERLAP)
+      else:
+        since = fields.Datetime.now() - timedelta(days=const.BRIVO_CHECKIN_INITIAL_DAYS)
+      newest = None
+      offset = 0
+    
+    conn = brivo_connection(self.env, account_id)
+    read = inserted = 0
+    
+    while True:
+      if time.time() >= deadline:
+        _logger.warning(f'Brivo Check-in Import: Out of time after {read} events of account {account_id or "default"}, '
+                        f'resuming at offset {offset} next time')
+        return
+      
+      page = brivo_list_access_events(conn, since.strftime('%Y-%m-%dT%H:%M:%SZ'), offset=offset)
+      if page.get('status', None) == 'FAILURE':
+        _logger.error(f'Brivo Check-in Import: Listing events failed at offset {offset}: {page.get("error")}')
+        return
+      
+      events = page.get('data') or []
+      rows = self._prepare_rows(events, account_id)
+      inserted += self._insert_rows(rows)
+      
+      read += len(events)
+      if rows:
+        page_newest = max(row[1] for row in rows)
+        newest = max(newest, page_newest) if newest else page_newest
+      
+      offset += len(events)
+      ICP.set_param(cursor_key, json.dumps({
+        'since': since.isoformat(),
+        'offset': offset,
+        'newest': newest and newest.isoformat()
+      }))
+      self.env.cr.commit()
+      if not events or offset >= page.get('count', offset + 1):
+        break
+    
+    if newest:
+      ICP.set_param(watermark_key, newest.isoformat())
+    ICP.set_param(cursor_key, False)
+    self.env.cr.commit()
+    _logger.info(f'Brivo Check-in Import: Read {read} events of account {account_id or "default"}, {inserted} new check-ins')
+  
+  @api.model
+  def _prepare_rows(self, events, account_id=False):
+    '''
+      Turn a page of Brivo access events of an account into check-in rows, resolving their
+      users to the partners of the account in bulk: by Brivo user ID, then by `externalId`.
+    '''
+    parsed = []
+    for event in events:
+      actor = event.get('actor') or {}
+      door = event.get('eventObject') or {}
+      action = event.get('securityAction') or {}
+      occurred = event.get('occurred')
+      key = event.get('uuid') or event.get('id')
+      if not occurred or not key:
+        continue
+      
+      occurred = datetime.fromisoformat(occurred.replace('Z', '+00:00'))
+      if occurred.tzinfo:
+        occurred = occurred.astimezone(timezone.utc).replace(tzinfo=None)
+      parsed.append((str(key), occurred, actor, door, action))
+    
+    partner_by_brivo_id = self.env['res.partner']._resolve_brivo_ids((a.get('id') for _, _, a, _, _ in parsed), account_id=account_id)
+    
+    external_ids = { int(a['externalId']) for _, _, a, _, _ in parsed if str(a.get('externalId') or '').isdigit() }
+    existing_ids = set()
+    if external_ids:
+      self.env.cr.execute('SELECT id FROM res_partner WHERE id = ANY(%s) AND COALESCE(brivo_account_id, 0) = %s',
+                          [list(external_ids), account_id or 0])
+      existing_ids = { row[0] for row in self.env.cr.fetchall() }
+    
+    rows = []
+    for key, occurred, actor, door, action in parsed:
+      partner_id = partner_by_brivo_id.get(actor.get('id'))
+      if not partner_id and str(actor.get('externalId') or '').isdigit() and int(actor['externalId']) in existing_ids:
+        partner_id = int(actor['externalId'])
+      granted = not action.get('exception', False) and 'denied' not in str(action.get('action') or '').lower()
+      rows.append((key, occurred, occurred.date(), partner_id, actor.get('id'), door.get('id'), door.get('name'), granted,
+                   account_id or None))
+    
+    return rows
+  
+  @api.model
+  def _insert_rows(self, rows):
+    '''
+      Insert check-in rows with a single statement. Output: the number of new check-ins.
+    '''
+    if not rows:
+      return 0
+    
+    # Rows are deduplicated by the statement itself, so a page repeated by the overlap costs nothing
+    execute_values(self.env.cr._obj, '''
+      INSERT INTO brivo_checkin (event_key, occurred, occurred_date, partner_id, brivo_user_id, door_id, door_name, granted, account_id)
+      VALUES %s
+      ON CONFLICT ((COALESCE(account_id, 0)), event_key) DO NOTHING
+    ''', rows, page_size=len(rows))
+    return self.env.cr.rowcount
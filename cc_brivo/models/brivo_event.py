@@ -0,0 +1,187 @@
+import hashlib
+import json
+import logging
+from collections import defaultdict
+from datetime import timedelta
+from odoo import models, fields, api
+from ..utils import const
+
+_logger = logging.getLogger(__name__)
+
+class BrivoEvent(models.Model):
+  _name = 'brivo.event'
+  _description = 'Events received from Brivo event subscriptions, applied in batches to the local state.'
+  _order = 'id desc'
+  
+  event_key = fields.Char(required=True, index=True, readonly=True,
+                          help='Brivo event ID, unique within its account, used to ignore redeliveries.')
+  event_type = fields.Char(readonly=True)
+  account_id = fields.Many2one('brivo.account', string='Brivo Account', readonly=True, ondelete='cascade',
+                               help='Brivo account the event was received from, empty for the account of the system settings.')
+  payload = fields.Json(readonly=True)
+  state = fields.Selection([
+    ('pending', 'Pending'),
+    ('done', 'Done'),
+    ('ignored', 'Ignored')
+  ], default='pending', required=True, index=True, readonly=True)
+  processed_date = fields.Datetime(readonly=True)
+  
+  def init(self):
+    '''
+      Receive each event of a Brivo account once. Event IDs are only unique within their account.
+    '''
+    self.env.cr.execute('''
+      CREATE UNIQUE INDEX IF NOT EXISTS brivo_event_account_event_key_uniq
+          ON brivo_event ((COALESCE(account_id, 0)), event_key)
+    ''')
+  
+  @api.model
+  def receive(self, events, account_id=False):
+    '''
+      Store received events, ignoring the ones already received.
+      Input:
+        - events. A list of Brivo event payloads.
+        - account_id. The Brivo account the events were received from.
+      Output:
+        The number of new events.
+    '''
+    received = 0
+    for event in events:
+      event_key = str(event.get('uuid') or event.get('id') or
+                      hashlib.sha1(json.dumps(event, sort_keys=True).encode('utf-8')).hexdigest())
+      self.env.cr.execute('''
+        INSERT INTO brivo_event (event_key, event_type, payload, account_id, state, create_date, write_date, create_uid, write_uid)
+        VALUES (%s, %s, %s, %s, 'pending', now() at time zone 'UTC', now() at time zone 'UTC', %s, %s)
+        ON CONFLICT ((COALESCE(account_id, 0)), event_key) DO NOTHING
+      ''', [event_key, _event_type(event), json.dumps(event), account_id or None, self.env.uid, self.env.uid])
+      received += self.env.cr.rowcount
+    
+    if received:
+      self.env.ref('cc_brivo.ir_cron_process_brivo_events').sudo()._trigger()
+    return received
+  
+  @api.model
+  def cron_process_brivo_events(self):
+    '''
+      Apply pending events to the Brivo groups and partners, one batch per transaction.
+      Events of a batch are applied in the order they were received, the last event on
+      an object winning, and applying an event twice leaves the same state.
+    '''
+    while True:
+      self.env.cr.execute('''
+        SELECT id
+          FROM brivo_event
+         WHERE state = 'pending'
+         ORDER BY id
+         LIMIT %s
+           FOR UPDATE SKIP LOCKED
+      ''', [const.BRIVO_EVENT_BATCH_SIZE])
+      events = self.browse([row[0] for row in self.env.cr.fetchall()])
+      if not events:
+        break
+      
+      events._apply()
+      self.env.cr.commit()
+  
+  def _apply(self):
+    # Groups are per account, keyed by (account ID, Brivo group ID)
+    groups = {}
+    deleted_groups = set()
+    # Brivo user IDs are per account, keyed by (account ID, Brivo user ID)
+    suspended = {}
+    credentials = {}
+    applied = self.browse()
+    
+    for event in self:
+      event_type = event.event_type
+      obj = _event_object(event.payload)
+      account_id = event.account_id.id
+      group_key = (account_id, obj.get('id'))
+      
+      if event_type in const.BRIVO_EVENT_GROUP_UPSERT and obj.get('id'):
+        groups[group_key] = obj.get('name')
+        deleted_groups.discard(group_key)
+      elif event_type in const.BRIVO_EVENT_GROUP_DELETE and obj.get('id'):
+        deleted_groups.add(group_key)
+        groups.pop(group_key, None)
+      elif event_type in const.BRIVO_EVENT_USER_SUSPENDED and obj.get('id'):
+        suspended[(account_id, obj['id'])] = True
+      elif event_type in const.BRIVO_EVENT_USER_UNSUSPENDED and obj.get('id'):
+        suspended[(account_id, obj['id'])] = False
+      elif event_type in const.BRIVO_EVENT_CREDENTIAL_ASSIGNED and obj.get('userId'):
+        credentials[(account_id, obj['userId'])] = (True, obj.get('credentialId'))
+      elif event_type in const.BRIVO_EVENT_CREDENTIAL_UNASSIGNED and obj.get('userId'):
+        credentials[(account_id, obj['userId'])] = (False, obj.get('credentialId'))
+      else:
+        continue
+      applied |= event
+    
+    self._apply_groups(groups, deleted_groups)
+    self._apply_partners(suspended, credentials)
+    
+    now = fields.Datetime.now()
+    applied.write({ 'state': 'done', 'processed_date': now })
+    (self - applied).write({ 'state': 'ignored', 'processed_date': now })
+  
+  @api.model
+  def _apply_groups(self, groups, deleted_groups):
+    Groups = self.env['brivo.groups'].with_context(active_test=False)
+    existing = Groups.search([('brivo_group_id', 'in', [gid for _, gid in set(groups) | deleted_groups])])
+    rec_by_key = { (g.account_id.id, g.brivo_group_id): g for g in existing }
+    
+    Groups.create([{ 'name': name, 'brivo_group_id': gid, 'account_id': account_id }
+                   for (account_id, gid), name in groups.items() if (account_id, gid) not in rec_by_key])
+    for key, name in groups.items():
+      rec = rec_by_key.get(key)
+      if rec and (rec.name != name or not rec.active):
+        rec.write({ 'name': name or rec.name, 'active': True })
+    
+    Groups.browse([rec_by_key[key].id for key in deleted_groups if key in rec_by_key]).write({ 'active': False })
+  
+  @api.model
+  def _apply_partners(self, suspended, credentials):
+    Partner = self.env['res.partner'].with_context(skip_brivo_call_on_write=True, active_test=False)
+    
+    # Resolve the Brivo user IDs of each account among the partners of that account only
+    brivo_ids = defaultdict(set)
+    for account_id, brivo_id in set(suspended) | set(credentials):
+      brivo_ids[account_id].add(brivo_id)
+    partner_by_key = {}
+    for account_id, ids in brivo_ids.items():
+      for brivo_id, partner_id in Partner._resolve_brivo_ids(ids, account_id=account_id).items():
+        partner_by_key[(account_id, brivo_id)] = Partner.browse(partner_id)
+    
+    by_value = defaultdict(lambda: Partner)
+    for key, value in suspended.items():
+      if key in partner_by_key:
+        by_value[value] |= partner_by_key[key]
+    for value, recs in by_value.items():
+      # The groups are not part of the event, the state date is left for them
+      recs.write({ 'brivo_suspended': value })
+    
+    for key, (assigned, cred_id) in credentials.items():
+      partner = partner_by_key.get(key)
+      if not partner:
+        continue
+      if assigned and cred_id != partner.brivo_barcode_credential_id:
+        partner.brivo_barcode_credential_id = cred_id
+      elif not assigned and cred_id == partner.brivo_barcode_credential_id:
+        partner.brivo_barcode_credential_id = False
+  
+  @api.autovacuum
+  def _gc_processed_events(self):
+    limit_date = fields.Datetime.now() - timedelta(days=const.BRIVO_JOB_RETENTION_DAYS)
+    self.search([('state', '!=', 'pending'), ('processed_date', '<', limit_date)]).unlink()
+
+def _event_type(event):
+  '''
+    Returns the normalized (lower case) type of a Brivo event payload.
+  '''
+  return str(event.get('eventType') or event.get('type') or '').strip().lower()
+
+def _event_object(event):
+  '''
+    Returns the object a Brivo event payload is about.
+  '''
+  obj = event.get('eventObject') or event.get('object') or event.get('data') or {}
+  return obj if isinstance(obj, dict) else {}
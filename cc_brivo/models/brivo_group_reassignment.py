@@ -0,0 +1,204 @@
+import logging
+import time
+from collections import defaultdict
+from odoo import models, fields, api, Command
+from ..utils import const
+from ..utils.brivo import brivo_add_to_group, brivo_remove_from_group
+from ..utils.brivo_async import run_brivo_account_batches
+
+_logger = logging.getLogger(__name__)
+
+class BrivoGroupReassignment(models.Model):
+  _name = 'brivo.group.reassignment'
+  _description = 'Background transfer of the members of a membership from one Brivo group to another.'
+  _order = 'id desc'
+  
+  sale_order_template_id = fields.Many2one('sale.order.template', string='Membership', required=True, readonly=True)
+  old_brivo_group_id = fields.Many2one('brivo.groups', string='Old Brivo Group', readonly=True, context={ 'active_test': False })
+  brivo_group_id = fields.Many2one('brivo.groups', string='New Brivo Group', required=True, readonly=True, context={ 'active_test': False })
+  state = fields.Selection([
+    ('running', 'Running'),
+    ('done', 'Done'),
+    ('failed', 'Failed')
+  ], default='running', required=True, index=True, readonly=True)
+  line_ids = fields.One2many('brivo.group.reassignment.line', 'reassignment_id', readonly=True)
+  
+  total_count = fields.Integer(compute='_compute_progress')
+  done_count = fields.Integer(compute='_compute_progress')
+  failed_count = fields.Integer(compute='_compute_progress')
+  progress = fields.Float(compute='_compute_progress')
+  failure_summary = fields.Text(compute='_compute_failure_summary')
+  
+  def _compute_progress(self):
+    counts = { (r.id, state): count for r, state, count in self.env['brivo.group.reassignment.line']._read_group(
+      [('reassignment_id', 'in', self.ids)], ['reassignment_id', 'state'], ['__count']) }
+    
+    for rec in self:
+      done = counts.get((rec.id, 'done'), 0)
+      failed = counts.get((rec.id, 'failed'), 0)
+      total = done + failed + counts.get((rec.id, 'pending'), 0)
+      rec.total_count = total
+      rec.done_count = done
+      rec.failed_count = failed
+      rec.progress = 100.0 * (done + failed) / total if total else 100.0
+  
+  def _compute_failure_summary(self):
+    for rec in self:
+      errors = self.env['brivo.group.reassignment.line']._read_group(
+        [('reassignment_id', '=', rec.id), ('state', '=', 'failed')], ['error'], ['__count'])
+      rec.failure_summary = '\n'.join(f'{count} x {error}' for error, count in errors) or False
+  
+  @api.model
+  def start(self, sale_order_template, partners, brivo_group):
+    '''
+      Create a reassignment moving `partners` from the current Brivo group of
+      `sale_order_template` to `brivo_group`, and schedule it.
+    '''
+    rec = self.create({
+      'sale_order_template_id': sale_order_template.id,
+      'old_brivo_group_id': sale_order_template.brivo_group_id.id,
+      'brivo_group_id': brivo_group.id
+    })
+    self.env['brivo.group.reassignment.line'].create([
+      { 'reassignment_id': rec.id, 'partner_id': p.id } for p in partners
+    ])
+    self._trigger_cron()
+    return rec
+  
+  def action_resume(self):
+    '''
+      Resume failed reassignments: the failed members are retried, the finished ones are kept.
+    '''
+    failed = self.filtered(lambda r: r.state == 'failed')
+    failed.line_ids.filtered(lambda l: l.state == 'failed').write({ 'state': 'pending', 'error': False })
+    failed.write({ 'state': 'running' })
+    self._trigger_cron()
+  
+  @api.model
+  def _trigger_cron(self):
+    self.env.ref('cc_brivo.ir_cron_process_brivo_group_reassignments').sudo()._trigger()
+  
+  @api.model
+  def cron_process_brivo_group_reassignments(self):
+    '''
+      Move the members of running reassignments chunk by chunk. Each chunk is committed,
+      so a reassignment interrupted by a restart continues where it stopped.
+    '''
+    deadline = time.time() + const.BRIVO_JOB_CRON_TIME_BUDGET
+    
+    while time.time() < deadline:
+      lines = self.env['brivo.group.reassignment.line']._claim_lines(const.BRIVO_REASSIGNMENT_CHUNK_SIZE)
+      if not lines:
+        break
+      
+      lines._run()
+      self.env.cr.commit()
+    
+    self.search([('state', '=', 'running')])._finalize()
+  
+  def _finalize(self):
+    for rec in self:
+      if rec.done_count + rec.failed_count < rec.total_count:
+        continue
+      
+      rec.state = 'failed' if rec.failed_count else 'done'
+      _logger.info(f'Brivo Group Reassignment: {rec.sale_order_template_id.name} finished, '
+                   f'{rec.done_count} members moved, {rec.failed_count} failed')
+
+class BrivoGroupReassignmentLine(models.Model):
+  _name = 'brivo.group.reassignment.line'
+  _description = 'Status of one member in a Brivo group reassignment.'
+  _order = 'id'
+  
+  reassignment_id = fields.Many2one('brivo.group.reassignment', required=True, index=True, ondelete='cascade')
+  partner_id = fields.Many2one('res.partner', string='Member', required=True, ondelete='cascade')
+  state = fields.Selection([
+    ('pending', 'Pending'),
+    ('done', 'Done'),
+    ('failed', 'Failed')
+  ], default='pending', required=True, index=True)
+  error = fields.Char()
+  
+  @api.model
+  def _claim_lines(self, limit):
+    self.env.cr.execute('''
+      SELECT l.id
+        FROM brivo_group_reassignment_line l
+        JOIN brivo_group_reassignment r ON r.id = l.reassignment_id
+       WHERE r.state = 'running'
+         AND l.state = 'pending'
+       ORDER BY l.id
+       LIMIT %s
+         FOR UPDATE OF l SKIP LOCKED
+    ''', [limit])
+    return self.browse([row[0] for row in self.env.cr.fetchall()])
+  
+  def _run(self):
+    '''
+      Remove each member from the old group and add it to the new one, all in flight at
+      once through the async client, in the Brivo account of each member. The outcomes are
+      written in batches: one write for the moved members of each reassignment, and one per
+      distinct error.
+      
+      Groups are only sent to members of their own Brivo account: the old group of another
+      account is left alone, and members of another account than the new group fail.
+    '''
+    failed = defaultdict(lambda: self.browse())
+    mismatched = self.filtered(lambda l: l.reassignment_id.brivo_group_id.account_id != l.partner_id.brivo_account_id)
+    if mismatched:
+      failed['The new Brivo group belongs to another Brivo account.'] |= mismatched
+    
+    by_account = (self - mismatched).grouped(lambda l: l.partner_id.brivo_account_id)
+    errors_by_account = run_brivo_account_batches(self.env, {
+      account.id: [
+        (_move_member,
+         line.reassignment_id.old_brivo_group_id.brivo_group_id if line.reassignment_id.old_brivo_group_id.account_id == account else 0,
+         line.reassignment_id.brivo_group_id.brivo_group_id,
+         line.partner_id.brivo_id)
+        for line in lines
+      ]
+      for account, lines in by_account.items()
+    })
+    
+    for account, lines in by_account.items():
+      for line, error in zip(lines, errors_by_account[account.id]):
+        failed[error] |= line
+    
+    for error, lines in failed.items():
+      lines.write({ 'state': 'failed' if error else 'done', 'error': error or False })
+    
+    for reassignment, lines in failed.pop(None, self.browse()).grouped('reassignment_id').items():
+      Groups = self.env['brivo.groups'].with_context(active_test=False)
+      old_group, new_group = reassignment.old_brivo_group_id, reassignment.brivo_group_id
+      old_groups = Groups.search([('account_id', '=', old_group.account_id.id), ('brivo_group_id', '=', old_group.brivo_group_id)]) if old_group else Groups
+      new_groups = Groups.search([('account_id', '=', new_group.account_id.id), ('brivo_group_id', '=', new_group.brivo_group_id)])
+      lines.partner_id.with_context(skip_brivo_call_on_write=True).write({
+        'brivo_group_ids': [Command.unlink(g.id) for g in old_groups - new_groups] + [Command.link(g.id) for g in new_groups]
+      })
+
+def _move_member(conn, old_brivo_group_id, new_brivo_group_id, brivo_user_id):
+  '''
+    Move a Brivo user between groups. Safe to call from worker threads.
+    The user joins the new group before leaving the old one, so that a failed call never
+    leaves it without access, and a membership already gone from the old group (e.g. when
+    a move is resumed) counts as removed.
+    Output:
+      An error message, or None on success.
+  '''
+  if not brivo_user_id:
+    return 'The member has no Brivo user.'
+  
+  try:
+    res = brivo_add_to_group(conn, new_brivo_group_id, brivo_user_id)
+    if res.get('status', None) == 'FAILURE':
+      return f'Add to new group: {res.get("error")}'
+    
+    if old_brivo_group_id and old_brivo_group_id != new_brivo_group_id:
+      res = brivo_remove_from_group(conn, old_brivo_group_id, brivo_user_id)
+      if res.get('status', None) == 'FAILURE' and res.get('status_code') != 404:
+        return f'Remove from old group: {res.get("error")}'
+    
+    return None
+  except Exception as err:
+    _logger.exception('Brivo Group Reassignment: Moving a member raised an error')
+    return str(err) or repr(err)
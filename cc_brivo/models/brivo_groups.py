@@ -1,6 +1,11 @@
+import hashlib
+import json
 import logging
 from odoo import models, fields, api
-from ..utils.brivo import brivo_list_groups
+from ..utils import const
+from ..utils.brivo import brivo_connection, brivo_iter_groups, BrivoListError
+from ..utils.locks import advisory_lock
+from .brivo_account import account_param
 
 _logger = logging.getLogger(__name__)
 
@@ -9,31 +14,90 @@ class BrivoGroups(models.Model):
   _description = 'Model that syncs with Brivo for listing groups in the system.'
   
   name = fields.Char(readonly=True)
-  brivo_group_id = fields.Integer(readonly=True)
+  brivo_group_id = fields.Integer(readonly=True, index=True)
+  active = fields.Boolean(default=True, help='Groups that no longer exist in Brivo are archived.')
+  account_id = fields.Many2one('brivo.account', string='Brivo Account', readonly=True, index=True, ondelete='cascade',
+                               help='Empty for the groups of the account of the system settings.')
   
   @api.model
   def cron_sync_brivo_groups(self):
     '''
-       Synchronize groups in Brivo with our system.
+       Synchronize the groups of every Brivo account with our system, committing after each
+       account. An account already being synced by another worker is skipped, so that runs
+       of this cron started by hand and by the scheduler share the accounts instead of
+       creating the same groups twice.
     '''
-    groups : dict = brivo_list_groups(self.env)
+    for account_id in self.env['brivo.account']._get_account_ids():
+      with advisory_lock(self.env.cr, 'brivo.groups.sync', account_id or 0) as acquired:
+        if not acquired:
+          _logger.info(f'Brivo Group Sync: Account {account_id or "default"} is being synced by another worker')
+          continue
+        self._sync_brivo_groups(account_id)
+        self.env.cr.commit()
+  
+  @api.model
+  def _sync_brivo_groups(self, account_id=False):
+    '''
+       Synchronize the groups of a Brivo account with our system.
+       
+       Groups are fetched page by page and upserted: new groups are created in one batch,
+       renamed groups are updated in place, and groups that vanished from Brivo are archived
+       so that memberships linked to them keep their reference. When the groups are the same
+       as in the last sync, nothing is written.
+    '''
+    group_id_to_name = self._fetch_brivo_groups(account_id)
+    
+    if group_id_to_name is None:
+      return
+    
+    digest = hashlib.sha1(json.dumps(sorted(group_id_to_name.items())).encode('utf-8')).hexdigest()
+    ICP = self.env['ir.config_parameter'].sudo()
+    hash_key = account_param(const.IR_CONFIG_GROUPS_SYNC_HASH, account_id)
     
-    group_id_to_group : dict = { g['id'] : g for g in groups['data'] }
-    group_ids : list = [ g['id'] for g in groups['data'] ]
+    if ICP.get_param(hash_key) == digest:
+      _logger.info(f'Brivo Group Sync: Groups of account {account_id or "default"} are unchanged since the last sync')
+      return
     
-    # Erase records that are not found in the Brivo groups
-    erase_records = self.search([('brivo_group_id', 'not in', group_ids)])
-    erase_records.unlink()
+    records = self.with_context(active_test=False).search([('account_id', '=', account_id)])
+    rec_by_group_id : dict = { r.brivo_group_id : r for r in records }
     
-    # Create records for Brivo records that do not have a corresponding record
-    rec_ids : set = set(self.search([]).mapped('brivo_group_id'))
+    # Create records for Brivo groups that do not have a corresponding record
+    new_ids = [ gid for gid in group_id_to_name if gid not in rec_by_group_id ]
+    if new_ids:
+      _logger.info(f'Brivo Group Sync: Creating records for Brivo Groups: {[ group_id_to_name[gid] for gid in new_ids ]}')
+      self.create([{ 'name': group_id_to_name[gid], 'brivo_group_id': gid, 'account_id': account_id } for gid in new_ids])
     
-    diff : set = set(group_ids).difference(rec_ids)
+    # Rename records and restore the ones that reappeared
+    for gid, rec in rec_by_group_id.items():
+      if gid not in group_id_to_name:
+        continue
+      
+      vals = {}
+      if rec.name != group_id_to_name[gid]:
+        vals['name'] = group_id_to_name[gid]
+      if not rec.active:
+        vals['active'] = True
+      if vals:
+        rec.write(vals)
     
-    _logger.info(f'Brivo Group Sync: Creating records for Brivo Groups: {[ group_id_to_group[gid]['name'] for gid in diff ]}')
-    for gid in diff:
-      group = group_id_to_group[gid]
-      self.create({
-        'name': group['name'],
-        'brivo_group_id': group['id']
-      })
\ No newline at end of file
+    # Archive records that are not found in the Brivo groups
+    vanished = records.filtered(lambda r: r.active and r.brivo_group_id not in group_id_to_name)
+    if vanished:
+      _logger.info(f'Brivo Group Sync: Archiving records for vanished Brivo Groups: {vanished.mapped("name")}')
+      vanished.write({ 'active': False })
+    
+    ICP.set_param(hash_key, digest)
+  
+  @api.model
+  def _fetch_brivo_groups(self, account_id=False):
+    '''
+      Fetch every group of a Brivo account, keeping only their names as the pages arrive.
+      Unchanged pages are revalidated without being downloaded again.
+      Output:
+        A dict mapping Brivo group IDs to names, or None if a page could not be fetched.
+    '''
+    try:
+      return { g['id'] : g['name'] for g in brivo_iter_groups(brivo_connection(self.env, account_id), prefetch=True) }
+    except BrivoListError as err:
+      _logger.error(f'Brivo Group Sync: {err}')
+      return None
@@ -0,0 +1,399 @@
+import itertools
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from odoo import models, fields, api
+from ..utils import const
+from ..utils.brivo import (brivo_connection, partner_snapshot, brivo_user_fingerprint, brivo_provision_user, brivo_rotate_barcode_credential,
+                           brivo_delete_barcode_credential, brivo_delete_user, brivo_update_user, brivo_toggle_suspended_status,
+                           brivo_add_to_group, brivo_remove_from_group, brivo_issue_barcode_credential, brivo_assign_credential)
+from ..utils.metrics import attributed
+
+_logger = logging.getLogger(__name__)
+
+JOB_TYPES = [
+  ('create_user', 'Create User'),
+  ('update_user', 'Update User'),
+  ('rotate_credential', 'Rotate Credential'),
+  ('suspend', 'Suspend/Unsuspend'),
+  ('add_group', 'Add to Group'),
+  ('remove_group', 'Remove from Group'),
+  ('revoke_credential', 'Revoke Credential'),
+  ('sync_group', 'Sync Group Membership'),
+  ('delete_user', 'Delete User')
+]
+
+class BrivoJob(models.Model):
+  _name = 'brivo.job'
+  _description = 'Outbox of Brivo operations, run by a cron after the originating transaction commits.'
+  _order = 'id desc'
+  
+  partner_id = fields.Many2one('res.partner', required=True, index=True, ondelete='cascade', readonly=True)
+  account_id = fields.Many2one('brivo.account', string='Brivo Account', related='partner_id.brivo_account_id', store=True, index=True)
+  job_type = fields.Selection(JOB_TYPES, required=True, readonly=True)
+  payload = fields.Json(readonly=True)
+  dedup_key = fields.Char(index=True, readonly=True)
+  state = fields.Selection([
+    ('pending', 'Pending'),
+    ('done', 'Done'),
+    ('failed', 'Failed')
+  ], default='pending', required=True, index=True, readonly=True)
+  attempts = fields.Integer(readonly=True)
+  next_attempt = fields.Datetime(default=fields.Datetime.now, index=True, readonly=True)
+  done_date = fields.Datetime(readonly=True)
+  last_error = fields.Text(readonly=True)
+  
+  @api.model
+  def _dedup_key(self, job_type, payload):
+    '''
+      Jobs sharing a partner and a dedup key supersede each other: only the latest intent matters.
+    '''
+    if job_type in ('add_group', 'remove_group', 'sync_group'):
+      return f'group:{payload["brivo_group_id"]}'
+    if job_type == 'revoke_credential':
+      return f'credential:{payload["brivo_credential_id"]}'
+    return job_type
+  
+  @api.model
+  def enqueue(self, partners, job_type, payload=None, delay=0):
+    '''
+      Queue a Brivo operation for each partner in `partners`.
+      
+      A pending job with the same partner and dedup key is updated in place instead of
+      queueing a new one, so superseded updates are never sent. User updates and credential
+      rotations are dropped while a user creation is pending, since the creation pushes the
+      partner's latest data anyway.
+      Input:
+        - partners. A res.partner recordset.
+        - job_type. One of `JOB_TYPES`.
+        - payload. A JSON-serializable dict with the job arguments.
+        - delay. Seconds before the jobs are due. A pending job updated in place is
+          postponed as well, so that changes made within `delay` are sent once.
+      Output:
+        The brivo.job records that were created or updated.
+    '''
+    partners = partners.filtered('id')
+    if not partners:
+      return self.browse()
+    
+    # Jobs are queued on behalf of users who have no access to the queue itself
+    self = self.sudo()
+    
+    dedup_key = self._dedup_key(job_type, payload)
+    keys = [dedup_key]
+    if job_type in ('update_user', 'rotate_credential'):
+      keys.append('create_user')
+    
+    # Rows currently being run by the job cron are locked; a new job is queued behind them.
+    self.flush_model()
+    self.env.cr.execute('''
+      SELECT id, partner_id, dedup_key
+        FROM brivo_job
+       WHERE state = 'pending'
+         AND partner_id = ANY(%s)
+         AND dedup_key = ANY(%s)
+         FOR UPDATE SKIP LOCKED
+    ''', [partners.ids, keys])
+    pending = { (partner_id, key): job_id for job_id, partner_id, key in self.env.cr.fetchall() }
+    
+    next_attempt = fields.Datetime.now() + timedelta(seconds=delay)
+    jobs = self.browse()
+    vals_list = []
+    for partner in partners:
+      if dedup_key != 'create_user' and (partner.id, 'create_user') in pending:
+        continue
+      
+      job_id = pending.get((partner.id, dedup_key))
+      if job_id:
+        job = self.browse(job_id)
+        job.write({
+          'job_type': job_type,
+          'payload': payload,
+          'attempts': 0,
+          'next_attempt': next_attempt,
+          'last_error': False
+        })
+        jobs |= job
+      else:
+        vals_list.append({
+          'partner_id': partner.id,
+          'job_type': job_type,
+          'payload': payload,
+          'dedup_key': dedup_key,
+          'next_attempt': next_attempt
+        })
+    
+    jobs |= self.create(vals_list)
+    
+    cron = self.env.ref('cc_brivo.ir_cron_process_brivo_jobs', raise_if_not_found=False)
+    if cron:
+      cron.sudo()._trigger(next_attempt if delay else None)
+    
+    return jobs
+  
+  @api.model
+  def cron_process_brivo_jobs(self):
+    '''
+      Run due Brivo jobs in batches, committing after each batch.
+      
+      Only the oldest pending job of each partner is eligible, which keeps the jobs of a
+      partner in order while a failing job waits for its retry, and guarantees that the
+      jobs of a batch belong to distinct partners. Claimed rows are locked with SKIP LOCKED
+      so that concurrent runs never pick the same job.
+      
+      A batch takes up to `BRIVO_JOB_BATCH_SIZE` jobs of each Brivo account, so a backlog
+      on one account does not hold back the jobs of the others.
+    '''
+    deadline = time.time() + const.BRIVO_JOB_CRON_TIME_BUDGET
+    processed = failed = 0
+    
+    while time.time() < deadline:
+      jobs = self._claim_jobs(const.BRIVO_JOB_BATCH_SIZE)
+      if not jobs:
+        break
+      
+      failed += len(jobs._run())
+      processed += len(jobs)
+      self.env.cr.commit()
+    
+    if processed:
+      _logger.info(f'Brivo Job Queue: Processed {processed} jobs, {failed} failed')
+  
+  @api.model
+  def _claim_jobs(self, limit):
+    '''
+      Lock and return the next due jobs, up to `limit` per Brivo account.
+    '''
+    self.env.cr.execute('''
+      SELECT id
+        FROM brivo_job
+       WHERE id IN (
+               SELECT id
+                 FROM (
+                        SELECT j.id, ROW_NUMBER() OVER (PARTITION BY j.account_id ORDER BY j.id) AS rank
+                          FROM brivo_job j
+                         WHERE j.state = 'pending'
+                           AND j.next_attempt <= now() at time zone 'UTC'
+                           AND NOT EXISTS (
+                                 SELECT 1
+                                   FROM brivo_job p
+                                  WHERE p.partner_id = j.partner_id
+                                    AND p.state = 'pending'
+                                    AND p.id < j.id
+                               )
+                      ) due
+                WHERE rank <= %s
+             )
+       ORDER BY id
+         FOR UPDATE SKIP LOCKED
+    ''', [limit])
+    return self.browse([row[0] for row in self.env.cr.fetchall()])
+  
+  def _run(self):
+    '''
+      Execute these jobs with bounded concurrency and record their outcomes, scheduling
+      retries with exponential backoff on failure.
+      
+      The Brivo calls run in worker threads on snapshots of the partners; all reads and
+      writes of records happen in the calling thread.
+      Output:
+        The jobs that failed.
+    '''
+    conns = { account_id: brivo_connection(self.env, account_id) for account_id in set(self.mapped(lambda j: j.account_id.id)) }
+    active_memberships = self._get_active_memberships()
+    
+    # Jobs of the different accounts are interleaved, so that each account gets its share of the threads
+    by_account = self.grouped('account_id')
+    jobs = self.browse(_interleave([account_jobs.ids for account_jobs in by_account.values()]))
+    
+    tasks = []
+    for job in jobs:
+      job_type, payload = job.job_type, job.payload or {}
+      if job_type == 'sync_group':
+        job_type = job._get_membership_delta(active_memberships)
+      elif job_type == 'delete_user' and not job.partner_id.brivo_provisional:
+        # The partner confirmed a membership since its deletion was queued
+        job_type = None
+      tasks.append((conns[job.account_id.id], job_type, payload, partner_snapshot(job.partner_id.with_context(active_test=False))))
+    
+    if len(tasks) == 1:
+      results = [_perform_job(*tasks[0])]
+    else:
+      with ThreadPoolExecutor(max_workers=min(const.BRIVO_JOB_CONCURRENCY * len(conns), const.BRIVO_ASYNC_CONCURRENCY)) as executor:
+        results = list(executor.map(attributed(lambda task: _perform_job(*task)), tasks))
+    
+    failed = self.browse()
+    for job, brivo_res in zip(jobs, results):
+      job.partner_id._apply_brivo_result(brivo_res)
+      
+      if brivo_res.get('status', None) == 'FAILURE':
+        job._schedule_retry(brivo_res.get('error') or 'Brivo call failed.')
+        failed |= job
+      else:
+        job.write({ 'state': 'done', 'done_date': fields.Datetime.now(), 'last_error': False })
+    
+    return failed
+  
+  def _get_active_memberships(self):
+    '''
+      Return the (partner ID, Brivo group ID) pairs of the active subscriptions among the
+      group membership syncs of these jobs, for the groups of the partners' Brivo accounts.
+    '''
+    partner_ids = self.filtered(lambda j: j.job_type == 'sync_group').partner_id.ids
+    if not partner_ids:
+      return set()
+    
+    self.env.flush_all()
+    self.env.cr.execute('''
+      SELECT DISTINCT so.partner_id, g.brivo_group_id
+        FROM sale_order so
+        JOIN res_partner p ON p.id = so.partner_id
+        JOIN sale_order_template t ON t.id = so.sale_order_template_id
+        JOIN brivo_groups g ON g.id = t.brivo_group_id
+       WHERE so.subscription_state = '3_progress'
+         AND so.partner_id = ANY(%s)
+         AND COALESCE(g.account_id, 0) = COALESCE(p.brivo_account_id, 0)
+    ''', [partner_ids])
+    return set(self.env.cr.fetchall())
+  
+  def _get_membership_delta(self, active_memberships):
+    '''
+      Turn a group membership sync into the change to send: `add_group` or `remove_group`,
+      or None when the cached Brivo groups of the partner already match its active subscriptions.
+      The cache is only trusted while it is fresh; otherwise the change is sent anyway, both
+      calls being idempotent.
+    '''
+    self.ensure_one()
+    partner = self.partner_id
+    brivo_group_id = self.payload['brivo_group_id']
+    desired = (partner.id, brivo_group_id) in active_memberships
+    
+    if not desired and not partner.brivo_id:
+      return None
+    
+    fresh = partner.brivo_state_date and partner.brivo_state_date >= fields.Datetime.now() - timedelta(seconds=const.BRIVO_STATE_TTL)
+    if fresh and desired == (brivo_group_id in partner.brivo_group_ids.mapped('brivo_group_id')):
+      return None
+    return 'add_group' if desired else 'remove_group'
+  
+  def _schedule_retry(self, error):
+    self.ensure_one()
+    attempts = self.attempts + 1
+    
+    if attempts >= const.BRIVO_JOB_MAX_ATTEMPTS:
+      _logger.error(f'Brivo Job Queue: {self.job_type} for partner {self.partner_id.id} failed permanently: {error}')
+      self.write({ 'state': 'failed', 'attempts': attempts, 'last_error': error })
+      return
+    
+    delay = min(const.BRIVO_JOB_RETRY_BASE * 2 ** (attempts - 1), const.BRIVO_JOB_RETRY_MAX)
+    _logger.warning(f'Brivo Job Queue: {self.job_type} for partner {self.partner_id.id} failed, retrying in {delay}s: {error}')
+    self.write({
+      'attempts': attempts,
+      'next_attempt': fields.Datetime.now() + timedelta(seconds=delay),
+      'last_error': error
+    })
+  
+  def action_retry(self):
+    '''
+      Re-queue failed jobs for an immediate run.
+    '''
+    self.filtered(lambda j: j.state == 'failed').write({
+      'state': 'pending',
+      'attempts': 0,
+      'next_attempt': fields.Datetime.now()
+    })
+    self.env.ref('cc_brivo.ir_cron_process_brivo_jobs').sudo()._trigger()
+  
+  @api.autovacuum
+  def _gc_finished_jobs(self):
+    '''
+      Remove finished jobs once they are older than the retention period.
+    '''
+    limit_date = fields.Datetime.now() - timedelta(days=const.BRIVO_JOB_RETENTION_DAYS)
+    self.search([
+      ('state', '=', 'done'),
+      ('write_date', '<', limit_date)
+    ]).unlink()
+
+
+def _interleave(id_lists):
+  '''
+    Merge lists of IDs round-robin, e.g. [[1, 2, 3], [4]] gives [1, 4, 2, 3].
+  '''
+  return [i for ids in itertools.zip_longest(*id_lists) for i in ids if i is not None]
+
+def _perform_job(conn, job_type, payload, partner):
+  '''
+    Perform the Brivo calls of a job. Safe to call from worker threads.
+    Input:
+      - conn. A `BrivoConnection`.
+      - job_type. One of `JOB_TYPES`, or None when there is nothing to send.
+      - payload. The job arguments.
+      - partner. A `BrivoPartner` snapshot.
+    Output:
+      A Brivo result, possibly holding partner values to store.
+  '''
+  try:
+    if job_type is None:
+      return { 'status': 'SUCCESS' }
+    
+    if job_type == 'create_user' or (job_type == 'update_user' and not partner.brivo_id):
+      if partner.brivo_id:
+        # A retried creation whose credential step failed resumes from the stored IDs
+        if not partner.barcode:
+          return { 'status': 'SUCCESS' }
+        if not partner.brivo_barcode_credential_id:
+          return brivo_issue_barcode_credential(conn, partner.brivo_id, partner.barcode)
+        brivo_res = brivo_assign_credential(conn, partner.brivo_id, partner.brivo_barcode_credential_id)
+        return brivo_res if brivo_res.get('status', None) == 'FAILURE' else { 'status': 'SUCCESS' }
+      brivo_res = brivo_provision_user(conn, partner)
+      if brivo_res.get('brivo_id'):
+        brivo_res['brivo_sync_hash'] = brivo_user_fingerprint(partner)
+      return brivo_res
+    
+    if job_type == 'revoke_credential':
+      brivo_res = brivo_delete_barcode_credential(conn, payload['brivo_credential_id'])
+      # A credential already gone is revoked
+      return { 'status': 'SUCCESS' } if brivo_res.get('status_code') == 404 else brivo_res
+    
+    if job_type == 'delete_user':
+      # A credential or user already gone is deleted
+      if partner.brivo_barcode_credential_id:
+        brivo_res = brivo_delete_barcode_credential(conn, partner.brivo_barcode_credential_id)
+        if brivo_res.get('status', None) == 'FAILURE' and brivo_res.get('status_code') != 404:
+          return brivo_res
+      if partner.brivo_id:
+        brivo_res = brivo_delete_user(conn, partner.brivo_id)
+        if brivo_res.get('status', None) == 'FAILURE' and brivo_res.get('status_code') != 404:
+          return brivo_res
+      # The partner stays provisional, so that only a new quotation or membership provisions it again,
+      # and the cached state of the deleted user is cleared
+      return { 'status': 'SUCCESS', 'brivo_id': 0, 'brivo_barcode_credential_id': 0, 'brivo_sync_hash': False,
+               'brivo_suspended': False, 'brivo_state_date': False, 'clear_brivo_groups': True }
+    
+    if not partner.brivo_id:
+      # Credentials are created along with the user; the other operations need a user.
+      if job_type == 'rotate_credential':
+        return { 'status': 'SUCCESS' }
+      return { 'status': 'FAILURE', 'error': 'The partner has no Brivo user.' }
+    
+    if job_type == 'update_user':
+      brivo_res = brivo_update_user(conn, partner)
+      if brivo_res.get('status', None) != 'FAILURE':
+        brivo_res = { 'status': 'SUCCESS', 'brivo_sync_hash': brivo_user_fingerprint(partner) }
+      return brivo_res
+    if job_type == 'rotate_credential':
+      return brivo_rotate_barcode_credential(conn, partner)
+    # Successful calls are written through to the cached Brivo state of the partner
+    if job_type == 'suspend':
+      brivo_res = brivo_toggle_suspended_status(conn, partner.brivo_id, payload['suspend'])
+      return brivo_res if brivo_res.get('status', None) == 'FAILURE' else { 'status': 'SUCCESS', 'brivo_suspended': payload['suspend'] }
+    if job_type == 'add_group':
+      brivo_res = brivo_add_to_group(conn, payload['brivo_group_id'], partner.brivo_id)
+      return brivo_res if brivo_res.get('status', None) == 'FAILURE' else { 'status': 'SUCCESS', 'add_brivo_group_id': payload['brivo_group_id'] }
+    brivo_res = brivo_remove_from_group(conn, payload['brivo_group_id'], partner.brivo_id)
+    return brivo_res if brivo_res.get('status', None) == 'FAILURE' else { 'status': 'SUCCESS', 'remove_brivo_group_id': payload['brivo_group_id'] }
+  except Exception as err:
+    _logger.exception(f'Brivo Job Queue: {job_type} for partner {partner.id} raised an error')
+    return { 'status': 'FAILURE', 'error': str(err) or repr(err) }
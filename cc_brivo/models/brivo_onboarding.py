@@ -0,0 +1,342 @@
+import logging
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from odoo import models, fields, api
+from odoo.exceptions import UserError
+from ..utils import const
+from ..utils.brivo import (brivo_connection, partner_snapshot, brivo_iter_users, brivo_iter_credentials, brivo_create_user,
+                           brivo_create_barcode_credential, brivo_assign_credential, brivo_add_to_group, brivo_user_fingerprint,
+                           BrivoListError)
+from ..utils.metrics import attributed
+
+_logger = logging.getLogger(__name__)
+
+class BrivoOnboarding(models.Model):
+  _name = 'brivo.onboarding'
+  _description = 'Background provisioning of existing partners into Brivo, when the integration is turned on.'
+  _order = 'id desc'
+  
+  '''
+    An onboarding first links the partners to the Brivo users and credentials that already
+    exist for them (matched by `externalId` and `referenceId`), then creates what is missing
+    and adds the members to the groups of their active subscriptions, chunk by chunk.
+    Every Brivo ID obtained is checkpointed on the line, so a stopped or failed onboarding
+    resumes without creating anything twice.
+  '''
+  scope = fields.Selection([
+    ('members', 'Members with an Active Membership'),
+    ('all', 'All Individuals')
+  ], default='members', required=True, readonly=True)
+  state = fields.Selection([
+    ('matching', 'Matching'),
+    ('provisioning', 'Provisioning'),
+    ('stopped', 'Stopped'),
+    ('done', 'Done'),
+    ('failed', 'Failed')
+  ], default='matching', required=True, index=True, readonly=True)
+  matched_count = fields.Integer(string='Matched Brivo Users', readonly=True)
+  matched_date = fields.Datetime(string='Matched On', readonly=True)
+  error = fields.Char(readonly=True)
+  line_ids = fields.One2many('brivo.onboarding.line', 'onboarding_id', readonly=True)
+  
+  total_count = fields.Integer(compute='_compute_progress')
+  done_count = fields.Integer(compute='_compute_progress')
+  failed_count = fields.Integer(compute='_compute_progress')
+  progress = fields.Float(compute='_compute_progress')
+  failure_summary = fields.Text(compute='_compute_failure_summary')
+  
+  def _compute_progress(self):
+    counts = { (r.id, state): count for r, state, count in self.env['brivo.onboarding.line']._read_group(
+      [('onboarding_id', 'in', self.ids)], ['onboarding_id', 'state'], ['__count']) }
+    
+    for rec in self:
+      done = counts.get((rec.id, 'done'), 0)
+      failed = counts.get((rec.id, 'failed'), 0)
+      total = done + failed + counts.get((rec.id, 'pending'), 0)
+      rec.total_count = total
+      rec.done_count = done
+      rec.failed_count = failed
+      rec.progress = 100.0 * (done + failed) / total if total else 100.0
+  
+  def _compute_failure_summary(self):
+    for rec in self:
+      errors = self.env['brivo.onboarding.line']._read_group(
+        [('onboarding_id', '=', rec.id), ('state', '=', 'failed')], ['error'], ['__count'])
+      rec.failure_summary = '\n'.join(f'{count} x {error}' for error, count in errors) or False
+  
+  @api.model
+  def _get_partners_to_onboard(self, scope):
+    '''
+      Return the partners of `scope` without a Brivo user, leaving out the ones whose
+      creation is already queued.
+    '''
+    self.env.flush_all()
+    cr = self.env.cr
+    if scope == 'members':
+      cr.execute('''
+        SELECT DISTINCT p.id
+          FROM res_partner p
+          JOIN sale_order so ON so.partner_id = p.id
+         WHERE so.subscription_state = '3_progress'
+           AND p.active
+           AND COALESCE(p.brivo_id, 0) = 0
+      ''')
+    else:
+      cr.execute('''
+        SELECT p.id
+          FROM res_partner p
+         WHERE NOT p.is_company
+           AND p.active
+           AND COALESCE(p.brivo_id, 0) = 0
+      ''')
+    partner_ids = { row[0] for row in cr.fetchall() }
+    
+    cr.execute('''
+      SELECT partner_id
+        FROM brivo_job
+       WHERE state = 'pending'
+         AND job_type = 'create_user'
+    ''')
+    partner_ids -= { row[0] for row in cr.fetchall() }
+    
+    return self.env['res.partner'].browse(sorted(partner_ids))
+  
+  @api.model
+  def start(self, scope='members'):
+    '''
+      Create an onboarding of the partners of `scope` without a Brivo user, and schedule it.
+    '''
+    if self.search_count([('state', 'in', ('matching', 'provisioning'))]):
+      raise UserError('A Brivo onboarding is already running.')
+    
+    partners = self._get_partners_to_onboard(scope)
+    if not partners:
+      raise UserError('Every partner already has a Brivo user.')
+    
+    rec = self.create({ 'scope': scope })
+    self.env['brivo.onboarding.line'].create([
+      { 'onboarding_id': rec.id, 'partner_id': p.id } for p in partners
+    ])
+    _logger.info(f'Brivo Onboarding: Scheduled the onboarding of {len(partners)} partners')
+    self._trigger_cron()
+    return rec
+  
+  def action_stop(self):
+    '''
+      Stop running onboardings after the current chunk. The lines already processed are kept.
+    '''
+    self.filtered(lambda r: r.state in ('matching', 'provisioning')).write({ 'state': 'stopped' })
+  
+  def action_resume(self):
+    '''
+      Resume stopped or failed onboardings: the failed members are retried from their last
+      checkpoint, the finished ones are kept.
+    '''
+    to_resume = self.filtered(lambda r: r.state in ('stopped', 'failed'))
+    to_resume.line_ids.filtered(lambda l: l.state == 'failed').write({ 'state': 'pending', 'error': False })
+    for rec in to_resume:
+      rec.state = 'provisioning' if rec.matched_date else 'matching'
+    self._trigger_cron()
+  
+  @api.model
+  def _trigger_cron(self):
+    self.env.ref('cc_brivo.ir_cron_process_brivo_onboardings').sudo()._trigger()
+  
+  @api.model
+  def cron_process_brivo_onboardings(self):
+    '''
+      Match the partners of new onboardings with existing Brivo users, then provision the
+      members chunk by chunk. Each chunk is committed, so an onboarding interrupted by a
+      restart continues where it stopped.
+    '''
+    deadline = time.time() + const.BRIVO_JOB_CRON_TIME_BUDGET
+    
+    for rec in self.search([('state', '=', 'matching')]):
+      rec._match()
+      self.env.cr.commit()
+    
+    while time.time() < deadline:
+      lines = self.env['brivo.onboarding.line']._claim_lines(const.BRIVO_ONBOARDING_CHUNK_SIZE)
+      if not lines:
+        break
+      
+      lines._run()
+      self.env.cr.commit()
+    
+    self.search([('state', '=', 'provisioning')])._finalize()
+  
+  def _match(self):
+    '''
+      Link the pending lines to the Brivo users whose `externalId` is their partner, and to
+      the credentials whose `referenceId` is their barcode, so that none is created twice.
+      Each partner is matched in its own Brivo account.
+    '''
+    self.ensure_one()
+    pending = self.line_ids.filtered(lambda l: l.state == 'pending')
+    user_by_partner_id = {}
+    credential_by_barcode = {}
+    
+    try:
+      for account_id in set(pending.partner_id.mapped(lambda p: p.brivo_account_id.id)):
+        conn = brivo_connection(self.env, account_id)
+        user_by_partner_id.update({
+          (account_id, int(user['externalId'])): user['id']
+          for user in brivo_iter_users(conn, prefetch=True)
+          if str(user.get('externalId') or '').isdigit()
+        })
+        credential_by_barcode.update({
+          (account_id, cred['referenceId']): cred['id']
+          for cred in brivo_iter_credentials(conn, prefetch=True)
+          if cred.get('referenceId')
+        })
+    except BrivoListError as err:
+      # Matching is retried by the next cron run
+      _logger.warning(f'Brivo Onboarding: Matching failed, retrying later: {err}')
+      self.error = str(err)
+      return
+    
+    matched = 0
+    for line in pending:
+      account_id = line.partner_id.brivo_account_id.id
+      vals = {}
+      if (account_id, line.partner_id.id) in user_by_partner_id:
+        vals['brivo_user_id'] = user_by_partner_id[(account_id, line.partner_id.id)]
+        matched += 1
+      if (account_id, line.partner_id.barcode) in credential_by_barcode:
+        vals['brivo_credential_id'] = credential_by_barcode[(account_id, line.partner_id.barcode)]
+      if vals:
+        line.write(vals)
+    
+    _logger.info(f'Brivo Onboarding: Matched {matched} partners with existing Brivo users')
+    self.write({ 'state': 'provisioning', 'matched_count': matched, 'matched_date': fields.Datetime.now(), 'error': False })
+  
+  def _finalize(self):
+    for rec in self:
+      if rec.done_count + rec.failed_count < rec.total_count:
+        continue
+      
+      rec.state = 'failed' if rec.failed_count else 'done'
+      _logger.info(f'Brivo Onboarding: Finished, {rec.done_count} partners provisioned, {rec.failed_count} failed')
+
+class BrivoOnboardingLine(models.Model):
+  _name = 'brivo.onboarding.line'
+  _description = 'Status of one partner in a Brivo onboarding.'
+  _order = 'id'
+  
+  onboarding_id = fields.Many2one('brivo.onboarding', required=True, index=True, ondelete='cascade')
+  partner_id = fields.Many2one('res.partner', string='Partner', required=True, ondelete='cascade')
+  state = fields.Selection([
+    ('pending', 'Pending'),
+    ('done', 'Done'),
+    ('failed', 'Failed')
+  ], default='pending', required=True, index=True)
+  brivo_user_id = fields.Integer(string='Brivo User ID', help='Checkpoint of the Brivo user found or created.')
+  brivo_credential_id = fields.Integer(string='Brivo Credential ID', help='Checkpoint of the Brivo credential found or created.')
+  error = fields.Char()
+  
+  @api.model
+  def _claim_lines(self, limit):
+    self.env.cr.execute('''
+      SELECT l.id
+        FROM brivo_onboarding_line l
+        JOIN brivo_onboarding o ON o.id = l.onboarding_id
+       WHERE o.state = 'provisioning'
+         AND l.state = 'pending'
+       ORDER BY l.id
+       LIMIT %s
+         FOR UPDATE OF l SKIP LOCKED
+    ''', [limit])
+    return self.browse([row[0] for row in self.env.cr.fetchall()])
+  
+  def _run(self):
+    '''
+      Provision each partner and add it to the groups of its active subscriptions that
+      belong to its Brivo account, with bounded concurrency. The Brivo calls run in worker
+      threads on snapshots.
+    '''
+    self.env.cr.execute('''
+      SELECT DISTINCT so.partner_id, g.brivo_group_id
+        FROM sale_order so
+        JOIN res_partner p ON p.id = so.partner_id
+        JOIN sale_order_template t ON t.id = so.sale_order_template_id
+        JOIN brivo_groups g ON g.id = t.brivo_group_id
+       WHERE so.subscription_state = '3_progress'
+         AND so.partner_id IN %s
+         AND COALESCE(g.account_id, 0) = COALESCE(p.brivo_account_id, 0)
+    ''', [tuple(self.partner_id.ids)])
+    group_ids = defaultdict(list)
+    for partner_id, brivo_group_id in self.env.cr.fetchall():
+      group_ids[partner_id].append(brivo_group_id)
+    
+    conns = { account_id: brivo_connection(self.env, account_id)
+              for account_id in set(self.partner_id.mapped(lambda p: p.brivo_account_id.id)) }
+    tasks = [
+      (conns[line.partner_id.brivo_account_id.id],
+       partner_snapshot(line.partner_id)._replace(brivo_id=line.brivo_user_id or line.partner_id.brivo_id,
+                                                  brivo_barcode_credential_id=line.brivo_credential_id),
+       group_ids[line.partner_id.id])
+      for line in self
+    ]
+    
+    with ThreadPoolExecutor(max_workers=min(const.BRIVO_JOB_CONCURRENCY * len(conns), const.BRIVO_ASYNC_CONCURRENCY)) as executor:
+      results = list(executor.map(attributed(lambda task: _onboard_member(*task)), tasks))
+    
+    for line, brivo_res in zip(self, results):
+      failed = brivo_res.get('status', None) == 'FAILURE'
+      line.write({
+        'state': 'failed' if failed else 'done',
+        'error': brivo_res.get('error') if failed else False,
+        'brivo_user_id': brivo_res.get('brivo_id') or line.brivo_user_id,
+        'brivo_credential_id': brivo_res.get('brivo_barcode_credential_id') or line.brivo_credential_id
+      })
+      line.partner_id._apply_brivo_result(brivo_res)
+      for brivo_group_id in brivo_res.get('brivo_group_ids', []):
+        line.partner_id._apply_brivo_result({ 'add_brivo_group_id': brivo_group_id })
+
+def _onboard_member(conn, partner, brivo_group_ids):
+  '''
+    Create what a partner is missing on Brivo: its user, its barcode credential and its
+    group memberships. Safe to call from worker threads.
+    Input:
+      - conn. A `BrivoConnection`.
+      - partner. A `BrivoPartner` snapshot, holding the Brivo IDs already known.
+      - brivo_group_ids. The Brivo groups of its active subscriptions.
+    Output:
+      A Brivo result holding the partner values to store, even on failure, and the
+      `brivo_group_ids` the partner was added to.
+  '''
+  vals = {}
+  try:
+    brivo_id = partner.brivo_id
+    if not brivo_id:
+      user_res = brivo_create_user(conn, partner)
+      if user_res.get('status', None) == 'FAILURE':
+        return { 'status': 'FAILURE', 'error': f'Cannot create user on Brivo! {user_res.get("error", "")}' }
+      brivo_id = user_res['id']
+    vals.update(brivo_id=brivo_id, brivo_sync_hash=brivo_user_fingerprint(partner))
+    
+    if partner.barcode:
+      credential_id = partner.brivo_barcode_credential_id
+      if not credential_id:
+        cred_res = brivo_create_barcode_credential(conn, partner.barcode)
+        if cred_res.get('status', None) == 'FAILURE':
+          return dict(vals, status='FAILURE', error=f'Cannot create user credential on Brivo! {cred_res.get("error", "")}')
+        credential_id = cred_res['id']
+      vals['brivo_barcode_credential_id'] = credential_id
+      
+      assign_res = brivo_assign_credential(conn, brivo_id, credential_id)
+      if assign_res.get('status', None) == 'FAILURE':
+        return dict(vals, status='FAILURE', error=f'Cannot assign credential to user on Brivo! {assign_res.get("error", "")}')
+    
+    vals['brivo_group_ids'] = []
+    for brivo_group_id in brivo_group_ids:
+      group_res = brivo_add_to_group(conn, brivo_group_id, brivo_id)
+      if group_res.get('status', None) == 'FAILURE':
+        return dict(vals, status='FAILURE', error=f'Cannot add user to group {brivo_group_id} on Brivo! {group_res.get("error", "")}')
+      vals['brivo_group_ids'].append(brivo_group_id)
+    
+    return dict(vals, status='SUCCESS')
+  except Exception as err:
+    _logger.exception(f'Brivo Onboarding: Provisioning partner {partner.id} raised an error')
+    return dict(vals, status='FAILURE', error=str(err) or repr(err))
@@ -0,0 +1,16 @@
+from odoo import models, fields
+
+class BrivoRateBucket(models.Model):
+  _name = 'brivo.rate.bucket'
+  _description = 'Token buckets limiting the rate of Brivo calls across Odoo workers.'
+  
+  '''
+    Rows are read and written with raw SQL by `utils/rate_limit.py`.
+  '''
+  bucket_key = fields.Char(required=True, index=True, readonly=True)
+  tokens = fields.Float(readonly=True)
+  updated_at = fields.Datetime(readonly=True)
+  
+  _sql_constraints = [
+    ('bucket_key_uniq', 'unique(bucket_key)', 'There can only be one Brivo rate bucket per key.')
+  ]
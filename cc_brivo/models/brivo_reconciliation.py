@@ -0,0 +1,228 @@
+import logging
+from odoo import models, fields, api
+from odoo.exceptions import UserError
+from ..utils.brivo import brivo_connection, brivo_iter_users, brivo_iter_credentials, brivo_iter_group_users, BrivoListError
+
+_logger = logging.getLogger(__name__)
+
+ACTIONS = [
+  ('link', 'Link Brivo User'),
+  ('create_user', 'Recreate User'),
+  ('rotate_credential', 'Reissue Credential'),
+  ('suspend', 'Suspend User'),
+  ('add_group', 'Add to Group'),
+  ('remove_group', 'Remove from Group'),
+  ('orphan', 'Orphan Brivo User')
+]
+
+class BrivoReconciliation(models.Model):
+  _name = 'brivo.reconciliation'
+  _description = 'Comparison of Odoo partners and subscriptions with Brivo users, credentials and groups.'
+  _order = 'id desc'
+  
+  state = fields.Selection([
+    ('planned', 'Planned'),
+    ('applied', 'Applied')
+  ], default='planned', required=True, readonly=True)
+  account_id = fields.Many2one('brivo.account', string='Brivo Account', readonly=True, ondelete='cascade',
+                               help='Empty for the account of the system settings.')
+  user_count = fields.Integer(string='Brivo Users', readonly=True)
+  credential_count = fields.Integer(string='Brivo Credentials', readonly=True)
+  membership_count = fields.Integer(string='Brivo Group Memberships', readonly=True)
+  line_ids = fields.One2many('brivo.reconciliation.line', 'reconciliation_id', readonly=True)
+  line_count = fields.Integer(compute='_compute_line_count')
+  
+  def _compute_line_count(self):
+    counts = dict(self.env['brivo.reconciliation.line']._read_group(
+      [('reconciliation_id', 'in', self.ids)], ['reconciliation_id'], ['__count']))
+    for rec in self:
+      rec.line_count = counts.get(rec, 0)
+  
+  @api.model
+  def cron_reconcile_brivo(self, apply=False):
+    '''
+      Build a reconciliation plan for every Brivo account, and apply it when `apply` is set.
+    '''
+    for account_id in self.env['brivo.account']._get_account_ids():
+      rec = self.plan(account_id)
+      if apply:
+        rec.action_apply()
+  
+  @api.model
+  def plan(self, account_id=False):
+    '''
+      Stream the Brivo users, credentials and group memberships, index them in memory and
+      diff them against the partners and active subscriptions, read with a few set-based queries.
+      
+      Only credential existence and barcodes are compared, since Brivo lists credentials
+      without their user. Brivo users without an `externalId` (staff, manual entries) are ignored.
+      Input:
+        account_id. The Brivo account to compare with its partners and groups.
+      Output:
+        A brivo.reconciliation record holding the minimal patch plan.
+    '''
+    conn = brivo_connection(self.env, account_id)
+    cr = self.env.cr
+    
+    # Odoo side
+    self.env.flush_all()
+    cr.execute('''
+      SELECT id, brivo_id, brivo_barcode_credential_id, barcode, active
+        FROM res_partner
+       WHERE COALESCE(brivo_id, 0) != 0
+         AND COALESCE(brivo_account_id, 0) = %s
+    ''', [account_id or 0])
+    partners = { row[0]: row for row in cr.fetchall() }
+    partner_by_brivo_id = { row[1]: row[0] for row in partners.values() }
+    
+    cr.execute('''
+      SELECT DISTINCT so.partner_id, g.brivo_group_id
+        FROM sale_order so
+        JOIN sale_order_template t ON t.id = so.sale_order_template_id
+        JOIN brivo_groups g ON g.id = t.brivo_group_id
+       WHERE so.subscription_state = '3_progress'
+         AND COALESCE(g.account_id, 0) = %s
+    ''', [account_id or 0])
+    desired = set(cr.fetchall())
+    members = { partner_id for partner_id, _ in desired }
+    
+    cr.execute('''
+      SELECT DISTINCT g.brivo_group_id
+        FROM sale_order_template t
+        JOIN brivo_groups g ON g.id = t.brivo_group_id
+       WHERE COALESCE(g.account_id, 0) = %s
+    ''', [account_id or 0])
+    managed_group_ids = [row[0] for row in cr.fetchall()]
+    
+    # Brivo side
+    lines = []
+    user_count = credential_count = membership_count = 0
+    suspended = set()
+    seen_brivo_ids = set()
+    
+    unlinked = {}
+    for user in _list_all(brivo_iter_users(conn, prefetch=True)):
+      user_count += 1
+      external_id = str(user.get('externalId') or '')
+      if not external_id.isdigit():
+        continue
+      
+      seen_brivo_ids.add(user['id'])
+      if user.get('suspended'):
+        suspended.add(user['id'])
+      if user['id'] not in partner_by_brivo_id:
+        unlinked[user['id']] = int(external_id)
+    
+    # Brivo users pointing to a partner without a Brivo user are linked, the others are orphans
+    cr.execute('''
+      SELECT id
+        FROM res_partner
+       WHERE id = ANY(%s)
+         AND COALESCE(brivo_id, 0) = 0
+         AND COALESCE(brivo_account_id, 0) = %s
+    ''', [list(set(unlinked.values())), account_id or 0])
+    linkable = { row[0] for row in cr.fetchall() }
+    for brivo_id, partner_id in unlinked.items():
+      if partner_id in linkable:
+        lines.append({ 'action': 'link', 'partner_id': partner_id, 'brivo_user_id': brivo_id })
+        partner_by_brivo_id[brivo_id] = partner_id
+        linkable.discard(partner_id)
+      else:
+        lines.append({ 'action': 'orphan', 'brivo_user_id': brivo_id,
+                       'detail': f'externalId {partner_id} does not match a partner linked to this user' })
+    
+    # Members without any Brivo user
+    linked = set(partner_by_brivo_id.values())
+    for partner_id in sorted(members - linked):
+      lines.append({ 'action': 'create_user', 'partner_id': partner_id, 'detail': 'The member has no Brivo user' })
+    
+    credentials = {}
+    for cred in _list_all(brivo_iter_credentials(conn, prefetch=True)):
+      credential_count += 1
+      credentials[cred['id']] = cred.get('referenceId')
+    
+    for partner_id, brivo_id, cred_id, barcode, active in partners.values():
+      if brivo_id not in seen_brivo_ids:
+        if partner_id in members:
+          lines.append({ 'action': 'create_user', 'partner_id': partner_id, 'brivo_user_id': brivo_id,
+                         'detail': 'The Brivo user no longer exists' })
+        continue
+      if not active and brivo_id not in suspended:
+        lines.append({ 'action': 'suspend', 'partner_id': partner_id, 'brivo_user_id': brivo_id })
+      if barcode and (not cred_id or credentials.get(cred_id) != barcode):
+        lines.append({ 'action': 'rotate_credential', 'partner_id': partner_id, 'brivo_user_id': brivo_id })
+    
+    actual = set()
+    for brivo_group_id in managed_group_ids:
+      for user in _list_all(brivo_iter_group_users(conn, brivo_group_id, prefetch=True)):
+        membership_count += 1
+        partner_id = partner_by_brivo_id.get(user['id'])
+        if partner_id:
+          actual.add((partner_id, brivo_group_id))
+    
+    for partner_id, brivo_group_id in sorted(desired - actual):
+      lines.append({ 'action': 'add_group', 'partner_id': partner_id, 'brivo_group_id': brivo_group_id })
+    for partner_id, brivo_group_id in sorted(actual - desired):
+      lines.append({ 'action': 'remove_group', 'partner_id': partner_id, 'brivo_group_id': brivo_group_id })
+    
+    rec = self.create({
+      'account_id': account_id,
+      'user_count': user_count,
+      'credential_count': credential_count,
+      'membership_count': membership_count
+    })
+    self.env['brivo.reconciliation.line'].create([dict(l, reconciliation_id=rec.id) for l in lines])
+    
+    _logger.info(f'Brivo Reconciliation: {user_count} users, {credential_count} credentials and '
+                 f'{membership_count} memberships compared, {len(lines)} differences found')
+    return rec
+  
+  def action_apply(self):
+    '''
+      Apply the plan: partner links are written directly, everything else is queued as
+      Brivo jobs in bulk. Orphan Brivo users are only reported.
+    '''
+    Partner = self.env['res.partner'].with_context(skip_brivo_call_on_write=True, active_test=False)
+    Job = self.env['brivo.job']
+    
+    for rec in self.filtered(lambda r: r.state == 'planned'):
+      lines = rec.line_ids
+      
+      for line in lines.filtered(lambda l: l.action == 'link'):
+        line.partner_id.with_context(skip_brivo_call_on_write=True).brivo_id = line.brivo_user_id
+      
+      recreate = Partner.browse(lines.filtered(lambda l: l.action == 'create_user').partner_id.ids)
+      recreate.write({ 'brivo_id': False, 'brivo_barcode_credential_id': False, 'brivo_sync_hash': False })
+      Job.enqueue(recreate, 'create_user')
+      Job.enqueue(lines.filtered(lambda l: l.action == 'rotate_credential').partner_id, 'rotate_credential')
+      Job.enqueue(lines.filtered(lambda l: l.action == 'suspend').partner_id, 'suspend', { 'suspend': True })
+      
+      for action in ('remove_group', 'add_group'):
+        group_lines = lines.filtered(lambda l: l.action == action)
+        for brivo_group_id in set(group_lines.mapped('brivo_group_id')):
+          partners = group_lines.filtered(lambda l: l.brivo_group_id == brivo_group_id).partner_id
+          Job.enqueue(partners, action, { 'brivo_group_id': brivo_group_id })
+      
+      rec.state = 'applied'
+
+class BrivoReconciliationLine(models.Model):
+  _name = 'brivo.reconciliation.line'
+  _description = 'One difference found by a Brivo reconciliation.'
+  _order = 'id'
+  
+  reconciliation_id = fields.Many2one('brivo.reconciliation', required=True, index=True, ondelete='cascade')
+  action = fields.Selection(ACTIONS, required=True)
+  partner_id = fields.Many2one('res.partner', ondelete='cascade')
+  brivo_user_id = fields.Integer()
+  brivo_group_id = fields.Integer()
+  detail = fields.Char()
+
+def _list_all(items):
+  '''
+    Yield the items of a `brivo_iter_list` generator, raising a UserError if a page cannot
+    be fetched, so that no plan is built from partial data.
+  '''
+  try:
+    yield from items
+  except BrivoListError as err:
+    raise UserError(f'Brivo reconciliation aborted, {err}')
@@ -1,35 +1,39 @@
 import logging
-from ..utils.brivo import brivo_auth, brivo_create_group
-from ..utils import const
+from ..utils.brivo import BrivoSettings, SETTINGS_FIELDS
 from ...ksc_club_cloud.utils.notifications import NotificationFeedback
-from odoo import models, fields, api
+from odoo import models, api, tools
 
 _logger = logging.getLogger(__name__)
 
 class ClubSystemSettings(models.Model):
-  _inherit = 'club.system.settings'
+  _inherit = ['club.system.settings', 'brivo.connection.mixin']
   
   '''
-    Brivo API Fields
+    The Brivo fields of the settings configure the default Brivo account, used by the
+    partners of the companies without a `brivo.account`.
   '''
-  brivo_app_client_id = fields.Char(string='Brivo App Client ID')
-  brivo_app_client_secret = fields.Char(string='Brivo App Client Secret')
-  brivo_access_username = fields.Char(string='Brivo Admin ID')
-  brivo_access_password = fields.Char(string='Brivo Access Pasword')
-  brivo_api_key = fields.Char(string='Brivo API Key')
-    
-  def action_test_brivo_connection(self):
+  
+  @api.model
+  @tools.ormcache()
+  def _get_brivo_settings(self):
+    '''
+      Return an immutable snapshot of the Brivo settings, cached per database so that
+      Brivo calls do not query the settings. The cache is cleared when the settings change.
+    '''
+    record = self.sudo().search([], limit=1)
+    return BrivoSettings(**{ f: record[f] for f in SETTINGS_FIELDS })
+  
+  def action_show_brivo_token_stats(self):
+    '''
+      Show the Brivo token cache counters, so that the auth call rate can be compared
+      with the number of API calls served from the cache.
+    '''
     self.ensure_one()
     
-    res = brivo_auth(self.env)
+    stats = self.env['brivo.auth.token'].sudo().get_token_stats()
+    message = ', '.join(f'{k}: {v}' for k, v in sorted(stats.items())) or 'No Brivo tokens requested yet.'
     
-    if res.get('status', None) == 'FAILURE':
-      return NotificationFeedback.notification_feedback(self.env,
-                                                        'Brivo Test Connection',
-                                                        'The Brivo test connection failed.',
-                                                        'danger')
-    else:
-      return NotificationFeedback.notification_feedback(self.env,
-                                                        'Brivo Test Connection',
-                                                        'The Brivo test connection was successful.',
-                                                        'success')
\ No newline at end of file
+    return NotificationFeedback.notification_feedback(self.env,
+                                                      'Brivo Token Cache',
+                                                      message,
+                                                      'info')
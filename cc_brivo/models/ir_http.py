@@ -0,0 +1,23 @@
+import logging
+from odoo import models
+from ..utils.metrics import reset_thread_stats
+
+_logger = logging.getLogger(__name__)
+
+class IrHttp(models.AbstractModel):
+  _inherit = 'ir.http'
+  
+  @classmethod
+  def _pre_dispatch(cls, rule, args):
+    reset_thread_stats()
+    super()._pre_dispatch(rule, args)
+  
+  @classmethod
+  def _post_dispatch(cls, response):
+    super()._post_dispatch(response)
+    
+    # Attribute the time spent calling Brivo to the request, e.g. in the browser network panel
+    count, seconds = reset_thread_stats()
+    if count:
+      response.headers.add('Server-Timing', f'brivo;dur={seconds * 1000:.1f};desc="{count} calls"')
+      _logger.debug(f'{count} Brivo API calls took {seconds * 1000:.0f}ms')
@@ -1,7 +1,22 @@
-from odoo import models, fields
+import logging
+from collections import defaultdict
+from datetime import timedelta
+from odoo import models, fields, api, Command
 from odoo.exceptions import ValidationError
+from odoo.tools.sql import index_exists
+from ...ksc_club_cloud.utils.notifications import NotificationFeedback
 
-from ..utils.brivo import brivo_create_user, brivo_toggle_suspended_status, brivo_update_user, brivo_create_barcode_credential, brivo_delete_barcode_credential, brivo_assign_credential
+from ..utils import const
+from ..utils.brivo import (brivo_connection, brivo_provision_user, brivo_rotate_barcode_credential, brivo_user_projection,
+                           brivo_user_fingerprint)
+from ..utils.brivo_async import run_brivo_account_batches
+from ..utils.partner_index import BRIVO_ID_INDEX, COLUMNS
+
+_logger = logging.getLogger(__name__)
+
+# Partner fields that Brivo operations may set
+BRIVO_RESULT_FIELDS = ['brivo_id', 'brivo_barcode_credential_id', 'brivo_sync_hash', 'brivo_suspended', 'brivo_provisional',
+                       'brivo_state_date']
 
 class ResPartner(models.Model):
   _inherit = 'res.partner'
@@ -11,44 +26,267 @@ class ResPartner(models.Model):
   '''
   brivo_id = fields.Integer()
   brivo_barcode_credential_id = fields.Integer()
+  brivo_sync_hash = fields.Char(copy=False, help='Fingerprint of the user fields last pushed to Brivo.')
+  brivo_account_id = fields.Many2one('brivo.account', string='Brivo Account', compute='_compute_brivo_account_id',
+                                     store=True, readonly=False, index=True, ondelete='restrict',
+                                     help='Brivo account of the partner, from its company until its Brivo user '
+                                          'is created. Empty for the account of the system settings.')
+  
+  '''
+    Cached Brivo state, updated by our own Brivo calls and refreshed once older than `BRIVO_STATE_TTL`
+  '''
+  brivo_suspended = fields.Boolean(string='Suspended on Brivo', copy=False, readonly=True)
+  brivo_group_ids = fields.Many2many('brivo.groups', 'res_partner_brivo_groups_rel', 'partner_id', 'group_id',
+                                     string='Brivo Groups', copy=False, readonly=True,
+                                     context={ 'active_test': False })
+  brivo_state_date = fields.Datetime(string='Brivo State Checked On', copy=False, readonly=True)
+  brivo_suspended_overdue = fields.Boolean(string='Suspended for Overdue Invoices', copy=False, readonly=True,
+                                           help='Set when the member was suspended on Brivo by the overdue members cron, '
+                                                'which unsuspends it once its invoices are paid.')
+  brivo_provisional = fields.Boolean(string='Provisional Brivo User', copy=False, readonly=True,
+                                     help='Set when the Brivo user is created ahead of a first membership, for a quotation. '
+                                          'It is deleted from Brivo if no membership is confirmed, and only created again '
+                                          'for a new quotation or membership.')
+  
+  @api.depends('company_id')
+  def _compute_brivo_account_id(self):
+    account_by_company = self.env['brivo.account']._get_account_by_company()
+    # A Brivo user lives in the account it was created in, whatever the company becomes
+    for partner in self.filtered(lambda p: not p.brivo_id):
+      partner.brivo_account_id = account_by_company.get(partner.company_id.id, False)
+  
+  def init(self):
+    '''
+      Index the Brivo IDs for reverse lookups, and guarantee that a Brivo user is linked to
+      one partner at most. Brivo IDs are only unique within their Brivo account. Unset IDs
+      (NULL or 0) are left out of the indexes.
+    '''
+    super().init()
+    cr = self.env.cr
+    cr.execute('''
+      CREATE INDEX IF NOT EXISTS res_partner_brivo_barcode_credential_id_index
+          ON res_partner (brivo_barcode_credential_id)
+       WHERE brivo_barcode_credential_id > 0
+    ''')
+    
+    if index_exists(cr, 'res_partner_brivo_id_uniq'):
+      return
+    cr.execute('''
+      SELECT brivo_id, array_agg(id)
+        FROM res_partner
+       WHERE brivo_id > 0
+       GROUP BY brivo_id, COALESCE(brivo_account_id, 0)
+      HAVING count(*) > 1
+    ''')
+    duplicates = cr.fetchall()
+    if duplicates:
+      # Creating the index would fail the upgrade; the duplicates must be unlinked first
+      _logger.error(f'Brivo users linked to several partners, the unique index on brivo_id is not created: {duplicates[:20]}')
+      cr.execute('CREATE INDEX IF NOT EXISTS res_partner_brivo_id_index ON res_partner (brivo_id) WHERE brivo_id > 0')
+      return
+    cr.execute('DROP INDEX IF EXISTS res_partner_brivo_id_index')
+    cr.execute('''
+      CREATE UNIQUE INDEX res_partner_brivo_id_uniq
+          ON res_partner (brivo_id, (COALESCE(brivo_account_id, 0)))
+       WHERE brivo_id > 0
+    ''')
+  
+  @api.model
+  def _resolve_brivo_ids(self, brivo_ids, kind='user', account_id=False):
+    '''
+      Map Brivo user IDs (or credential IDs, with `kind` 'credential') of a Brivo account to
+      partner IDs in bulk, through the in-process index. Archived partners are included.
+      Input:
+        account_id. The Brivo account the IDs belong to, False for the account of the
+        system settings.
+      Output:
+        A dict { Brivo ID: partner ID }, without the Brivo IDs of no partner.
+    '''
+    self.env['res.partner'].flush_model(['brivo_id', 'brivo_barcode_credential_id', 'brivo_account_id'])
+    return BRIVO_ID_INDEX.resolve(self.env.cr, kind, brivo_ids, account_id)
   
-  def create(self, vals):
+  @api.model_create_multi
+  def create(self, vals_list):
     '''
       Override account creation so that a brivo user is 
-      created along with this user.
+      created along with these users. The Brivo calls are queued
+      and run once the transaction is committed.
     '''
-    res = super().create(vals)
+    res = super().create(vals_list)
     
-    res._create_brivo_user()
+    self.env['brivo.job'].enqueue(res, 'create_user')
     
     return res
   
   def write(self, vals):
     '''
-      Override account editing so that the brivo user
-      is edited along with this user.
+      Override account editing so that the brivo users
+      are edited along with these users. Only the partners whose
+      Brivo fields changed are queued, in bulk, and the Brivo calls
+      run once the transaction is committed.
     '''
+    for kind, column in COLUMNS.items():
+      if column in vals or 'brivo_account_id' in vals:
+        BRIVO_ID_INDEX.evict(self.env.cr.dbname, kind, [(p.brivo_account_id.id, p[column]) for p in self])
+    
+    if self.env.context.get('skip_brivo_call_on_write', False):
+      return super().write(vals)
+    
+    before = { p.id: p._brivo_projection() for p in self }
     res = super().write(vals)
     
-    if not self.env.context.get('skip_brivo_call_on_write', False) and self.active:  
-      if self.brivo_id:
-        brivo_update_user(self.env, self)
-      else:
-        self._create_brivo_user()
-        
-    # If the user's barcode was updated, 
-    # update the Brivo user's credential
-    if vals.get('barcode') and self:
-      self._update_user_barcode_credential()
+    changed = self.filtered(lambda p: p._brivo_projection() != before[p.id])
+    # If the users' barcodes were updated, 
+    # update the Brivo users' credentials
+    barcode_changed = changed.filtered(lambda p: p.barcode != before[p.id]['barcode'])
+    changed._enqueue_brivo_sync(rotate=barcode_changed)
     
     return res
   
   def action_archive(self, *args, **kwargs):
     res = super().action_archive(*args, **kwargs)
-    if self.brivo_id:
-      brivo_toggle_suspended_status(self.env, self.brivo_id, True)
+    self.env['brivo.job'].enqueue(self.filtered('brivo_id'), 'suspend', { 'suspend': True })
     return res
   
+  def action_push_to_brivo(self):
+    '''
+      Queue the selected partners for creation or update on Brivo. The outcome for
+      each partner is reported on its Brivo jobs.
+    '''
+    to_create, to_update = self._enqueue_brivo_sync(force=True)
+    
+    return NotificationFeedback.notification_feedback(self.env,
+                                                      'Brivo Sync Queued',
+                                                      f'{len(to_create)} partners queued for creation and {len(to_update)} for update on Brivo.',
+                                                      'success')
+  
+  def action_brivo_suspend(self):
+    return self._notify_brivo_suspension(self._set_brivo_suspended(True), 'suspended')
+  
+  def action_brivo_unsuspend(self):
+    return self._notify_brivo_suspension(self._set_brivo_suspended(False), 'unsuspended')
+  
+  def _notify_brivo_suspension(self, outcomes, verb):
+    counts = defaultdict(int)
+    for outcome in outcomes.values():
+      counts[outcome['status']] += 1
+    failed = self.browse([pid for pid, outcome in outcomes.items() if outcome['status'] == 'FAILURE'])
+    
+    message = f'{counts["SUCCESS"]} members {verb}, {counts["SKIPPED"]} already {verb} or without a Brivo user.'
+    if failed:
+      message += f' Failed for: {", ".join(failed[:10].mapped("display_name"))}{"..." if len(failed) > 10 else ""}'
+    
+    return NotificationFeedback.notification_feedback(self.env,
+                                                      'Brivo Suspension',
+                                                      message,
+                                                      'warning' if failed else 'success')
+  
+  def _set_brivo_suspended(self, suspend):
+    '''
+      Suspend or unsuspend the Brivo users of these partners, all in flight at once through
+      the async client and within the shared rate limit. Partners without a Brivo user, or
+      whose cached status is fresh and already matches, are skipped.
+      Output:
+        A dict mapping each partner ID to its outcome, of the form { 'status': 'SUCCESS' },
+        { 'status': 'SKIPPED' } or { 'status': 'FAILURE', 'error': '...' }.
+    '''
+    # A status never read from Brivo, or stale, is not trusted
+    fresh_after = fields.Datetime.now() - timedelta(seconds=const.BRIVO_STATE_TTL)
+    to_change = self.filtered(lambda p: p.brivo_id and (p.brivo_suspended != suspend or
+                                                        not p.brivo_state_date or p.brivo_state_date < fresh_after))
+    outcomes = { pid: { 'status': 'SKIPPED' } for pid in (self - to_change).ids }
+    if not to_change:
+      return outcomes
+    
+    results = to_change._run_brivo_batch(lambda p: ('toggle_suspended_status', p.brivo_id, suspend))
+    
+    changed = self.browse()
+    for partner, res in zip(to_change, results):
+      if res.get('status', None) == 'FAILURE':
+        outcomes[partner.id] = { 'status': 'FAILURE', 'error': res.get('error') }
+      else:
+        outcomes[partner.id] = { 'status': 'SUCCESS' }
+        changed |= partner
+    
+    changed.with_context(skip_brivo_call_on_write=True).write({ 'brivo_suspended': suspend })
+    return outcomes
+  
+  @api.model
+  def cron_suspend_overdue_brivo_members(self, grace_days=const.BRIVO_OVERDUE_GRACE_DAYS):
+    '''
+      Suspend on Brivo the members of active memberships with an invoice overdue by more than
+      `grace_days`, and unsuspend the ones it suspended once nothing is overdue anymore.
+      Members suspended by hand are left alone.
+    '''
+    self.env.flush_all()
+    self.env.cr.execute('''
+      SELECT DISTINCT so.partner_id
+        FROM sale_order so
+        JOIN sale_order_line sol ON sol.order_id = so.id
+        JOIN sale_order_line_invoice_rel rel ON rel.order_line_id = sol.id
+        JOIN account_move_line aml ON aml.id = rel.invoice_line_id
+        JOIN account_move am ON am.id = aml.move_id
+       WHERE so.subscription_state = '3_progress'
+         AND am.move_type = 'out_invoice'
+         AND am.state = 'posted'
+         AND am.payment_state IN ('not_paid', 'partial')
+         AND am.invoice_date_due < %s
+    ''', [fields.Date.today() - timedelta(days=grace_days)])
+    overdue = self.browse([row[0] for row in self.env.cr.fetchall()]).filtered('brivo_id')
+    settled = self.search([('brivo_suspended_overdue', '=', True), ('id', 'not in', overdue.ids)])
+    
+    suspended = [pid for pid, outcome in overdue._set_brivo_suspended(True).items() if outcome['status'] == 'SUCCESS']
+    self.browse(suspended).with_context(skip_brivo_call_on_write=True).write({ 'brivo_suspended_overdue': True })
+    
+    unsuspended = [pid for pid, outcome in settled._set_brivo_suspended(False).items() if outcome['status'] != 'FAILURE']
+    self.browse(unsuspended).with_context(skip_brivo_call_on_write=True).write({ 'brivo_suspended_overdue': False })
+    
+    _logger.info(f'Brivo Overdue Members: {len(suspended)} suspended, {len(unsuspended)} unsuspended')
+  
+  @api.model
+  def cron_delete_abandoned_brivo_users(self, retention_days=const.BRIVO_PREPROVISION_RETENTION_DAYS):
+    '''
+      Delete from Brivo the users provisioned ahead of membership quotations that were never
+      confirmed, along with their credentials, once none of the partner's orders changed for
+      `retention_days`. The partners stay provisional: only a new quotation or membership
+      provisions them again.
+    '''
+    self.env.flush_all()
+    self.env.cr.execute('''
+      SELECT p.id
+        FROM res_partner p
+       WHERE p.brivo_provisional
+         AND p.brivo_id > 0
+         AND p.create_date < %(limit)s
+         AND NOT EXISTS (SELECT 1
+                           FROM sale_order so
+                          WHERE so.partner_id = p.id
+                            AND (so.state = 'sale' OR so.write_date >= %(limit)s))
+    ''', { 'limit': fields.Datetime.now() - timedelta(days=retention_days) })
+    abandoned = self.with_context(active_test=False).browse([row[0] for row in self.env.cr.fetchall()])
+    
+    self.env['brivo.job'].enqueue(abandoned, 'delete_user')
+    _logger.info(f'Brivo Abandoned Users: {len(abandoned)} provisional Brivo users queued for deletion')
+  
+  def action_reissue_brivo_credentials(self):
+    '''
+      Queue the rotation of the barcode credentials of the selected partners, e.g. for a
+      mass card reissue. Each member keeps a working credential throughout.
+    '''
+    partners = self.filtered('brivo_id')
+    self.env['brivo.job'].enqueue(partners, 'rotate_credential')
+    
+    return NotificationFeedback.notification_feedback(self.env,
+                                                      'Brivo Credential Reissue Queued',
+                                                      f'{len(partners)} partners queued for a new credential on Brivo.',
+                                                      'success')
+  
+  def action_refresh_brivo_state(self):
+    '''
+      Refresh the cached Brivo state of the selected partners.
+    '''
+    self._refresh_brivo_state()
+  
   def action_manage_suspended_status(self):
     self.ensure_one()
     
@@ -64,36 +302,160 @@ class ResPartner(models.Model):
       }
     }
   
-  def _create_brivo_user(self):
-    # create a user counterpart
-    brivo_res = brivo_create_user(self.env, self)  
+  def _enqueue_brivo_sync(self, rotate=None, force=False):
+    '''
+      Sort the partners into the ones to create, update and re-credential on Brivo,
+      and queue one bulk set of jobs for each.
+      Input:
+        - rotate. The partners whose barcode credential must be replaced.
+        - force. If true, update users even when their Brivo fields match the last push.
+      Output:
+        The partners to create and the partners to update.
+    '''
+    Job = self.env['brivo.job']
+    active = self.filtered('active')
+    # Provisional partners are only provisioned by their quotations and memberships
+    to_create = active.filtered(lambda p: not p.brivo_id and not p.brivo_provisional)
+    to_update = active.filtered('brivo_id')
     
-    if brivo_res.get('status', None) == 'FAILURE':
-      raise ValidationError('Cannot create user on Brivo!')
+    if not force:
+      to_update = to_update.filtered(lambda p: brivo_user_fingerprint(p) != p.brivo_sync_hash)
+    
+    Job.enqueue(to_create, 'create_user')
+    Job.enqueue(to_update, 'update_user')
+    
+    if rotate:
+      Job.enqueue(rotate.filtered('brivo_id'), 'rotate_credential')
+    
+    return to_create, to_update
+  
+  def _brivo_projection(self):
+    '''
+      Return the values of this partner that Brivo depends on.
+    '''
+    self.ensure_one()
+    return dict(brivo_user_projection(self), barcode=self.barcode, active=self.active)
+  
+  def _apply_brivo_result(self, brivo_res):
+    '''
+      Store the partner values returned by a Brivo operation, without calling Brivo back.
+      Group changes (`add_brivo_group_id`, `remove_brivo_group_id`) are written through
+      to the cached groups, which `clear_brivo_groups` empties.
+    '''
+    self.ensure_one()
+    vals = { f: brivo_res[f] for f in BRIVO_RESULT_FIELDS if f in brivo_res }
+    
+    commands = [Command.clear()] if brivo_res.get('clear_brivo_groups') else []
+    Groups = self.env['brivo.groups'].with_context(active_test=False)
+    account_domain = [('account_id', '=', self.brivo_account_id.id)]
+    if brivo_res.get('remove_brivo_group_id'):
+      commands += [Command.unlink(g.id) for g in Groups.search(account_domain + [('brivo_group_id', '=', brivo_res['remove_brivo_group_id'])])]
+    if brivo_res.get('add_brivo_group_id'):
+      commands += [Command.link(g.id) for g in Groups.search(account_domain + [('brivo_group_id', '=', brivo_res['add_brivo_group_id'])])]
+    if commands:
+      vals['brivo_group_ids'] = commands
+    
+    if vals:
+      self.with_context(skip_brivo_call_on_write=True).write(vals)
+    
+    # A credential replaced by a rotation but not deleted yet is deleted in the background
+    if brivo_res.get('stale_brivo_credential_id'):
+      self.env['brivo.job'].enqueue(self, 'revoke_credential', { 'brivo_credential_id': brivo_res['stale_brivo_credential_id'] })
+  
+  def _get_brivo_state(self, max_age=const.BRIVO_STATE_TTL):
+    '''
+      Return the cached Brivo state of this partner, refreshing it from Brivo first
+      when it is older than `max_age` seconds.
+      Output:
+        An object of the form { 'suspended': False, 'brivo_group_ids': brivo.groups records }
+    '''
+    self.ensure_one()
     
-    self.with_context(skip_brivo_call_on_write=True).brivo_id = brivo_res['id']
-    # create a barcode credential
-    self._create_user_credential()
+    if self.brivo_id and (not self.brivo_state_date or
+                          self.brivo_state_date < fields.Datetime.now() - timedelta(seconds=max_age)):
+      self._refresh_brivo_state()
     
-  def _create_user_credential(self):
+    return { 'suspended': self.brivo_suspended, 'brivo_group_ids': self.brivo_group_ids }
+  
+  def _refresh_brivo_state(self):
     '''
-      Create and assign a user credential
+      Read the suspended status and groups of the partners' Brivo users, all in flight at
+      once through the async client, and store them in the cache. Partners with the same
+      state are written together.
     '''
-    # create a barcode credential
-    barcode_res = brivo_create_barcode_credential(self.env, self.barcode)
+    partners = self.filtered('brivo_id')
+    if not partners:
+      return
+    
+    results = partners._run_brivo_batch(lambda p: ('fetch_user_state', p.brivo_id))
     
-    if barcode_res.get('status', None) == 'FAILURE':
-      raise ValidationError('Cannot create user credential on Brivo!')
+    group_ids = { gid for res in results for gid in res.get('brivo_group_ids', []) }
+    groups = self.env['brivo.groups'].with_context(active_test=False).search([('brivo_group_id', 'in', list(group_ids))])
+    group_by_brivo_id = { (g.account_id.id, g.brivo_group_id): g.id for g in groups }
     
-    self.with_context(skip_brivo_call_on_write=True).brivo_barcode_credential_id = barcode_res
-    # assign credential to user
-    assign_res = brivo_assign_credential(self.env, self.brivo_id, barcode_res['id'])
+    partners_by_state = defaultdict(lambda: self.browse())
+    for partner, res in zip(partners, results):
+      if res.get('status', None) == 'FAILURE':
+        continue
+      account_id = partner.brivo_account_id.id
+      group_ids = tuple(sorted(group_by_brivo_id[(account_id, gid)] for gid in res['brivo_group_ids'] if (account_id, gid) in group_by_brivo_id))
+      partners_by_state[(res['suspended'], group_ids)] |= partner
     
-    if assign_res.get('status', None) == 'FAILURE':
-      raise ValidationError('Cannot assign credential to user on Brivo!')
+    now = fields.Datetime.now()
+    for (suspended, group_ids), same_state in partners_by_state.items():
+      same_state.with_context(skip_brivo_call_on_write=True).write({
+        'brivo_suspended': suspended,
+        'brivo_group_ids': [Command.set(list(group_ids))],
+        'brivo_state_date': now
+      })
+  
+  def _brivo_connection(self):
+    '''
+      Return the `BrivoConnection` of the Brivo account of this partner.
+    '''
+    self.ensure_one()
+    return brivo_connection(self.env, self.brivo_account_id.id)
+  
+  def _run_brivo_batch(self, make_call):
+    '''
+      Run one Brivo call per partner through the async client, with the batch of each Brivo
+      account sent to its own account, all accounts at the same time.
+      Input:
+        make_call. A function of a partner returning its call (operation, *args), see
+        `run_brivo_batch`.
+      Output:
+        The results of the calls, in the order of the partners.
+    '''
+    by_account = self.grouped('brivo_account_id')
+    results = run_brivo_account_batches(self.env, {
+      account.id: [make_call(p) for p in partners] for account, partners in by_account.items()
+    })
     
+    res_by_partner_id = {}
+    for account, partners in by_account.items():
+      res_by_partner_id.update(zip(partners.ids, results[account.id]))
+    return [res_by_partner_id[p.id] for p in self]
+  
+  def _create_brivo_user(self):
+    '''
+      Create the Brivo user of this partner, with its barcode credential, right away.
+    '''
+    self.ensure_one()
+    brivo_res = brivo_provision_user(self._brivo_connection(), self)
+    if brivo_res.get('brivo_id'):
+      brivo_res['brivo_sync_hash'] = brivo_user_fingerprint(self)
+    self._apply_brivo_result(brivo_res)
+    
+    if brivo_res.get('status', None) == 'FAILURE':
+      raise ValidationError(brivo_res['error'])
+  
   def _update_user_barcode_credential(self):
-    # Delete the user's current credential
-    brivo_delete_barcode_credential(self.env, self.brivo_barcode_credential_id)
-    # Assign the user a new credential based on their barcode
-    self._create_user_credential()
\ No newline at end of file
+    '''
+      Replace the Brivo credential of this partner with one for its current barcode, right away.
+    '''
+    self.ensure_one()
+    brivo_res = brivo_rotate_barcode_credential(self._brivo_connection(), self)
+    self._apply_brivo_result(brivo_res)
+    
+    if brivo_res.get('status', None) == 'FAILURE':
+      raise ValidationError(brivo_res['error'])
@@ -1,39 +1,119 @@
 import logging
-from odoo import models, fields
-from ..utils.brivo import brivo_add_to_group, brivo_remove_from_group
+from collections import defaultdict
+from odoo import models, fields, api
+from ..utils import const
 
 _logger = logging.getLogger(__name__)
 class SaleOrder(models.Model):
   _inherit = 'sale.order'
   
   brivo_group_id = fields.Many2one('brivo.groups', related='sale_order_template_id.brivo_group_id')
+  brivo_sync_error = fields.Char(string='Brivo Sync Error', copy=False, readonly=True,
+                                 help='Set when the membership cannot be synced to Brivo, e.g. when the member\'s '
+                                      'Brivo user belongs to another Brivo account than the group of the membership.')
+  
+  @api.model_create_multi
+  def create(self, vals_list):
+    '''
+      Override create so that the partners of new membership quotations
+      are provisioned on Brivo ahead of the confirmation.
+    '''
+    res = super().create(vals_list)
+    res._enqueue_brivo_preprovision()
+    
+    return res
+  
+  def write(self, vals):
+    res = super().write(vals)
+    if 'partner_id' in vals or 'sale_order_template_id' in vals:
+      self._enqueue_brivo_preprovision()
+    
+    return res
   
   def action_confirm(self, *args, **kwargs):
     '''
-      Override action_confirm so that the partner's
-      Brivo user is added to the Brivo group corresponding
-      to this membership.
+      Override action_confirm so that the partners' Brivo users
+      join the Brivo groups corresponding to these memberships.
+      The Brivo users of first memberships were provisioned with the
+      quotation, so they only join their group, without the debounce.
     '''
     res = super().action_confirm(*args, **kwargs)
-    if self.brivo_group_id and self.partner_id.brivo_id:
-      try:
-        brivo_add_to_group(self.env, self.brivo_group_id.brivo_group_id, self.partner_id.brivo_id)
-      except Exception as err:
-        _logger.error(err)
-        
+    self._route_brivo_partners()
+    # Partners whose provisional Brivo user was deleted, or never created, are provisioned first
+    self.env['brivo.job'].enqueue(self.filtered('brivo_group_id').partner_id.filtered(lambda p: not p.brivo_id), 'create_user')
+    first = self.filtered(lambda o: o.partner_id.brivo_provisional)
+    (self - first)._enqueue_brivo_membership_sync()
+    first._enqueue_brivo_membership_sync(delay=0)
+    first.partner_id.with_context(skip_brivo_call_on_write=True).write({ 'brivo_provisional': False })
+    
     return res
   
   def set_close(self, *args, **kwargs):
     '''
-      Override set_close so that the partner's
-      Brivo user is removed from the Brivo group corresponding
-      with this membership.
+      Override set_close so that the partners' Brivo users leave
+      the Brivo groups corresponding to these memberships, unless
+      another active membership still grants them.
     '''
     res = super().set_close(*args, **kwargs)
-    if self.brivo_group_id and self.partner_id.brivo_id:
-      try:
-        brivo_remove_from_group(self.env, self.brivo_group_id.brivo_group_id, self.partner_id.brivo_id)
-      except Exception as err:
-        _logger.error(err)
+    self._enqueue_brivo_membership_sync()
         
-    return res
\ No newline at end of file
+    return res
+  
+  def _enqueue_brivo_preprovision(self):
+    '''
+      Queue the creation of the Brivo users and credentials of the partners of these
+      membership quotations, so that their confirmation only adds the members to their
+      group. The users are created in no group, and open no door until then.
+      
+      Partners without a Brivo user nor a confirmed order are flagged as provisional, and
+      their Brivo users are deleted if the quotations are abandoned, see
+      `cron_delete_abandoned_brivo_users`.
+    '''
+    orders = self.filtered(lambda o: o.state in ('draft', 'sent') and o.brivo_group_id)
+    orders._route_brivo_partners()
+    partners = orders.partner_id.filtered(lambda p: not p.brivo_id)
+    if not partners:
+      return
+    
+    confirmed = self.search([('partner_id', 'in', partners.ids), ('state', '=', 'sale')]).partner_id
+    (partners - confirmed).filtered(lambda p: not p.brivo_provisional).with_context(skip_brivo_call_on_write=True).write({ 'brivo_provisional': True })
+    self.env['brivo.job'].enqueue(partners, 'create_user')
+  
+  def _route_brivo_partners(self):
+    '''
+      Move the partners of these orders without a Brivo user to the Brivo account of the group
+      of their order, so that their user is created where the membership grants access. The
+      account of a partner otherwise follows its company, which shared members often lack.
+    '''
+    for order in self.filtered(lambda o: o.brivo_group_id and not o.partner_id.brivo_id):
+      if order.partner_id.brivo_account_id != order.brivo_group_id.account_id:
+        order.partner_id.with_context(skip_brivo_call_on_write=True).brivo_account_id = order.brivo_group_id.account_id
+  
+  def _enqueue_brivo_membership_sync(self, delay=None):
+    '''
+      Queue a membership sync for each partner and Brivo group of these orders, one bulk
+      set of jobs per group. The syncs are delayed by `delay`, `BRIVO_MEMBERSHIP_DEBOUNCE` by
+      default, so that the changes of a renewal or an upgrade (close then confirm) are
+      collapsed, and only the net change to the partner's active subscriptions is sent to Brivo.
+      Orders whose group belongs to another Brivo account than the partner's Brivo user are
+      not synced, and flagged with a `brivo_sync_error`.
+    '''
+    partners_by_group = defaultdict(lambda: self.env['res.partner'])
+    mismatched = self.browse()
+    for order in self.filtered('brivo_group_id'):
+      if order.brivo_group_id.account_id != order.partner_id.brivo_account_id:
+        _logger.warning(f'Brivo Membership Sync: The Brivo group of {order.name} belongs to another Brivo account '
+                        f'than its partner {order.partner_id.id}, it is not synced')
+        mismatched |= order
+        continue
+      partners_by_group[order.brivo_group_id.brivo_group_id] |= order.partner_id
+    
+    mismatched.write({ 'brivo_sync_error': 'The Brivo group of this membership belongs to another Brivo account '
+                                           'than the Brivo user of the member, who gets no access from it.' })
+    (self.filtered('brivo_sync_error') - mismatched).write({ 'brivo_sync_error': False })
+    
+    if delay is None:
+      delay = const.BRIVO_MEMBERSHIP_DEBOUNCE
+    for brivo_group_id, partners in partners_by_group.items():
+      self.env['brivo.job'].enqueue(partners, 'sync_group', { 'brivo_group_id': brivo_group_id },
+                                    delay=delay)
@@ -0,0 +1,358 @@
+# All Rights Reserved
+# You may not use, distribute and modify this code without the express written consent of clubcloud, LLC.
+'''
+  Measures what the cc_brivo operations cost end-to-end, against the mock Brivo server of
+  `mock_brivo_server.py` started in-process.
+  
+  Usage:
+    python benchmark_brivo.py -c /etc/odoo/odoo.conf -d brivo_bench --scales 1 100 10000 \
+        --template 12 --output results/18.0.0.1.json --compare results/previous.json
+  
+  Run it with the Python environment of Odoo, against a DEDICATED database with cc_brivo
+  installed: the benchmark commits the partners, orders and jobs it creates, and sets the
+  Brivo settings of the database to reach the mock server.
+  
+  Each scenario is run at every scale, `--repeat` times, on fresh records:
+    - partner_create. `ResPartner.create` of N partners.
+    - partner_write. `ResPartner.write` of the names of N provisioned partners.
+    - barcode_rotation. `ResPartner.write` of the barcodes of N provisioned partners.
+    - sale_confirm. `SaleOrder.action_confirm` of N membership orders.
+    - sale_close. `SaleOrder.set_close` of N confirmed membership orders.
+    - group_reassignment. `AssignBrivoGroupWizard.action_confirm` on a membership with N members.
+    - group_sync. `cron_sync_brivo_groups` with N groups on Brivo.
+  The sale scenarios need `--template`, a membership template that can be confirmed in this
+  database, and are skipped without it.
+  
+  The measured time of an operation includes running the Brivo jobs and reassignments it
+  queued, so that it covers the Brivo calls. Results hold, per scenario and scale:
+    - calls_per_record. Brivo calls made per record, retries included.
+    - latency_p50/latency_p99. Seconds taken by the operation over the repeats.
+    - call_p50/call_p99. Seconds taken by a single Brivo call.
+    - throughput. Records processed per second, at the median latency.
+'''
+import argparse
+import json
+import os
+import secrets
+import subprocess
+import sys
+import threading
+import time
+from datetime import datetime, timezone
+
+from mock_brivo_server import MockBrivo, start_server
+
+SCENARIOS = ['partner_create', 'partner_write', 'barcode_rotation', 'sale_confirm', 'sale_close', 'group_reassignment', 'group_sync']
+SALE_SCENARIOS = {'sale_confirm', 'sale_close', 'group_reassignment'}
+
+def percentile(values, quantile):
+  values = sorted(values)
+  if not values:
+    return 0.0
+  return values[min(len(values) - 1, int(round(quantile * (len(values) - 1))))]
+
+class CallTimer:
+  '''
+    Wraps `_send` of `utils/brivo.py` to time every Brivo call, from any thread.
+  '''
+  def __init__(self, brivo_api):
+    self.brivo_api = brivo_api
+    self.send = brivo_api._send
+    self.lock = threading.Lock()
+    self.durations = []
+  
+  def __enter__(self):
+    def timed_send(*args, **kwargs):
+      start = time.monotonic()
+      try:
+        return self.send(*args, **kwargs)
+      finally:
+        with self.lock:
+          self.durations.append(time.monotonic() - start)
+    self.brivo_api._send = timed_send
+    return self
+  
+  def __exit__(self, *exc):
+    self.brivo_api._send = self.send
+  
+  def reset(self):
+    with self.lock:
+      durations, self.durations = self.durations, []
+    return durations
+
+class Benchmark:
+  def __init__(self, registry, brivo, args):
+    self.registry = registry
+    self.brivo = brivo
+    self.args = args
+    self.tag = secrets.token_hex(3)
+    self.counter = 0
+  
+  def env(self, cr):
+    from odoo import api, SUPERUSER_ID
+    return api.Environment(cr, SUPERUSER_ID, {})
+  
+  def unique(self):
+    self.counter += 1
+    return f'{self.tag}{self.counter:07d}'
+  
+  '''
+    Queue runners, equivalent to their crons running until nothing is left
+  '''
+  def drain_jobs(self, env):
+    from odoo import fields
+    Job = env['brivo.job']
+    # Pending jobs are run whatever their next attempt, so that debounced syncs and retries
+    # of failed calls are measured too; a job failing for good ends as failed
+    while True:
+      pending = Job.search([('state', '=', 'pending')])
+      if not pending:
+        break
+      pending.write({ 'next_attempt': fields.Datetime.now() })
+      env.cr.commit()
+      Job.cron_process_brivo_jobs()
+      env.cr.commit()
+  
+  def drain_reassignments(self, env):
+    Reassignment = env['brivo.group.reassignment']
+    while Reassignment.search_count([('state', '=', 'running')]):
+      Reassignment.cron_process_brivo_group_reassignments()
+      env.cr.commit()
+  
+  '''
+    Fixtures
+  '''
+  def partners(self, env, scale, provisioned):
+    partners = env['res.partner'].create([
+      { 'name': f'Bench Member {key}', 'email': f'{key}@bench.invalid', 'barcode': key }
+      for key in (self.unique() for _ in range(scale))
+    ])
+    env.cr.commit()
+    if provisioned:
+      self.drain_jobs(env)
+    return partners
+  
+  def group(self, env):
+    name = f'Bench Group {self.unique()}'
+    self.brivo.seed_groups(1, prefix=name)
+    brivo_group_id = max(self.brivo.groups)
+    return env['brivo.groups'].create({ 'name': name, 'brivo_group_id': brivo_group_id })
+  
+  def orders(self, env, scale, confirmed):
+    # A copy of the membership per run, so that the members of earlier runs are left out
+    template = env['sale.order.template'].browse(self.args.template).copy({ 'brivo_group_id': self.group(env).id })
+    partners = self.partners(env, scale, provisioned=True)
+    orders = env['sale.order'].create([
+      { 'partner_id': partner.id, 'sale_order_template_id': template.id }
+      for partner in partners
+    ])
+    env.cr.commit()
+    if confirmed:
+      orders.action_confirm()
+      env.cr.commit()
+      self.drain_jobs(env)
+    return orders
+  
+  '''
+    Scenarios. `setup_<name>` prepares the records and returns the operation to time.
+  '''
+  def setup_partner_create(self, env, scale):
+    vals_list = [
+      { 'name': f'Bench Member {key}', 'email': f'{key}@bench.invalid', 'barcode': key }
+      for key in (self.unique() for _ in range(scale))
+    ]
+    return lambda: env['res.partner'].create(vals_list)
+  
+  def setup_partner_write(self, env, scale):
+    partners = self.partners(env, scale, provisioned=True)
+    return lambda: partners.write({ 'name': f'Bench Renamed {self.unique()}' })
+  
+  def setup_barcode_rotation(self, env, scale):
+    partners = self.partners(env, scale, provisioned=True)
+    def run():
+      for partner in partners:
+        partner.barcode = self.unique()
+    return run
+  
+  def setup_sale_confirm(self, env, scale):
+    orders = self.orders(env, scale, confirmed=False)
+    return orders.action_confirm
+  
+  def setup_sale_close(self, env, scale):
+    orders = self.orders(env, scale, confirmed=True)
+    return orders.set_close
+  
+  def setup_group_reassignment(self, env, scale):
+    orders = self.orders(env, scale, confirmed=True)
+    wizard = env['assign.brivo.group.wizard'].create({
+      'sale_order_template_id': orders[:1].sale_order_template_id.id,
+      'brivo_group_id': self.group(env).id
+    })
+    env.cr.commit()
+    return wizard.action_confirm
+  
+  def setup_group_sync(self, env, scale):
+    with self.brivo.lock:
+      self.brivo.groups.clear()
+      self.brivo.members.clear()
+    self.brivo.seed_groups(scale, prefix=f'Bench Group {self.unique()}')
+    return env['brivo.groups'].cron_sync_brivo_groups
+  
+  def measure(self, scenario, scale, timer):
+    latencies, calls, call_durations, endpoints = [], 0, [], {}
+    
+    for _ in range(self.args.repeat):
+      with self.registry.cursor() as cr:
+        env = self.env(cr)
+        operation = getattr(self, f'setup_{scenario}')(env, scale)
+        env.cr.commit()
+        self.brivo.reset_stats()
+        timer.reset()
+        
+        start = time.monotonic()
+        operation()
+        env.cr.commit()
+        self.drain_jobs(env)
+        self.drain_reassignments(env)
+        latencies.append(time.monotonic() - start)
+        
+        stats = self.brivo.reset_stats()
+        calls += sum(count for name, count in stats.items() if name not in ('throttled', 'errors'))
+        for name, count in stats.items():
+          endpoints[name] = endpoints.get(name, 0) + count
+        call_durations += timer.reset()
+    
+    p50 = percentile(latencies, 0.5)
+    return {
+      'scenario': scenario,
+      'scale': scale,
+      'repeat': self.args.repeat,
+      'calls': calls,
+      'calls_per_record': calls / (scale * self.args.repeat),
+      'latency_p50': p50,
+      'latency_p99': percentile(latencies, 0.99),
+      'call_p50': percentile(call_durations, 0.5),
+      'call_p99': percentile(call_durations, 0.99),
+      'throughput': scale / p50 if p50 else 0.0,
+      'endpoints': endpoints
+    }
+
+def configure(registry, url, rate_limit):
+  '''
+    Points cc_brivo at the mock server. Returns the previous settings, to restore them.
+  '''
+  from odoo import api, SUPERUSER_ID
+  from odoo.addons.cc_brivo.utils import brivo as brivo_api, const
+  
+  brivo_api.AUTH_STUB = brivo_api.API_STUB = url
+  # Membership syncs are due right away, the debounce window would only add idle time
+  const.BRIVO_MEMBERSHIP_DEBOUNCE = 0
+  with registry.cursor() as cr:
+    env = api.Environment(cr, SUPERUSER_ID, {})
+    settings = env['club.system.settings'].search([], limit=1)
+    vals = {
+      'brivo_app_client_id': 'bench',
+      'brivo_app_client_secret': 'bench',
+      'brivo_access_username': 'bench',
+      'brivo_access_password': 'bench',
+      'brivo_api_key': 'bench',
+      'brivo_rate_limit': rate_limit
+    }
+    previous = settings.read(list(vals))[0]
+    settings.write(vals)
+  return previous
+
+def restore(registry, previous):
+  from odoo import api, SUPERUSER_ID
+  with registry.cursor() as cr:
+    env = api.Environment(cr, SUPERUSER_ID, {})
+    env['club.system.settings'].browse(previous.pop('id')).write(previous)
+
+def compare(results, baseline_path):
+  with open(baseline_path, encoding='utf-8') as f:
+    baseline = { (r['scenario'], r['scale']): r for r in json.load(f)['results'] }
+  
+  print(f'\nCompared with {baseline_path}:')
+  for r in results:
+    before = baseline.get((r['scenario'], r['scale']))
+    if not before:
+      continue
+    deltas = []
+    for key in ('calls_per_record', 'latency_p50', 'latency_p99', 'throughput'):
+      if before[key]:
+        deltas.append(f'{key} {(r[key] - before[key]) / before[key]:+.0%}')
+    print(f'  {r["scenario"]:<20} {r["scale"]:>6}  ' + ', '.join(deltas))
+
+def revision():
+  try:
+    return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)), text=True).strip()
+  except (OSError, subprocess.CalledProcessError):
+    return None
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description='Benchmark the cc_brivo operations against a mock Brivo server.')
+  parser.add_argument('-c', '--config', required=True, help='Odoo configuration file.')
+  parser.add_argument('-d', '--database', required=True, help='Dedicated database with cc_brivo installed.')
+  parser.add_argument('--scales', type=int, nargs='+', default=[1, 100, 10000])
+  parser.add_argument('--scenarios', nargs='+', choices=SCENARIOS, default=SCENARIOS)
+  parser.add_argument('--repeat', type=int, default=3, help='Runs of each scenario and scale.')
+  parser.add_argument('--template', type=int, help='ID of a membership template, needed by the sale scenarios.')
+  parser.add_argument('--latency', type=float, default=0.02, help='Seconds added by the mock to every call.')
+  parser.add_argument('--jitter', type=float, default=0.02)
+  parser.add_argument('--error-rate', type=float, default=0)
+  parser.add_argument('--throttle-rate', type=float, default=0)
+  parser.add_argument('--rate-limit', type=float, default=0, help='Brivo rate limit to configure, 0 to disable it.')
+  parser.add_argument('--seed', type=int, default=0)
+  parser.add_argument('--output', help='File to write the JSON results to.')
+  parser.add_argument('--compare', help='Results of an earlier run to compare with.')
+  args = parser.parse_args(argv)
+  
+  import odoo
+  odoo.tools.config.parse_config(['-c', args.config, '-d', args.database])
+  from odoo.modules.registry import Registry
+  from odoo.addons.cc_brivo.utils import brivo as brivo_api
+  
+  registry = Registry(args.database)
+  brivo = MockBrivo(args.latency, args.jitter, args.error_rate, args.throttle_rate, retry_after=1, seed=args.seed)
+  server, url = start_server(brivo)
+  previous = configure(registry, url, args.rate_limit)
+  
+  scenarios = [s for s in args.scenarios if args.template or s not in SALE_SCENARIOS]
+  skipped = set(args.scenarios) - set(scenarios)
+  if skipped:
+    print(f'Skipped without --template: {", ".join(sorted(skipped))}')
+  
+  benchmark = Benchmark(registry, brivo, args)
+  results = []
+  try:
+    with CallTimer(brivo_api) as timer:
+      for scenario in scenarios:
+        for scale in args.scales:
+          r = benchmark.measure(scenario, scale, timer)
+          results.append(r)
+          print(f'{scenario:<20} {scale:>6}  {r["calls_per_record"]:6.2f} calls/record  '
+                f'p50 {r["latency_p50"]:8.3f}s  p99 {r["latency_p99"]:8.3f}s  '
+                f'call p50 {r["call_p50"] * 1000:6.1f}ms  p99 {r["call_p99"] * 1000:6.1f}ms  '
+                f'{r["throughput"]:8.1f} records/s')
+  finally:
+    restore(registry, previous)
+    server.shutdown()
+  
+  if args.output:
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    with open(args.output, 'w', encoding='utf-8') as f:
+      json.dump({
+        'date': datetime.now(timezone.utc).isoformat(),
+        'revision': revision(),
+        'database': args.database,
+        'mock': { k: getattr(args, k) for k in ('latency', 'jitter', 'error_rate', 'throttle_rate', 'rate_limit', 'seed') },
+        'results': results
+      }, f, indent=2)
+    print(f'Results written to {args.output}')
+  
+  if args.compare:
+    compare(results, args.compare)
+  return 0
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -0,0 +1,356 @@
+# All Rights Reserved
+# You may not use, distribute and modify this code without the express written consent of clubcloud, LLC.
+'''
+  Local stand-in for the Brivo API, implementing the endpoints called by `utils/brivo.py`:
+  the OAuth token endpoint, users, credentials, groups, group members, suspended status
+  and access events.
+  State is kept in memory and lost when the server stops.
+  
+  Usage:
+    python mock_brivo_server.py --port 8899 --latency 0.05 --jitter 0.05 --error-rate 0.01 --throttle-rate 0.01
+  
+  Point cc_brivo at it by replacing `AUTH_STUB` and `API_STUB` of `utils/brivo.py` with
+  http://localhost:8899, which `benchmark_brivo.py` does by itself.
+  
+  Faults are injected before a request is handled, so a failed call never changes the state:
+    - latency/jitter. Every request waits `latency` plus up to `jitter` seconds.
+    - error-rate. Share of requests answered with a 503.
+    - throttle-rate. Share of requests answered with a 429 and a Retry-After header.
+'''
+import argparse
+import hashlib
+import json
+import random
+import re
+import secrets
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+
+# Routes of the Brivo API, matched in order
+ROUTES = [
+  ('POST', r'/oauth/token', 'token'),
+  ('GET', r'/v1/api/users', 'list_users'),
+  ('POST', r'/v1/api/users', 'create_user'),
+  ('PUT', r'/v1/api/users/(\d+)', 'update_user'),
+  ('DELETE', r'/v1/api/users/(\d+)', 'delete_user'),
+  ('GET', r'/v1/api/users/(\d+)/suspended', 'get_suspended'),
+  ('PUT', r'/v1/api/users/(\d+)/suspended', 'set_suspended'),
+  ('GET', r'/v1/api/users/(\d+)/groups', 'list_user_groups'),
+  ('PUT', r'/v1/api/users/(\d+)/credentials/(\d+)', 'assign_credential'),
+  ('GET', r'/v1/api/credentials', 'list_credentials'),
+  ('POST', r'/v1/api/credentials', 'create_credential'),
+  ('DELETE', r'/v1/api/credentials/(\d+)', 'delete_credential'),
+  ('GET', r'/v1/api/groups', 'list_groups'),
+  ('POST', r'/v1/api/groups', 'create_group'),
+  ('GET', r'/v1/api/groups/(\d+)/users', 'list_group_users'),
+  ('PUT', r'/v1/api/groups/(\d+)/users/(\d+)', 'add_to_group'),
+  ('DELETE', r'/v1/api/groups/(\d+)/users/(\d+)', 'remove_from_group'),
+  ('GET', r'/v1/api/events/access', 'list_access_events')
+]
+ROUTES = [(method, re.compile(f'^{pattern}$'), name) for method, pattern, name in ROUTES]
+
+class MockBrivoError(Exception):
+  def __init__(self, status, message):
+    super().__init__(message)
+    self.status = status
+
+class MockBrivo:
+  '''
+    In-memory state of the mock Brivo account, shared by the request handler threads.
+  '''
+  def __init__(self, latency=0.0, jitter=0.0, error_rate=0.0, throttle_rate=0.0, retry_after=1, token_lifetime=3600, seed=None):
+    self.latency = latency
+    self.jitter = jitter
+    self.error_rate = error_rate
+    self.throttle_rate = throttle_rate
+    self.retry_after = retry_after
+    self.token_lifetime = token_lifetime
+    self.random = random.Random(seed)
+    self.lock = threading.Lock()
+    self.tokens = set()
+    self.refresh_tokens = set()
+    self.users = {}
+    self.credentials = {}
+    self.groups = {}
+    # brivo_group_id -> set of brivo user IDs
+    self.members = {}
+    self.access_events = []
+    self._next_id = 1000
+    self.stats = Counter()
+  
+  def next_id(self):
+    self._next_id += 1
+    return self._next_id
+  
+  def seed_groups(self, count, prefix='Group'):
+    '''
+      Creates `count` groups, e.g. to measure the group sync.
+    '''
+    with self.lock:
+      for i in range(count):
+        group_id = self.next_id()
+        self.groups[group_id] = { 'id': group_id, 'name': f'{prefix} {i}' }
+        self.members[group_id] = set()
+  
+  def seed_access_events(self, count, doors=3):
+    '''
+      Records `count` access events of random users, e.g. to measure the check-in import.
+    '''
+    with self.lock:
+      users = list(self.users.values())
+      now = datetime.now(timezone.utc)
+      for i in range(count):
+        user = self.random.choice(users) if users else {}
+        door_id = self.random.randrange(doors)
+        self.access_events.append({
+          'uuid': str(uuid.UUID(int=self.random.getrandbits(128))),
+          'occurred': (now - timedelta(seconds=count - i)).strftime('%Y-%m-%dT%H:%M:%SZ'),
+          'actor': { 'id': user.get('id'), 'externalId': user.get('externalId') },
+          'eventObject': { 'id': door_id, 'name': f'Door {door_id}' },
+          'securityAction': { 'securityActionId': 2004, 'action': 'Access Granted', 'exception': False }
+        })
+  
+  def reset_stats(self):
+    with self.lock:
+      stats, self.stats = self.stats, Counter()
+    return stats
+  
+  def handle(self, method, path, query, body, headers):
+    '''
+      Returns the (status, body, headers) of a request.
+    '''
+    for route_method, pattern, name in ROUTES:
+      match = pattern.match(path)
+      if match and route_method == method:
+        break
+    else:
+      return 404, { 'message': f'No route for {method} {path}' }, {}
+    
+    with self.lock:
+      self.stats[name] += 1
+      delay = self.latency + self.random.uniform(0, self.jitter)
+      roll = self.random.random()
+    time.sleep(delay)
+    
+    if roll < self.throttle_rate:
+      with self.lock:
+        self.stats['throttled'] += 1
+      return 429, { 'message': 'Too Many Requests' }, { 'Retry-After': str(self.retry_after) }
+    if roll < self.throttle_rate + self.error_rate:
+      with self.lock:
+        self.stats['errors'] += 1
+      return 503, { 'message': 'Service Unavailable' }, {}
+    
+    if name != 'token' and headers.get('Authorization', '')[len('Bearer '):] not in self.tokens:
+      return 401, { 'message': 'Invalid token' }, {}
+    
+    try:
+      with self.lock:
+        status, res = getattr(self, f'_{name}')(*[int(g) for g in match.groups()], query=query, body=body)
+    except MockBrivoError as err:
+      return err.status, { 'message': str(err) }, {}
+    return status, res, {}
+  
+  def _page(self, items, query):
+    offset = int(query.get('offset', ['0'])[0])
+    page_size = int(query.get('pageSize', ['100'])[0])
+    items = list(items)
+    return 200, { 'data': items[offset:offset + page_size], 'offset': offset, 'pageSize': page_size, 'count': len(items) }
+  
+  def _get(self, collection, key, what):
+    if key not in collection:
+      raise MockBrivoError(404, f'{what} {key} not found')
+    return collection[key]
+  
+  def _token(self, query, body):
+    grant = body.get('grant_type')
+    if grant == 'refresh_token' and body.get('refresh_token') not in self.refresh_tokens:
+      raise MockBrivoError(401, 'Invalid refresh token')
+    if grant not in ('password', 'refresh_token'):
+      raise MockBrivoError(400, f'Unsupported grant {grant}')
+    
+    token, refresh_token = secrets.token_hex(16), secrets.token_hex(16)
+    self.tokens.add(token)
+    self.refresh_tokens.add(refresh_token)
+    return 200, { 'access_token': token, 'refresh_token': refresh_token, 'token_type': 'bearer', 'expires_in': self.token_lifetime }
+  
+  def _list_users(self, query, body):
+    return self._page(self.users.values(), query)
+  
+  def _create_user(self, query, body):
+    user_id = self.next_id()
+    self.users[user_id] = dict(body, id=user_id, suspended=False, credentials=[])
+    return 200, self.users[user_id]
+  
+  def _update_user(self, user_id, query, body):
+    self._get(self.users, user_id, 'User').update(body, id=user_id)
+    return 200, self.users[user_id]
+  
+  def _delete_user(self, user_id, query, body):
+    self._get(self.users, user_id, 'User')
+    del self.users[user_id]
+    for members in self.members.values():
+      members.discard(user_id)
+    return 204, None
+  
+  def _get_suspended(self, user_id, query, body):
+    return 200, { 'suspended': self._get(self.users, user_id, 'User')['suspended'] }
+  
+  def _set_suspended(self, user_id, query, body):
+    self._get(self.users, user_id, 'User')['suspended'] = bool(body.get('suspended'))
+    return 200, { 'suspended': self.users[user_id]['suspended'] }
+  
+  def _list_user_groups(self, user_id, query, body):
+    self._get(self.users, user_id, 'User')
+    return self._page((self.groups[g] for g, members in self.members.items() if user_id in members), query)
+  
+  def _assign_credential(self, user_id, credential_id, query, body):
+    user = self._get(self.users, user_id, 'User')
+    self._get(self.credentials, credential_id, 'Credential')
+    user['credentials'].append(credential_id)
+    return 204, None
+  
+  def _list_credentials(self, query, body):
+    credentials = self.credentials.values()
+    # Only the referenceId filter used by utils/brivo.py is supported
+    match = re.match(r'^referenceId__eq:(.*)$', query.get('filter', [''])[0])
+    if match:
+      credentials = [c for c in credentials if c.get('referenceId') == match.group(1)]
+    return self._page(credentials, query)
+  
+  def _create_credential(self, query, body):
+    credential_id = self.next_id()
+    self.credentials[credential_id] = dict(body, id=credential_id)
+    return 200, self.credentials[credential_id]
+  
+  def _delete_credential(self, credential_id, query, body):
+    self._get(self.credentials, credential_id, 'Credential')
+    del self.credentials[credential_id]
+    for user in self.users.values():
+      if credential_id in user['credentials']:
+        user['credentials'].remove(credential_id)
+    return 204, None
+  
+  def _list_access_events(self, query, body):
+    events = self.access_events
+    # Only the occurred filter used by utils/brivo.py is supported, ISO timestamps compare as strings
+    match = re.match(r'^occurred__gte:(.*)$', query.get('filter', [''])[0])
+    if match:
+      events = [e for e in events if e['occurred'] >= match.group(1)]
+    return self._page(events, query)
+  
+  def _list_groups(self, query, body):
+    return self._page(self.groups.values(), query)
+  
+  def _create_group(self, query, body):
+    group_id = self.next_id()
+    self.groups[group_id] = { 'id': group_id, 'name': body.get('name') }
+    self.members[group_id] = set()
+    return 200, self.groups[group_id]
+  
+  def _list_group_users(self, group_id, query, body):
+    self._get(self.groups, group_id, 'Group')
+    return self._page((self.users[u] for u in sorted(self.members[group_id]) if u in self.users), query)
+  
+  def _add_to_group(self, group_id, user_id, query, body):
+    self._get(self.groups, group_id, 'Group')
+    self._get(self.users, user_id, 'User')
+    self.members[group_id].add(user_id)
+    return 204, None
+  
+  def _remove_from_group(self, group_id, user_id, query, body):
+    self._get(self.groups, group_id, 'Group')
+    self.members[group_id].discard(user_id)
+    return 204, None
+
+class MockBrivoHandler(BaseHTTPRequestHandler):
+  protocol_version = 'HTTP/1.1'
+  
+  def _dispatch(self):
+    url = urlsplit(self.path)
+    raw = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+    
+    if self.headers.get('Content-Type', '').startswith('application/x-www-form-urlencoded'):
+      body = { k: v[0] for k, v in parse_qs(raw.decode('utf-8')).items() }
+    else:
+      body = json.loads(raw or b'{}')
+    
+    status, res, headers = self.server.brivo.handle(self.command, url.path, parse_qs(url.query), body, self.headers)
+    payload = b'' if res is None else json.dumps(res).encode('utf-8')
+    
+    # Lists are validated by an ETag of their body, like the conditional GETs of `utils/brivo.py` expect
+    if self.command == 'GET' and status == 200 and payload:
+      headers = dict(headers, ETag=f'"{hashlib.sha1(payload).hexdigest()}"')
+      if self.headers.get('If-None-Match') == headers['ETag']:
+        status, payload = 304, b''
+    
+    self.send_response(status)
+    for name, value in headers.items():
+      self.send_header(name, value)
+    if payload:
+      self.send_header('Content-Type', 'application/json')
+    if status != 304:
+      self.send_header('Content-Length', str(len(payload)))
+    self.end_headers()
+    self.wfile.write(payload)
+  
+  do_GET = do_POST = do_PUT = do_DELETE = _dispatch
+  
+  def log_message(self, format, *args):
+    if self.server.verbose:
+      super().log_message(format, *args)
+
+def make_server(brivo, host='127.0.0.1', port=0, verbose=False):
+  '''
+    Returns an HTTP server serving `brivo`, a `MockBrivo`. Port 0 picks a free port,
+    see `server.server_address`.
+  '''
+  server = ThreadingHTTPServer((host, port), MockBrivoHandler)
+  server.daemon_threads = True
+  server.brivo = brivo
+  server.verbose = verbose
+  return server
+
+def start_server(brivo, host='127.0.0.1', port=0):
+  '''
+    Serves `brivo` in a background thread and returns the server and its base URL.
+  '''
+  server = make_server(brivo, host, port)
+  threading.Thread(target=server.serve_forever, daemon=True).start()
+  return server, f'http://{server.server_address[0]}:{server.server_address[1]}'
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description='Serve a mock Brivo API.')
+  parser.add_argument('--host', default='127.0.0.1')
+  parser.add_argument('--port', type=int, default=8899)
+  parser.add_argument('--latency', type=float, default=0, help='Seconds added to every request.')
+  parser.add_argument('--jitter', type=float, default=0, help='Up to this many seconds added at random to every request.')
+  parser.add_argument('--error-rate', type=float, default=0, help='Share of requests failing with a 503.')
+  parser.add_argument('--throttle-rate', type=float, default=0, help='Share of requests failing with a 429.')
+  parser.add_argument('--retry-after', type=int, default=1, help='Retry-After of throttled requests, in seconds.')
+  parser.add_argument('--token-lifetime', type=int, default=3600, help='Lifetime of access tokens, in seconds.')
+  parser.add_argument('--groups', type=int, default=0, help='Number of groups to create at start.')
+  parser.add_argument('--seed', type=int, help='Seed of the fault injection.')
+  parser.add_argument('--verbose', action='store_true', help='Log every request.')
+  args = parser.parse_args(argv)
+  
+  brivo = MockBrivo(args.latency, args.jitter, args.error_rate, args.throttle_rate, args.retry_after, args.token_lifetime, args.seed)
+  brivo.seed_groups(args.groups)
+  server = make_server(brivo, args.host, args.port, args.verbose)
+  print(f'Mock Brivo listening on http://{args.host}:{server.server_address[1]}')
+  
+  try:
+    server.serve_forever()
+  except KeyboardInterrupt:
+    pass
+  print(json.dumps(brivo.stats, indent=2))
+  return 0
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -0,0 +1,55 @@
+# All Rights Reserved
+# You may not use, distribute and modify this code without the express written consent of clubcloud, LLC. 
+'''
+  Stands in for Brivo's event subscriptions by replaying recorded event payloads
+  against the cc_brivo webhook of a running Odoo.
+  
+  Usage:
+    python replay_brivo_events.py http://localhost:8069/cc_brivo/events <secret> samples/brivo_events.jsonl
+    
+  Each call is signed with the HMAC-SHA256 of its body keyed with the webhook
+  secret of the account in the X-Brivo-Signature header.
+  
+  Each line of the payload file is one event. Replaying the same file twice must not
+  change the local state the second time, since events are deduplicated on their uuid.
+'''
+import argparse
+import hashlib
+import hmac
+import json
+import sys
+import time
+
+import requests
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description='Replay recorded Brivo events against the cc_brivo webhook.')
+  parser.add_argument('url', help='Webhook URL.')
+  parser.add_argument('secret', help='Webhook secret of the Brivo account the events are sent for.')
+  parser.add_argument('payloads', help='File with one JSON event per line.')
+  parser.add_argument('--batch', type=int, default=1, help='Events sent per call.')
+  parser.add_argument('--delay', type=float, default=0, help='Seconds to wait between calls.')
+  args = parser.parse_args(argv)
+  
+  with open(args.payloads, encoding='utf-8') as f:
+    events = [json.loads(line) for line in f if line.strip()]
+  
+  session = requests.Session()
+  received = 0
+  for i in range(0, len(events), args.batch):
+    batch = events[i:i + args.batch]
+    body = json.dumps(batch if args.batch > 1 else batch[0]).encode('utf-8')
+    signature = hmac.new(args.secret.encode('utf-8'), body, hashlib.sha256).hexdigest()
+    res = session.post(args.url, data=body, timeout=10,
+                       headers={ 'Content-Type': 'application/json', 'X-Brivo-Signature': signature })
+    print(f'{res.status_code} {res.text}')
+    if not res.ok:
+      return 1
+    received += res.json().get('received', 0)
+    time.sleep(args.delay)
+  
+  print(f'{len(events)} events sent, {received} new')
+  return 0
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -3,6 +3,19 @@
 import requests
 import logging
 import base64
+import hashlib
+import json
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+from email.utils import parsedate_to_datetime
+from collections import namedtuple
+from .token_manager import get_access_token, invalidate_token, credential_key
+from .http_client import get_http_client
+from .rate_limit import get_breaker, acquire, BrivoCircuitOpenError, BrivoRateLimitError
+from .metrics import attributed, record_call, record_retry, maybe_flush
+from .list_cache import BRIVO_LIST_CACHE
+from . import const
 
 _logger = logging.getLogger(__name__)
 
@@ -13,40 +26,228 @@ def brivo_auth(env):
   '''
     Authenticates with Brivo to obtain an authentication token.
     Input:
-      env. An object environment.
+      env. An object environment or a `BrivoConnection`.
     Output:
       A response from Brivo.
   '''
-  SYSTEM_SETTINGS = env['club.system.settings'].search([], limit=1)
+  SYSTEM_SETTINGS = _get_settings(env)
   
-  s = f'{SYSTEM_SETTINGS.brivo_app_client_id}:{SYSTEM_SETTINGS.brivo_app_client_secret}'
+  data = {
+    'grant_type': 'password',
+    'username': SYSTEM_SETTINGS.brivo_access_username,
+    'password': SYSTEM_SETTINGS.brivo_access_password
+  }
+  
+  return _fetch_token(SYSTEM_SETTINGS, data)
+
+def _fetch_token(settings, data):
+  '''
+    Posts a grant to Brivo's OAuth token endpoint.
+    Input:
+      - settings. The `BrivoSettings` holding the Brivo credentials.
+      - data. The form data of the grant (password or refresh_token).
+    Output:
+      A response from Brivo.
+  '''
+  s = f'{settings.brivo_app_client_id}:{settings.brivo_app_client_secret}'
   client_creds = base64.b64encode(bytes(s, encoding='utf-8')).decode('utf-8')
   
   headers = {
     'Authorization': f'Basic {client_creds}',
-    'api-key': SYSTEM_SETTINGS.brivo_api_key,
+    'api-key': settings.brivo_api_key,
     'Content-Type': 'application/x-www-form-urlencoded'
   }
   
-  data = {
-    'grant_type': 'password',
-    'username': SYSTEM_SETTINGS.brivo_access_username,
-    'password': SYSTEM_SETTINGS.brivo_access_password
-  }
+  try:
+    # A rejected grant changes nothing on Brivo, so it is safe to retry
+    res = _send(settings, 'POST', f'{AUTH_STUB}/oauth/token', idempotent=True, data=data, headers=headers)
+  except requests.RequestException as err:
+    _logger.error(f'Brivo API Call to POST {AUTH_STUB}/oauth/token failed: {err}')
+    return { 'status': 'FAILURE', 'error': str(err) }
+  
+  return handle_response(res)
+
+# Fields of `club.system.settings` needed to call Brivo
+SETTINGS_FIELDS = [
+  'brivo_app_client_id',
+  'brivo_app_client_secret',
+  'brivo_access_username',
+  'brivo_access_password',
+  'brivo_api_key',
+  'brivo_http_pool_size',
+  'brivo_connect_timeout',
+  'brivo_read_timeout',
+  'brivo_rate_limit',
+  'brivo_rate_burst',
+  'brivo_webhook_token',
+  'brivo_slow_call_ms'
+]
+
+# Methods that may be retried after a 5xx or a network error
+IDEMPOTENT_METHODS = ('GET', 'PUT', 'DELETE', 'HEAD', 'OPTIONS')
+
+BrivoSettings = namedtuple('BrivoSettings', SETTINGS_FIELDS)
+
+# The partner fields read by the Brivo helpers, so that partners can be passed as plain snapshots
+BrivoPartner = namedtuple('BrivoPartner', ['id', 'name', 'email', 'barcode', 'brivo_id', 'brivo_barcode_credential_id'])
+
+class BrivoConnection:
+  '''
+    Everything needed to call Brivo without an Odoo environment. Every helper accepting
+    an `env` also accepts a connection, which allows spreading calls over worker threads.
+    A connection is bound to one Brivo account; `account_id` is False for the account of
+    the system settings.
+  '''
+  def __init__(self, registry, settings, account_id=False):
+    self.registry = registry
+    self.settings = settings
+    self.account_id = account_id
+
+def brivo_connection(env, account_id=False):
+  '''
+    Returns a thread-safe `BrivoConnection` for the database of `env`.
+    Input:
+      - env. An object environment, or an existing connection which is returned as is.
+      - account_id. The ID of the `brivo.account` to call, False for the account of the
+        system settings.
+  '''
+  if isinstance(env, BrivoConnection):
+    return env
   
-  return handle_response(requests.post(f'{AUTH_STUB}/oauth/token', data=data, headers=headers))
+  if account_id:
+    return BrivoConnection(env.registry, env['brivo.account']._get_brivo_settings(account_id), account_id)
+  
+  return BrivoConnection(env.registry, env['club.system.settings']._get_brivo_settings())
 
-def _set_api_headers(env):
+def partner_snapshot(partner_rec):
+  '''
+    Returns a `BrivoPartner` holding the values of `partner_rec` read by the Brivo helpers.
+  '''
+  return BrivoPartner(
+    partner_rec.id,
+    partner_rec.name,
+    partner_rec.email,
+    partner_rec.barcode,
+    partner_rec.brivo_id,
+    partner_rec.brivo_barcode_credential_id
+  )
+
+def _get_settings(env):
+  '''
+    Returns the Brivo credentials and connection settings, from the per-database cache.
+  '''
+  return brivo_connection(env).settings
+
+def _http_client(settings):
+  '''
+    Returns the pooled HTTP client of this worker for the account of `settings`.
+  '''
+  return get_http_client(credential_key(settings),
+                         settings.brivo_http_pool_size,
+                         settings.brivo_connect_timeout,
+                         settings.brivo_read_timeout)
+
+def _send(settings, method, url, registry=None, idempotent=None, **kwargs):
+  '''
+    Sends a request to Brivo through the pooled client.
+    
+    Calls fail fast while the circuit breaker is open, and wait for a slot of the shared
+    rate limit when a registry is given. A 429 is retried for any method, 5xx and network
+    errors only for idempotent calls, honoring `Retry-After` or else backing off exponentially
+    with full jitter.
+    Input:
+      - settings. The `BrivoSettings` of the call.
+      - method. The HTTP method.
+      - url. The full URL.
+      - registry. The registry of the database, used by the rate limit.
+      - idempotent. Whether the call may be retried after a 5xx, defaults on the method.
+    Output:
+      The final `requests.Response`. Raises `requests.RequestException` on network errors,
+      an open circuit or an exhausted rate limit.
+  '''
+  key = credential_key(settings)
+  breaker = get_breaker(key)
+  client = _http_client(settings)
+  if idempotent is None:
+    idempotent = method in IDEMPOTENT_METHODS
+  
+  attempt = 0
+  while True:
+    if not breaker.allow():
+      raise BrivoCircuitOpenError(f'Brivo is unavailable, calls are suspended for up to {breaker.cooldown}s')
+    if registry is not None and not acquire(registry, key, settings.brivo_rate_limit, settings.brivo_rate_burst):
+      raise BrivoRateLimitError('Brivo rate limit exceeded, no slot available')
+    
+    start = time.monotonic()
+    try:
+      res = client.request(method, url, **kwargs)
+    except (requests.ConnectionError, requests.Timeout) as err:
+      record_call(method, url, 'error', time.monotonic() - start, slow_ms=settings.brivo_slow_call_ms)
+      breaker.record(False)
+      if not idempotent or attempt >= const.BRIVO_MAX_RETRIES:
+        _flush_metrics(registry)
+        raise
+      delay = _backoff_delay(attempt)
+      reason = str(err)
+    else:
+      record_call(method, url, res.status_code, time.monotonic() - start,
+                  bytes_sent=len(res.request.body or b''), bytes_received=len(res.content),
+                  slow_ms=settings.brivo_slow_call_ms)
+      breaker.record(res.status_code < 500)
+      retryable = res.status_code == 429 or (idempotent and res.status_code in (502, 503, 504))
+      if not retryable or attempt >= const.BRIVO_MAX_RETRIES:
+        _flush_metrics(registry)
+        return res
+      delay = _retry_after(res)
+      delay = _backoff_delay(attempt) if delay is None else delay
+      reason = f'HTTP {res.status_code}'
+    
+    attempt += 1
+    record_retry(method, url)
+    _logger.warning(f'Brivo API Call to {method} {url} failed with {reason}, retry {attempt} in {delay:.2f}s')
+    time.sleep(delay)
+
+def _flush_metrics(registry):
+  if registry is not None:
+    maybe_flush(registry)
+
+def _backoff_delay(attempt):
+  '''
+    Exponential backoff with full jitter.
+  '''
+  return random.uniform(0, min(const.BRIVO_RETRY_MAX_DELAY, const.BRIVO_RETRY_BASE_DELAY * 2 ** attempt))
+
+def _retry_after(res):
+  '''
+    Returns the delay requested by a `Retry-After` header (seconds or HTTP date), capped
+    to `BRIVO_RETRY_MAX_DELAY`, or None.
+  '''
+  value = res.headers.get('Retry-After')
+  if not value:
+    return None
+  
+  try:
+    delay = float(value)
+  except ValueError:
+    try:
+      delay = parsedate_to_datetime(value).timestamp() - time.time()
+    except (TypeError, ValueError):
+      return None
+  
+  return min(max(delay, 0), const.BRIVO_RETRY_MAX_DELAY)
+
+def _set_api_headers(env, stale_token=None):
   '''
     Helper function for setting API headers to make requests to Brivo.
     Input:
-      env: An object environment, used to access Odoo models.
+      env: An object environment or a `BrivoConnection`.
+      stale_token: An access token rejected by Brivo, forcing a new token to be obtained.
     Output:
       An object containing necessary headers for calling to Brivo, including an access token and
       the API key.
   '''
-  SYSTEM_SETTINGS = env['club.system.settings'].search([], limit=1)
-  auth_res = brivo_auth(env)
+  conn = brivo_connection(env)
+  auth_res = get_access_token(conn.registry, conn.settings, _fetch_token, stale_token=stale_token)
   
   if auth_res.get('status', None) == 'FAILURE':
     return auth_res
@@ -55,76 +256,212 @@ def _set_api_headers(env):
   
   return {
     'Authorization': f'bearer {access_token}',
-    'api-key': SYSTEM_SETTINGS.brivo_api_key,
+    'api-key': conn.settings.brivo_api_key,
     'Content-Type': 'application/json'
   }
 
-def brivo_create_user(env, partner_rec):
+def _call_api(env, method, path, no_content=False, **kwargs):
   '''
-    Create a Brivo user.
+    Makes an authenticated call to the Brivo API. If Brivo rejects the cached access
+    token, the token is renewed and the call is retried once.
     Input:
-      - env. An object environment, passed into `_set_api_headers` to generate the API call headers.
-      - partner_rec. A res.partner record.
-      
+      - env. An object environment or a `BrivoConnection`.
+      - method. The HTTP method.
+      - path. The path of the endpoint, relative to `API_STUB`.
+      - no_content. Passed to `handle_response`.
     Output:
       A response from Brivo's API.
   '''
-  first_name = partner_rec.name.split(' ')[0]
-  last_name = partner_rec.name.split(' ')[1]
-  external_id = str(partner_rec.id)
-  emails = [{ 'address': partner_rec.email, 'type': 'personal' }] if partner_rec.email else []
+  res = _request(env, method, path, **kwargs)
   
-  body = {
-    'firstName': first_name,
-    'lastName': last_name,
-    'externalId': external_id,
-    'emails': emails
-  }
+  if isinstance(res, dict):
+    return res
   
-  headers = _set_api_headers(env)
+  return handle_response(res, no_content=no_content)
+
+def _request(env, method, path, extra_headers=None, **kwargs):
+  '''
+    Sends an authenticated request to the Brivo API, renewing a rejected access token once.
+    Input:
+      - extra_headers. Headers added to the authentication headers, e.g. conditional ones.
+    Output:
+      The `requests.Response`, or a FAILURE result if no response was received.
+  '''
+  conn = brivo_connection(env)
+  headers = _set_api_headers(conn)
   
   if headers.get('status', None) == 'FAILURE':
     return headers
+  
+  url = f'{API_STUB}{path}'
+  
+  try:
+    res = _send(conn.settings, method, url, registry=conn.registry, headers=dict(headers, **(extra_headers or {})), **kwargs)
+    
+    if res.status_code == 401:
+      stale_token = headers['Authorization'].split(' ', 1)[1]
+      invalidate_token(conn.registry, conn.settings, stale_token)
+      headers = _set_api_headers(conn, stale_token=stale_token)
+      
+      if headers.get('status', None) == 'FAILURE':
+        return headers
+      
+      res = _send(conn.settings, method, url, registry=conn.registry, headers=dict(headers, **(extra_headers or {})), **kwargs)
+  except requests.RequestException as err:
+    _logger.error(f'Brivo API Call to {method} {url} failed: {err}')
+    return { 'status': 'FAILURE', 'error': str(err) }
+  
+  return res
 
-  return handle_response(requests.post(f'{API_STUB}/v1/api/users', json=body, headers=headers))
-
-def brivo_delete_user(env, brivo_user_id):
+def _get_page(env, path, params):
   '''
-    Deletes a user from Brivo
+    Gets a page of a Brivo list, revalidating the cached copy of the page with a conditional
+    GET when there is one. An unchanged page costs a 304 without a body.
+    Output:
+      A tuple (page, unchanged), the page being a response from Brivo's API. Cached pages
+      are shared and must not be modified.
   '''
-  headers = _set_api_headers(env)
+  conn = brivo_connection(env)
+  key = BRIVO_LIST_CACHE.key(credential_key(conn.settings), path, params)
+  entry = BRIVO_LIST_CACHE.get(key)
   
-  if headers.get('status', None) == 'FAILURE':
-    return headers
+  res = _request(conn, 'GET', path, extra_headers=BRIVO_LIST_CACHE.validators(entry), params=params)
+  
+  if isinstance(res, dict):
+    return res, False
   
-  return handle_response(requests.delete(f'{API_STUB}/v1/api/users/{brivo_user_id}', headers=headers), no_content=True)
+  if res.status_code == 304 and entry:
+    BRIVO_LIST_CACHE.hit()
+    return entry.page, True
+  
+  page = handle_response(res)
+  if page.get('status', None) != 'FAILURE':
+    BRIVO_LIST_CACHE.put(key, res, page)
+  
+  return page, False
 
-def brivo_update_user(env, partner_rec):
+class BrivoListError(Exception):
   '''
-    Update a brivo user
+    Raised by `brivo_iter_list` when a page cannot be fetched.
+  '''
+  def __init__(self, path, offset, res):
+    super().__init__(f'Could not list {path} at offset {offset}: {res.get("error")}')
+    self.path = path
+    self.offset = offset
+    self.res = res
+
+def brivo_iter_list(env, path, params=None, page_size=const.BRIVO_PAGE_SIZE, prefetch=False):
+  '''
+    Yields the items of a paginated Brivo list as the pages arrive, holding at most two pages
+    in memory. Pages are revalidated with conditional GETs, see `_get_page`.
     Input:
-      - env. An object environment, passed into `_set_api_headers` to generate the API call headers.
-      - partner_rec. A res.partner record.
-      
+      - env. An object environment or a `BrivoConnection`.
+      - path. The path of the list endpoint, relative to `API_STUB`.
+      - params. Query parameters besides the pagination ones, e.g. a filter.
+      - page_size. The number of items requested per page.
+      - prefetch. Whether the next page is fetched on a thread while the items of the current
+        one are consumed. Worth it when processing a page takes about as long as fetching one.
     Output:
-      A response from Brivo's API.
+      A generator of the items. Raises a `BrivoListError` if a page cannot be fetched, after
+      the items of the previous pages were yielded.
+  '''
+  conn = brivo_connection(env)
+  params = dict(params or {})
+  executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='brivo-list') if prefetch else None
+  fetch = attributed(_get_page)
+  
+  def request(offset):
+    # Returns a callable giving the page, its fetch being already started when prefetching
+    args = (conn, path, dict(params, offset=offset, pageSize=page_size))
+    return executor.submit(fetch, *args).result if executor else lambda: _get_page(*args)
+  
+  start = time.monotonic()
+  offset = items = pages = unchanged_pages = 0
+  pending = request(0)
+  
+  try:
+    while pending:
+      page, unchanged = pending()
+      if page.get('status', None) == 'FAILURE':
+        raise BrivoListError(path, offset, page)
+      
+      data = page.get('data') or []
+      pages += 1
+      unchanged_pages += unchanged
+      
+      next_offset = offset + len(data)
+      last = len(data) < page_size or next_offset >= page.get('count', next_offset + 1)
+      pending = None if last else request(next_offset)
+      
+      items += len(data)
+      yield from data
+      offset = next_offset
+  finally:
+    if executor:
+      executor.shutdown(wait=False, cancel_futures=True)
+  
+  _logger.info(f'Brivo List {path}: {items} items in {pages} pages ({unchanged_pages} unchanged) '
+               f'in {(time.monotonic() - start) * 1000:.0f}ms')
+
+def brivo_user_projection(partner_rec):
+  '''
+    Returns the user fields Brivo stores for a partner.
+    Input:
+      partner_rec. A res.partner record or a `BrivoPartner` snapshot.
   '''
-  first_name = partner_rec.name.split(' ')[0]
-  last_name = partner_rec.name.split(' ')[1]
+  # The first word is the first name, the remaining words make up the last name
+  name_parts = (partner_rec.name or '').split()
+  first_name = name_parts[0] if name_parts else ''
+  last_name = ' '.join(name_parts[1:])
   emails = [{ 'address': partner_rec.email, 'type': 'personal' }] if partner_rec.email else []
   
-  body = {
+  return {
     'firstName': first_name,
     'lastName': last_name,
     'emails': emails
   }
+
+def brivo_user_fingerprint(partner_rec):
+  '''
+    Returns a digest of `brivo_user_projection`, stored on the partner once pushed so that
+    writes leaving the Brivo fields unchanged do not call Brivo.
+  '''
+  projection = json.dumps(brivo_user_projection(partner_rec), sort_keys=True)
+  return hashlib.sha1(projection.encode('utf-8')).hexdigest()
+
+def brivo_create_user(env, partner_rec):
+  '''
+    Create a Brivo user.
+    Input:
+      - env. An object environment, passed into `_set_api_headers` to generate the API call headers.
+      - partner_rec. A res.partner record or a `BrivoPartner` snapshot.
+    
+    Output:
+      A response from Brivo's API.
+  '''
+  body = dict(brivo_user_projection(partner_rec), externalId=str(partner_rec.id))
   
-  headers = _set_api_headers(env)
-  
-  if headers.get('status', None) == 'FAILURE':
-    return headers
+  return _call_api(env, 'POST', '/v1/api/users', json=body)
+
+def brivo_delete_user(env, brivo_user_id):
+  '''
+    Deletes a user from Brivo
+  '''
+  return _call_api(env, 'DELETE', f'/v1/api/users/{brivo_user_id}', no_content=True)
 
-  return handle_response(requests.put(f'{API_STUB}/v1/api/users/{partner_rec.brivo_id}', json=body, headers=headers))
+def brivo_update_user(env, partner_rec):
+  '''
+    Update a brivo user
+    Input:
+      - env. An object environment, passed into `_set_api_headers` to generate the API call headers.
+      - partner_rec. A res.partner record or a `BrivoPartner` snapshot.
+    
+    Output:
+      A response from Brivo's API.
+  '''
+  body = brivo_user_projection(partner_rec)
+  
+  return _call_api(env, 'PUT', f'/v1/api/users/{partner_rec.brivo_id}', json=body)
 
 def brivo_create_barcode_credential(env, barcode):
   '''
@@ -144,34 +481,19 @@ def brivo_create_barcode_credential(env, barcode):
     'encodedCredential': barcode
   }
   
-  headers = _set_api_headers(env)
-  
-  if headers.get('status', None) == 'FAILURE':
-    return headers
-  
-  return handle_response(requests.post(f'{API_STUB}/v1/api/credentials', json=body, headers=headers))
+  return _call_api(env, 'POST', '/v1/api/credentials', json=body)
 
 def brivo_delete_barcode_credential(env, brivo_cred_id):
   '''
     Deletes a credential in Brivo.
   '''
-  headers = _set_api_headers(env)
-  
-  if headers.get('status', None) == 'FAILURE':
-    return headers
-  
-  return handle_response(requests.delete(f'{API_STUB}/v1/api/credentials/{brivo_cred_id}', headers=headers), no_content=True)
+  return _call_api(env, 'DELETE', f'/v1/api/credentials/{brivo_cred_id}', no_content=True)
 
 def brivo_assign_credential(env, brivo_user_id, brivo_credential_id):
   '''
     Assigns a credential in Brivo to a user.
   '''
-  headers = _set_api_headers(env)
-  
-  if headers.get('status', None) == 'FAILURE':
-    return headers
-  
-  return handle_response(requests.put(f'{API_STUB}/v1/api/users/{brivo_user_id}/credentials/{brivo_credential_id}', headers=headers), no_content=True)
+  return _call_api(env, 'PUT', f'/v1/api/users/{brivo_user_id}/credentials/{brivo_credential_id}', no_content=True)
 
 def brivo_create_group(env, group_name):
   '''
@@ -179,7 +501,7 @@ def brivo_create_group(env, group_name):
     Input:
       - env. An Odoo environment, used to create headers.
       - group_name. The name for the group.
-      
+    
     Return:
       A response from Brivo of the form:
       
@@ -191,75 +513,260 @@ def brivo_create_group(env, group_name):
         "excludedFromLockdown" : false
       }
   '''
-  headers = _set_api_headers(env)
-  
-  if headers.get('status', None) == 'FAILURE':
-    return headers
-  
   payload = {
     'name' : group_name
   }
   
-  return handle_response(requests.post(f'{API_STUB}/v1/api/groups', headers=headers, json=payload))
+  return _call_api(env, 'POST', '/v1/api/groups', json=payload)
 
-def brivo_list_groups(env):
+def brivo_list_groups(env, offset=0, page_size=const.BRIVO_PAGE_SIZE):
   '''
-    List groups in Brivo
+    List a page of groups in Brivo
+    Input:
+      - env. An object environment or a `BrivoConnection`.
+      - offset. The number of groups to skip.
+      - page_size. The maximum number of groups to return.
+    Output:
+      A response from Brivo of the form { "data": [...], "offset": 0, "pageSize": 100, "count": 250 }
   '''
-  headers = _set_api_headers(env)
-  
-  if headers.get('status', None) == 'FAILURE':
-    return headers
-  
-  return handle_response(requests.get(f'{API_STUB}/v1/api/groups', headers=headers))
+  return _get_page(env, '/v1/api/groups', { 'offset': offset, 'pageSize': page_size })[0]
+
+def brivo_list_users(env, offset=0, page_size=const.BRIVO_PAGE_SIZE):
+  '''
+    List a page of users in Brivo
+    Output:
+      A response from Brivo of the form { "data": [...], "offset": 0, "pageSize": 100, "count": 250 }
+  '''
+  return _get_page(env, '/v1/api/users', { 'offset': offset, 'pageSize': page_size })[0]
+
+def brivo_list_credentials(env, offset=0, page_size=const.BRIVO_PAGE_SIZE):
+  '''
+    List a page of credentials in Brivo
+    Output:
+      A response from Brivo of the form { "data": [...], "offset": 0, "pageSize": 100, "count": 250 }
+  '''
+  return _get_page(env, '/v1/api/credentials', { 'offset': offset, 'pageSize': page_size })[0]
+
+def brivo_list_group_users(env, brivo_group_id, offset=0, page_size=const.BRIVO_PAGE_SIZE):
+  '''
+    List a page of the users of a group in Brivo
+    Output:
+      A response from Brivo of the form { "data": [...], "offset": 0, "pageSize": 100, "count": 250 }
+  '''
+  return _get_page(env, f'/v1/api/groups/{brivo_group_id}/users', { 'offset': offset, 'pageSize': page_size })[0]
+
+def brivo_iter_groups(env, **kwargs):
+  '''
+    Yields every group in Brivo, see `brivo_iter_list` for the keyword arguments.
+  '''
+  return brivo_iter_list(env, '/v1/api/groups', **kwargs)
+
+def brivo_iter_users(env, **kwargs):
+  '''
+    Yields every user in Brivo, see `brivo_iter_list` for the keyword arguments.
+  '''
+  return brivo_iter_list(env, '/v1/api/users', **kwargs)
+
+def brivo_iter_credentials(env, **kwargs):
+  '''
+    Yields every credential in Brivo, see `brivo_iter_list` for the keyword arguments.
+  '''
+  return brivo_iter_list(env, '/v1/api/credentials', **kwargs)
+
+def brivo_iter_group_users(env, brivo_group_id, **kwargs):
+  '''
+    Yields every user of a group in Brivo, see `brivo_iter_list` for the keyword arguments.
+  '''
+  return brivo_iter_list(env, f'/v1/api/groups/{brivo_group_id}/users', **kwargs)
 
 def brivo_remove_from_group(env, brivo_group_id, brivo_user_id):
   '''
     Remove a partner from a group in Brivo.
   '''
-  headers = _set_api_headers(env)
-  
-  if headers.get('status', None) == 'FAILURE':
-    return headers
-  
-  return handle_response(requests.delete(f'{API_STUB}/v1/api/groups/{brivo_group_id}/users/{brivo_user_id}', headers=headers), no_content=True)
+  return _call_api(env, 'DELETE', f'/v1/api/groups/{brivo_group_id}/users/{brivo_user_id}', no_content=True)
 
 def brivo_add_to_group(env, brivo_group_id, brivo_user_id):
   '''
     Remove a partner from a group in Brivo.
   '''
-  headers = _set_api_headers(env)
+  return _call_api(env, 'PUT', f'/v1/api/groups/{brivo_group_id}/users/{brivo_user_id}', no_content=True)
+
+def brivo_list_user_groups(env, brivo_user_id, offset=0, page_size=const.BRIVO_PAGE_SIZE):
+  '''
+    List a page of the groups of a Brivo user.
+    Output:
+      A response from Brivo of the form { "data": [...], "offset": 0, "pageSize": 100, "count": 2 }
+  '''
+  return _get_page(env, f'/v1/api/users/{brivo_user_id}/groups', { 'offset': offset, 'pageSize': page_size })[0]
+
+def brivo_list_access_events(env, since=None, offset=0, page_size=const.BRIVO_PAGE_SIZE):
+  '''
+    List a page of the access events (door activity) of the account.
+    Input:
+      - env. An object environment or a `BrivoConnection`.
+      - since. An ISO 8601 UTC timestamp; only the events that occurred at or after it are listed.
+    Output:
+      A response from Brivo of the form { "data": [...], "offset": 0, "pageSize": 100, "count": 250 },
+      each event being of the form:
+      
+      {
+        "uuid"           : "4f0c5d1e-...",
+        "occurred"       : "2026-10-18T07:15:02Z",
+        "actor"          : { "id": 8219006, "externalId": "42" },
+        "eventObject"    : { "id": 77, "name": "Front Door" },
+        "securityAction" : { "securityActionId": 2004, "action": "Access Granted", "exception": false }
+      }
+  '''
+  params = { 'offset': offset, 'pageSize': page_size }
+  if since:
+    params['filter'] = f'occurred__gte:{since}'
   
-  if headers.get('status', None) == 'FAILURE':
-    return headers
+  return _call_api(env, 'GET', '/v1/api/events/access', params=params)
+
+def brivo_fetch_user_state(env, brivo_user_id):
+  '''
+    Retrieves the suspended status and the groups of a Brivo user.
+    Output:
+      An object of the form { 'status': 'SUCCESS', 'suspended': False, 'brivo_group_ids': [8219006] }
+  '''
+  susp_res = brivo_query_suspended_status(env, brivo_user_id)
+  
+  if susp_res.get('status', None) == 'FAILURE':
+    return susp_res
   
-  return handle_response(requests.put(f'{API_STUB}/v1/api/groups/{brivo_group_id}/users/{brivo_user_id}', headers=headers), no_content=True)
+  groups_res = brivo_list_user_groups(env, brivo_user_id)
+  
+  if groups_res.get('status', None) == 'FAILURE':
+    return groups_res
+  
+  return {
+    'status': 'SUCCESS',
+    'suspended': susp_res['suspended'],
+    'brivo_group_ids': [g['id'] for g in groups_res.get('data') or []]
+  }
 
 def brivo_query_suspended_status(env, brivo_user_id):
   '''
     Retrieves the suspended status of a Brivo user.
   '''
-  headers = _set_api_headers(env)
-  
-  if headers.get('status', None) == 'FAILURE':
-    return headers
-  
-  return handle_response(requests.get(f'{API_STUB}/v1/api/users/{brivo_user_id}/suspended', headers=headers))
+  return _call_api(env, 'GET', f'/v1/api/users/{brivo_user_id}/suspended')
 
 def brivo_toggle_suspended_status(env, brivo_user_id, suspend):
   '''
     Toggles the suspended status of a Brivo user.
   '''
-  headers = _set_api_headers(env)
-  
-  if headers.get('status', None) == 'FAILURE':
-    return headers
-  
   payload = {
     "suspended": suspend
   }
   
-  return handle_response(requests.put(f'{API_STUB}/v1/api/users/{brivo_user_id}/suspended', headers=headers, json=payload))
+  return _call_api(env, 'PUT', f'/v1/api/users/{brivo_user_id}/suspended', json=payload)
+
+def brivo_provision_user(env, partner_rec):
+  '''
+    Creates a Brivo user for a partner, along with a barcode credential assigned to it.
+    Input:
+      - env. An object environment or a `BrivoConnection`.
+      - partner_rec. A res.partner record or a `BrivoPartner` snapshot.
+    Output:
+      An object holding the partner values to store (`brivo_id`, `brivo_barcode_credential_id`).
+      On failure, its status is FAILURE and it still holds the values of the steps that
+      succeeded, so that a retry does not create the user twice.
+  '''
+  user_res = brivo_create_user(env, partner_rec)
+  
+  if user_res.get('status', None) == 'FAILURE':
+    return { 'status': 'FAILURE', 'error': f'Cannot create user on Brivo! {user_res.get("error", "")}' }
+  
+  vals = { 'brivo_id': user_res['id'] }
+  
+  if not partner_rec.barcode:
+    return dict(vals, status='SUCCESS')
+  
+  cred_res = brivo_issue_barcode_credential(env, user_res['id'], partner_rec.barcode)
+  return dict(cred_res, **vals)
+
+def brivo_issue_barcode_credential(env, brivo_user_id, barcode):
+  '''
+    Creates a barcode credential and assigns it to a Brivo user.
+    Output:
+      An object holding `brivo_barcode_credential_id` once the credential is created.
+  '''
+  barcode_res = brivo_create_barcode_credential(env, barcode)
+  
+  if barcode_res.get('status', None) == 'FAILURE':
+    return { 'status': 'FAILURE', 'error': f'Cannot create user credential on Brivo! {barcode_res.get("error", "")}' }
+  
+  vals = { 'brivo_barcode_credential_id': barcode_res['id'] }
+  assign_res = brivo_assign_credential(env, brivo_user_id, barcode_res['id'])
+  
+  if assign_res.get('status', None) == 'FAILURE':
+    return dict(vals, status='FAILURE', error=f'Cannot assign credential to user on Brivo! {assign_res.get("error", "")}')
+  
+  return dict(vals, status='SUCCESS')
+
+def brivo_find_barcode_credential(env, barcode):
+  '''
+    Looks up the credential of a barcode in Brivo, by its `referenceId`.
+    Output:
+      An object of the form { 'status': 'SUCCESS', 'id': 4211 }, with a null `id` if there is none.
+  '''
+  res = _call_api(env, 'GET', '/v1/api/credentials', params={ 'filter': f'referenceId__eq:{barcode}', 'pageSize': 1 })
+  
+  if res.get('status', None) == 'FAILURE':
+    return res
+  
+  credentials = [c for c in res.get('data') or [] if c.get('referenceId') == barcode]
+  return { 'status': 'SUCCESS', 'id': credentials[0]['id'] if credentials else None }
+
+def brivo_rotate_barcode_credential(env, partner_rec):
+  '''
+    Replaces the barcode credential of a partner's Brivo user with one matching its current barcode.
+    
+    The credential of the barcode is reused when it already exists on Brivo, and is assigned
+    before the old one is deleted, so the member never goes without a working credential.
+    Input:
+      - env. An object environment or a `BrivoConnection`.
+      - partner_rec. A res.partner record or a `BrivoPartner` snapshot.
+    Output:
+      An object holding the new `brivo_barcode_credential_id`. If the old credential could
+      not be deleted, it is returned as `stale_brivo_credential_id` to be deleted later.
+  '''
+  old_cred_id = partner_rec.brivo_barcode_credential_id
+  
+  if not partner_rec.barcode:
+    if old_cred_id:
+      res = brivo_delete_barcode_credential(env, old_cred_id)
+      if res.get('status', None) == 'FAILURE' and res.get('status_code') != 404:
+        return { 'status': 'FAILURE', 'error': f'Cannot delete user credential on Brivo! {res.get("error", "")}' }
+    return { 'status': 'SUCCESS', 'brivo_barcode_credential_id': False }
+  
+  find_res = brivo_find_barcode_credential(env, partner_rec.barcode)
+  if find_res.get('status', None) == 'FAILURE':
+    return { 'status': 'FAILURE', 'error': f'Cannot look up user credential on Brivo! {find_res.get("error", "")}' }
+  
+  if find_res['id']:
+    cred_res = { 'brivo_barcode_credential_id': find_res['id'] }
+    assign_res = brivo_assign_credential(env, partner_rec.brivo_id, find_res['id'])
+    if assign_res.get('status', None) == 'FAILURE':
+      return dict(cred_res, status='FAILURE', error=f'Cannot assign credential to user on Brivo! {assign_res.get("error", "")}')
+  else:
+    cred_res = brivo_issue_barcode_credential(env, partner_rec.brivo_id, partner_rec.barcode)
+    if cred_res.get('status', None) == 'FAILURE':
+      # The old credential stays the recorded one. A credential created but not assigned
+      # is found by its barcode and reused on retry.
+      return { 'status': 'FAILURE', 'error': cred_res['error'] }
+  
+  new_cred_id = cred_res['brivo_barcode_credential_id']
+  res = { 'status': 'SUCCESS', 'brivo_barcode_credential_id': new_cred_id }
+  
+  # Only now that the new credential is assigned, revoke the old one
+  if old_cred_id and old_cred_id != new_cred_id:
+    delete_res = brivo_delete_barcode_credential(env, old_cred_id)
+    if delete_res.get('status', None) == 'FAILURE' and delete_res.get('status_code') != 404:
+      _logger.warning(f'Brivo credential {old_cred_id} could not be deleted after its rotation: {delete_res.get("error")}')
+      res['stale_brivo_credential_id'] = old_cred_id
+  
+  return res
 
 def handle_response(res : requests.Response, no_content=False):
   '''
@@ -270,21 +777,22 @@ def handle_response(res : requests.Response, no_content=False):
       res: The raw response object for an API call.
       no_content: If true, the function will not attempt to parse the response body.
   '''
-  _logger.info(f'Brivo API Call to {res.request.method} {res.url} with data {res.request.body}')
+  # Request bodies hold personal data and credentials, they are never logged
+  _logger.debug(f'Brivo API Call to {res.request.method} {res.url} returned {res.status_code} '
+                f'in {res.elapsed.total_seconds() * 1000:.0f}ms')
   
   try:
     if not res.ok:
       res.raise_for_status()
   except Exception as err:
     _logger.error(str(err))
-    _logger.error(res.json())
-    return { 'status': 'FAILURE', 'error': str(err) }
-
+    # Error bodies of gateways and rate limiters are not always JSON
+    _logger.error(res.text)
+    return { 'status': 'FAILURE', 'error': str(err), 'status_code': res.status_code }
+  
   try:
     if not no_content:
-      res_data = res.json()
-      _logger.info('Response from Brivo: %s', res_data)
-      return res_data
+      return res.json()
     else:
       return { 'status': 'SUCCESS' }
   except Exception as err:
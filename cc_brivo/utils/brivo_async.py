@@ -0,0 +1,154 @@
+# All Rights Reserved
+# You may not use, distribute and modify this code without the express written consent of clubcloud, LLC.
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from . import const
+from .metrics import attributed, current_stats
+from .brivo import (brivo_connection, brivo_create_user, brivo_update_user, brivo_delete_user, brivo_provision_user,
+                    brivo_create_barcode_credential, brivo_delete_barcode_credential, brivo_assign_credential,
+                    brivo_find_barcode_credential, brivo_issue_barcode_credential, brivo_rotate_barcode_credential,
+                    brivo_create_group, brivo_list_groups, brivo_list_users, brivo_list_credentials, brivo_list_group_users,
+                    brivo_list_user_groups, brivo_add_to_group, brivo_remove_from_group, brivo_fetch_user_state,
+                    brivo_query_suspended_status, brivo_toggle_suspended_status)
+
+_logger = logging.getLogger(__name__)
+
+def _operation(fn):
+  async def call(self, *args, **kwargs):
+    return await self.run(fn, *args, **kwargs)
+  call.__name__ = fn.__name__.removeprefix('brivo_')
+  call.__doc__ = f'Awaitable `{fn.__name__}`, taking the same arguments without the connection.'
+  return call
+
+class AsyncBrivoClient:
+  '''
+    Awaitable version of the Brivo helpers, for batch operations that are mostly network wait.
+    
+    Up to `concurrency` calls are in flight at once, `BRIVO_ASYNC_CONCURRENCY` at most, since
+    some calls open a database cursor. Each call goes through `utils/brivo.py`
+    on a thread of the client, so it shares the pooled session, the token cache, the rate
+    limit, the retries and the metrics of the synchronous helpers. For calls to reuse
+    connections, the HTTP pool size of the settings should be at least `concurrency`.
+    
+    Results are returned to the calling coroutine, which maps them back to records in the
+    thread owning the Odoo environment, ideally in one batched write.
+    
+    Usage:
+      async with AsyncBrivoClient(env) as client:
+        results = await client.gather(client.fetch_user_state(brivo_id) for brivo_id in brivo_ids)
+  '''
+  def __init__(self, env, concurrency=None, account_id=False):
+    # Read the settings now, records cannot be read from the client threads
+    self.conn = brivo_connection(env, account_id)
+    self.concurrency = min(concurrency or const.BRIVO_ASYNC_CONCURRENCY, const.BRIVO_ASYNC_CONCURRENCY)
+    # Calls run on the client threads are attributed to the request or cron creating the client
+    self._stats = current_stats()
+    self._executor = None
+    self._semaphore = None
+  
+  async def __aenter__(self):
+    self._executor = ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix='brivo')
+    self._semaphore = asyncio.Semaphore(self.concurrency)
+    return self
+  
+  async def __aexit__(self, *exc):
+    self._executor.shutdown(wait=True)
+    self._executor = self._semaphore = None
+  
+  async def run(self, fn, *args, **kwargs):
+    '''
+      Await `fn(conn, *args, **kwargs)`, any helper taking a `BrivoConnection` first, e.g. a
+      composite operation. Exceptions are returned as FAILURE results.
+    '''
+    async with self._semaphore:
+      try:
+        return await asyncio.get_running_loop().run_in_executor(self._executor, attributed(lambda: fn(self.conn, *args, **kwargs), self._stats))
+      except Exception as err:
+        _logger.exception(f'Brivo Async Client: {fn.__name__} raised an error')
+        return { 'status': 'FAILURE', 'error': str(err) or repr(err) }
+  
+  async def gather(self, calls):
+    '''
+      Await an iterable of calls of this client. Output: their results, in order.
+    '''
+    return await asyncio.gather(*calls)
+  
+  # Users
+  create_user = _operation(brivo_create_user)
+  update_user = _operation(brivo_update_user)
+  delete_user = _operation(brivo_delete_user)
+  provision_user = _operation(brivo_provision_user)
+  list_users = _operation(brivo_list_users)
+  
+  # Credentials
+  create_barcode_credential = _operation(brivo_create_barcode_credential)
+  delete_barcode_credential = _operation(brivo_delete_barcode_credential)
+  assign_credential = _operation(brivo_assign_credential)
+  find_barcode_credential = _operation(brivo_find_barcode_credential)
+  issue_barcode_credential = _operation(brivo_issue_barcode_credential)
+  rotate_barcode_credential = _operation(brivo_rotate_barcode_credential)
+  list_credentials = _operation(brivo_list_credentials)
+  
+  # Groups
+  create_group = _operation(brivo_create_group)
+  list_groups = _operation(brivo_list_groups)
+  list_group_users = _operation(brivo_list_group_users)
+  list_user_groups = _operation(brivo_list_user_groups)
+  add_to_group = _operation(brivo_add_to_group)
+  remove_from_group = _operation(brivo_remove_from_group)
+  
+  # Suspension
+  fetch_user_state = _operation(brivo_fetch_user_state)
+  query_suspended_status = _operation(brivo_query_suspended_status)
+  toggle_suspended_status = _operation(brivo_toggle_suspended_status)
+
+def _gather_calls(client, calls):
+  return client.gather(
+    getattr(client, op)(*args) if isinstance(op, str) else client.run(op, *args)
+    for op, *args in calls
+  )
+
+def run_brivo_batch(env, calls, concurrency=None, account_id=False):
+  '''
+    Synchronous entry point for crons and wizards: run a batch of Brivo calls with up to
+    `concurrency` in flight, and wait for all of them.
+    Input:
+      - env. An object environment or a `BrivoConnection`.
+      - calls. An iterable of (operation, *args), an operation being the name of an
+        `AsyncBrivoClient` method or a function taking a `BrivoConnection` first.
+      - account_id. The Brivo account to call, see `brivo_connection`.
+    Output:
+      The results of the calls, in order.
+  '''
+  client = AsyncBrivoClient(env, concurrency, account_id)
+  
+  async def main():
+    async with client:
+      return await _gather_calls(client, calls)
+  
+  return asyncio.run(main())
+
+def run_brivo_account_batches(env, calls_by_account, concurrency=None):
+  '''
+    Run the batches of several Brivo accounts at the same time, each with its own client,
+    so that a large batch of one account does not delay the others. The accounts share
+    `concurrency` calls in flight.
+    Input:
+      - calls_by_account. A dict { account ID: calls }, see `run_brivo_batch`.
+    Output:
+      A dict { account ID: the results of its calls, in order }.
+  '''
+  per_account = max((concurrency or const.BRIVO_ASYNC_CONCURRENCY) // max(len(calls_by_account), 1), 1)
+  clients = { account_id: AsyncBrivoClient(env, per_account, account_id) for account_id in calls_by_account }
+  
+  async def run(account_id):
+    async with clients[account_id] as client:
+      return await _gather_calls(client, calls_by_account[account_id])
+  
+  async def main():
+    results = await asyncio.gather(*(run(account_id) for account_id in clients))
+    return dict(zip(clients, results))
+  
+  return asyncio.run(main())
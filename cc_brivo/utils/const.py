@@ -1,4 +1,96 @@
 # Key for the main member group in Brivo, saved in ir config system parameters
 IR_CONFIG_MEMBER_KEY = 'brivo.member.group'
 # Key for the premium member group in Brivo, saved in ir config system parameters
-IR_CONFIG_PREM_MEMBER_KEY = 'brivo.prem.member.group'
\ No newline at end of file
+IR_CONFIG_PREM_MEMBER_KEY = 'brivo.prem.member.group'
+# Seconds before expiry at which a cached Brivo access token is renewed
+BRIVO_TOKEN_REFRESH_MARGIN = 60
+# Lifetime assumed for a Brivo access token when the token response omits `expires_in`
+BRIVO_TOKEN_DEFAULT_LIFETIME = 300
+# Default size of the per-process Brivo HTTP connection pool
+BRIVO_HTTP_POOL_SIZE = 10
+# Default connect and read timeouts (in seconds) for calls to Brivo
+BRIVO_CONNECT_TIMEOUT = 5.0
+BRIVO_READ_TIMEOUT = 30.0
+# Brivo job queue: attempts before a job is marked as failed, and the retry backoff bounds (in seconds)
+BRIVO_JOB_MAX_ATTEMPTS = 8
+BRIVO_JOB_RETRY_BASE = 30
+BRIVO_JOB_RETRY_MAX = 3600
+# Seconds a single run of the Brivo job cron may spend before yielding to the next run
+BRIVO_JOB_CRON_TIME_BUDGET = 240
+# Days finished Brivo jobs are kept before being vacuumed
+BRIVO_JOB_RETENTION_DAYS = 30
+# Seconds during which membership changes of a partner and group are collapsed before being sent to Brivo
+BRIVO_MEMBERSHIP_DEBOUNCE = 30
+# Number of Brivo jobs claimed per batch, and how many of them run in parallel
+BRIVO_JOB_BATCH_SIZE = 50
+BRIVO_JOB_CONCURRENCY = 8
+# Brivo calls in flight at once in the async client of batch operations, shared by all the accounts
+# of a batch. Calls rarely open a database cursor (rate limit refills, token renewals, metrics flushes)
+BRIVO_ASYNC_CONCURRENCY = 64
+# Number of items requested per page from Brivo list endpoints
+BRIVO_PAGE_SIZE = 100
+# Pages of Brivo lists kept per worker with their ETag/Last-Modified, to be revalidated with a conditional GET
+BRIVO_LIST_CACHE_SIZE = 512
+# Key for the digest of the groups seen by the last Brivo group sync, saved in ir config system parameters
+IR_CONFIG_GROUPS_SYNC_HASH = 'brivo.groups.sync.hash'
+# Time of the most recent Brivo access event imported as a check-in
+IR_CONFIG_CHECKINS_WATERMARK = 'brivo.checkins.watermark'
+# Progress of an unfinished check-in import (window start, offset reached, newest event), resumed by the next run
+IR_CONFIG_CHECKINS_CURSOR = 'brivo.checkins.cursor'
+# Days of access events imported by the first check-in import
+BRIVO_CHECKIN_INITIAL_DAYS = 1
+# Seconds of access events read again before the watermark, for events Brivo records late
+BRIVO_CHECKIN_OVERLAP = 300
+# Number of members moved per committed chunk by a Brivo group reassignment
+BRIVO_REASSIGNMENT_CHUNK_SIZE = 200
+# Number of partners provisioned per committed chunk of a Brivo onboarding
+BRIVO_ONBOARDING_CHUNK_SIZE = 200
+# Seconds during which the cached Brivo state of a partner (suspension, groups) is used without asking Brivo
+BRIVO_STATE_TTL = 3600
+# Entries and lifetime (seconds) of the in-process index of Brivo IDs to partners
+BRIVO_ID_INDEX_SIZE = 50000
+BRIVO_ID_INDEX_TTL = 300
+# Days an invoice of an active membership may be overdue before the member is suspended on Brivo
+BRIVO_OVERDUE_GRACE_DAYS = 7
+# Default client-side rate limit shared by all workers (requests per second, 0 disables it) and its burst size
+BRIVO_RATE_LIMIT = 10.0
+BRIVO_RATE_BURST = 20
+# Rate limit slots taken from the shared bucket per database round trip, and seconds after which
+# the slots a worker took but did not use are dropped
+BRIVO_RATE_BATCH_SIZE = 10
+BRIVO_RATE_BATCH_TTL = 1.0
+# Longest wait (in seconds) for a rate limit slot before a call fails locally
+BRIVO_RATE_MAX_WAIT = 30
+# Retries of idempotent calls on 429/5xx and network errors, with jittered exponential backoff (in seconds)
+BRIVO_MAX_RETRIES = 3
+BRIVO_RETRY_BASE_DELAY = 0.5
+BRIVO_RETRY_MAX_DELAY = 10
+# Consecutive failures opening the circuit breaker, and seconds before a trial call is let through
+BRIVO_CIRCUIT_THRESHOLD = 5
+BRIVO_CIRCUIT_COOLDOWN = 30
+# Headers authenticating Brivo event subscription calls: the hex HMAC-SHA256 of the body keyed with
+# the webhook secret of an account, or the secret itself for subscriptions that only send static headers
+BRIVO_WEBHOOK_SIGNATURE_HEADER = 'X-Brivo-Signature'
+BRIVO_WEBHOOK_TOKEN_HEADER = 'X-Brivo-Webhook-Token'
+# Number of received Brivo events applied per transaction
+BRIVO_EVENT_BATCH_SIZE = 500
+# Brivo event types (lower case) applied to the local state; other events are stored and ignored
+BRIVO_EVENT_GROUP_UPSERT = ('group.created', 'group.updated')
+BRIVO_EVENT_GROUP_DELETE = ('group.deleted',)
+BRIVO_EVENT_USER_SUSPENDED = ('user.suspended',)
+BRIVO_EVENT_USER_UNSUSPENDED = ('user.unsuspended',)
+BRIVO_EVENT_CREDENTIAL_ASSIGNED = ('user.credential.assigned',)
+BRIVO_EVENT_CREDENTIAL_UNASSIGNED = ('user.credential.unassigned',)
+# Default duration (in milliseconds) above which a Brivo call is logged as a warning
+BRIVO_SLOW_CALL_MS = 2000
+# Upper bounds (in milliseconds) of the Brivo call latency histogram buckets
+BRIVO_LATENCY_BUCKETS_MS = (50, 100, 250, 500, 1000, 2500, 5000, 10000)
+# Seconds between two flushes of the in-process Brivo call metrics to the database
+BRIVO_METRICS_FLUSH_INTERVAL = 60
+# Records per shard of a Brivo batch, and per committed chunk of a shard
+BRIVO_BATCH_SHARD_SIZE = 2000
+BRIVO_BATCH_CHUNK_SIZE = 200
+# Failed chunks of a Brivo batch shard before the shard is marked as failed
+BRIVO_BATCH_MAX_ATTEMPTS = 3
+# Days without any change to the orders of a partner provisioned for a quotation before its Brivo user is deleted
+BRIVO_PREPROVISION_RETENTION_DAYS = 14
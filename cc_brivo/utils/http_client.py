@@ -0,0 +1,66 @@
+# All Rights Reserved
+# You may not use, distribute and modify this code without the express written consent of clubcloud, LLC. 
+import os
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from . import const
+
+# One client per Brivo account and worker process, keyed by credential key. The pid is checked
+# on every lookup so that prefork workers never share the sockets of the process they were
+# forked from, and each account gets its own pool so a busy account cannot exhaust another's.
+_CLIENTS : dict = {}
+_CLIENT_LOCK = threading.Lock()
+
+class BrivoHttpClient:
+  '''
+    Owns a pooled, keep-alive `requests.Session` used for every call to Brivo.
+    Sessions are safe to share between the threads of a worker for plain requests,
+    and every call gets a connect/read timeout so a slow endpoint cannot hold a worker forever.
+  '''
+  def __init__(self, pool_size, connect_timeout, read_timeout):
+    self.pid = os.getpid()
+    self.config = (pool_size, connect_timeout, read_timeout)
+    self.timeout = (connect_timeout, read_timeout)
+    
+    self.session = requests.Session()
+    # Brivo is reached through two hosts (auth and api), plus a local stand-in when testing.
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size)
+    self.session.mount('https://', adapter)
+    self.session.mount('http://', adapter)
+    self.session.headers['Connection'] = 'keep-alive'
+  
+  def request(self, method, url, **kwargs):
+    '''
+      Sends a request through the pooled session, applying the default timeouts.
+      Raises `requests.RequestException` on network errors and timeouts.
+    '''
+    kwargs.setdefault('timeout', self.timeout)
+    return self.session.request(method, url, **kwargs)
+  
+  def close(self):
+    self.session.close()
+
+def get_http_client(key=None, pool_size=None, connect_timeout=None, read_timeout=None):
+  '''
+    Returns the HTTP client of `key` (a Brivo account) in the current worker process,
+    (re)creating it after a fork or when the pool configuration changed.
+  '''
+  config = (
+    pool_size or const.BRIVO_HTTP_POOL_SIZE,
+    connect_timeout or const.BRIVO_CONNECT_TIMEOUT,
+    read_timeout or const.BRIVO_READ_TIMEOUT
+  )
+  
+  client = _CLIENTS.get(key)
+  if client and client.pid == os.getpid() and client.config == config:
+    return client
+  
+  with _CLIENT_LOCK:
+    client = _CLIENTS.get(key)
+    if not client or client.pid != os.getpid() or client.config != config:
+      # Sockets of a replaced client are released once in-flight requests drop their reference
+      client = _CLIENTS[key] = BrivoHttpClient(*config)
+    return client
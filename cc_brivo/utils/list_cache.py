@@ -0,0 +1,69 @@
+# All Rights Reserved
+# You may not use, distribute and modify this code without the express written consent of clubcloud, LLC.
+import threading
+from collections import OrderedDict, namedtuple
+
+from . import const
+
+# A page of a Brivo list, with the validators Brivo sent along
+CachedPage = namedtuple('CachedPage', ['etag', 'last_modified', 'page'])
+
+class BrivoListCache:
+  '''
+    Bounded LRU of the pages of Brivo lists, per set of credentials, path and query, shared
+    by the threads of a worker. Pages are only kept when Brivo sent an `ETag` or a
+    `Last-Modified`, so that asking for them again costs a 304 when they are unchanged.
+    Cached pages are shared and must not be modified.
+  '''
+  def __init__(self, size):
+    self.size = size
+    self.lock = threading.Lock()
+    self.entries = OrderedDict()
+    self.hits = self.misses = 0
+  
+  @staticmethod
+  def key(cred_key, path, params):
+    return (cred_key, path, tuple(sorted((k, str(v)) for k, v in (params or {}).items())))
+  
+  def get(self, key):
+    with self.lock:
+      entry = self.entries.get(key)
+      if entry:
+        self.entries.move_to_end(key)
+      return entry
+  
+  def validators(self, entry):
+    '''
+      Returns the conditional headers revalidating `entry`, empty without an entry.
+    '''
+    headers = {}
+    if entry and entry.etag:
+      headers['If-None-Match'] = entry.etag
+    if entry and entry.last_modified:
+      headers['If-Modified-Since'] = entry.last_modified
+    return headers
+  
+  def put(self, key, res, page):
+    '''
+      Stores `page`, the parsed body of `res`, if Brivo sent validators for it.
+    '''
+    etag, last_modified = res.headers.get('ETag'), res.headers.get('Last-Modified')
+    with self.lock:
+      self.misses += 1
+      if not etag and not last_modified:
+        self.entries.pop(key, None)
+        return
+      self.entries[key] = CachedPage(etag, last_modified, page)
+      self.entries.move_to_end(key)
+      while len(self.entries) > self.size:
+        self.entries.popitem(last=False)
+  
+  def hit(self):
+    with self.lock:
+      self.hits += 1
+  
+  def stats(self):
+    with self.lock:
+      return { 'size': len(self.entries), 'hits': self.hits, 'misses': self.misses }
+
+BRIVO_LIST_CACHE = BrivoListCache(const.BRIVO_LIST_CACHE_SIZE)
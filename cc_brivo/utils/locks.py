@@ -0,0 +1,36 @@
+# All Rights Reserved
+# You may not use, distribute and modify this code without the express written consent of clubcloud, LLC.
+import hashlib
+from contextlib import contextmanager
+
+def lock_id(*key):
+  '''
+    Returns the 64-bit PostgreSQL advisory lock ID of `key`, a tuple of strings and numbers.
+  '''
+  return int.from_bytes(hashlib.sha1(repr(key).encode('utf-8')).digest()[:8], 'big', signed=True)
+
+@contextmanager
+def advisory_lock(cr, *key):
+  '''
+    Try to take the session-level advisory lock of `key` on the connection of `cr`, without
+    waiting. Unlike row locks, it is kept across commits, so it covers work committed in
+    several steps, and it is released with the connection if the worker dies.
+    Input:
+      - cr. The cursor of the worker.
+      - key. What is locked, e.g. ('brivo.groups.sync', account_id).
+    Output:
+      Yields True when the lock was taken, False when another worker holds it.
+  '''
+  lid = lock_id(*key)
+  cr.execute('SELECT pg_try_advisory_lock(%s)', [lid])
+  acquired = cr.fetchone()[0]
+  try:
+    yield acquired
+  except Exception:
+    # The transaction may be aborted, and the lock cannot be released before a rollback
+    if acquired:
+      cr.rollback()
+    raise
+  finally:
+    if acquired:
+      cr.execute('SELECT pg_advisory_unlock(%s)', [lid])
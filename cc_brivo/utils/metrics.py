@@ -0,0 +1,200 @@
+# All Rights Reserved
+# You may not use, distribute and modify this code without the express written consent of clubcloud, LLC. 
+import json
+import logging
+import re
+import threading
+import time
+from urllib.parse import urlsplit
+
+import psycopg2
+
+from . import const
+
+_logger = logging.getLogger(__name__)
+
+# Metrics recorded by this process since the last flush, keyed by (method, endpoint)
+_PENDING : dict = {}
+_PENDING_LOCK = threading.Lock()
+_LAST_FLUSH = time.time()
+
+class CallStats:
+  '''
+    Brivo calls attributed to an Odoo request or cron, shared with the worker threads it
+    runs Brivo calls on, see `attributed`.
+  '''
+  def __init__(self):
+    self.count = 0
+    self.time = 0.0
+    self.lock = threading.Lock()
+  
+  def add(self, duration):
+    with self.lock:
+      self.count += 1
+      self.time += duration
+
+def current_stats():
+  '''
+    Returns the call stats the current thread attributes its Brivo calls to.
+  '''
+  thread = threading.current_thread()
+  stats = getattr(thread, 'brivo_call_stats', None)
+  if stats is None:
+    stats = thread.brivo_call_stats = CallStats()
+  return stats
+
+def attributed(fn, stats=None):
+  '''
+    Returns `fn` attributing the Brivo calls it makes to `stats`, by default the call stats of
+    the current thread. Worker threads are not the thread of the request or cron starting
+    them, so functions run on a thread pool must be wrapped for their calls to be counted.
+  '''
+  stats = stats or current_stats()
+  
+  def call(*args, **kwargs):
+    thread = threading.current_thread()
+    previous = getattr(thread, 'brivo_call_stats', None)
+    thread.brivo_call_stats = stats
+    try:
+      return fn(*args, **kwargs)
+    finally:
+      thread.brivo_call_stats = previous
+  return call
+
+def endpoint_of(url):
+  '''
+    Returns the endpoint of a Brivo URL, with IDs replaced by `{id}`, e.g. `/v1/api/users/{id}/suspended`.
+  '''
+  return re.sub(r'/\d+(?=/|$)', '/{id}', urlsplit(url).path)
+
+def _entry(method, url):
+  key = (method, endpoint_of(url))
+  entry = _PENDING.get(key)
+  if entry is None:
+    entry = _PENDING[key] = {
+      'calls': 0,
+      'errors': 0,
+      'retries': 0,
+      'total_ms': 0.0,
+      'max_ms': 0.0,
+      'bytes_sent': 0,
+      'bytes_received': 0,
+      'buckets': [0] * (len(const.BRIVO_LATENCY_BUCKETS_MS) + 1),
+      'statuses': {}
+    }
+  return entry
+
+def record_call(method, url, status, duration, bytes_sent=0, bytes_received=0, slow_ms=None):
+  '''
+    Records one call to Brivo.
+    Input:
+      - method. The HTTP method.
+      - url. The URL called.
+      - status. The HTTP status code, or 'error' for network errors.
+      - duration. The duration of the call in seconds.
+      - slow_ms. The threshold above which the call is logged as a warning.
+  '''
+  duration_ms = duration * 1000
+  
+  # Attribute the time to the enclosing Odoo request or cron
+  current_stats().add(duration)
+  
+  with _PENDING_LOCK:
+    entry = _entry(method, url)
+    entry['calls'] += 1
+    entry['errors'] += 0 if isinstance(status, int) and status < 400 else 1
+    entry['total_ms'] += duration_ms
+    entry['max_ms'] = max(entry['max_ms'], duration_ms)
+    entry['bytes_sent'] += bytes_sent
+    entry['bytes_received'] += bytes_received
+    entry['statuses'][str(status)] = entry['statuses'].get(str(status), 0) + 1
+    
+    bucket = len(const.BRIVO_LATENCY_BUCKETS_MS)
+    for i, bound in enumerate(const.BRIVO_LATENCY_BUCKETS_MS):
+      if duration_ms <= bound:
+        bucket = i
+        break
+    entry['buckets'][bucket] += 1
+  
+  if duration_ms >= (slow_ms or const.BRIVO_SLOW_CALL_MS):
+    _logger.warning(f'Slow Brivo API Call to {method} {endpoint_of(url)}: {duration_ms:.0f}ms, status {status}')
+
+def record_retry(method, url):
+  with _PENDING_LOCK:
+    _entry(method, url)['retries'] += 1
+
+def reset_thread_stats():
+  '''
+    Resets and returns the (call count, time in seconds) attributed to the current thread,
+    including the calls of the worker threads it started. Workers still running keep adding
+    to the previous stats.
+  '''
+  thread = threading.current_thread()
+  stats = getattr(thread, 'brivo_call_stats', None)
+  thread.brivo_call_stats = CallStats()
+  if stats is None:
+    return (0, 0.0)
+  with stats.lock:
+    return (stats.count, stats.time)
+
+def maybe_flush(registry):
+  '''
+    Flushes the metrics of this process once `BRIVO_METRICS_FLUSH_INTERVAL` has elapsed.
+  '''
+  if time.time() - _LAST_FLUSH >= const.BRIVO_METRICS_FLUSH_INTERVAL:
+    flush(registry)
+
+def flush(registry):
+  '''
+    Adds the metrics recorded by this process to the `brivo_api_metric` table, shared by
+    all workers, with its own cursor. Rows are locked while merged so that concurrent
+    flushes do not lose updates.
+  '''
+  global _PENDING, _LAST_FLUSH
+  with _PENDING_LOCK:
+    pending, _PENDING = _PENDING, {}
+    _LAST_FLUSH = time.time()
+  
+  if not pending:
+    return
+  
+  try:
+    with registry.cursor() as cr:
+      for (method, endpoint), entry in sorted(pending.items()):
+        cr.execute('''
+          INSERT INTO brivo_api_metric (method, endpoint, call_count, error_count, retry_count, total_time, max_time,
+                                        bytes_sent, bytes_received, buckets, status_counts, create_date, write_date)
+          VALUES (%s, %s, 0, 0, 0, 0, 0, 0, 0, '[]', '{}', now() at time zone 'UTC', now() at time zone 'UTC')
+          ON CONFLICT (method, endpoint) DO NOTHING
+        ''', [method, endpoint])
+        cr.execute('''
+          SELECT buckets, status_counts
+            FROM brivo_api_metric
+           WHERE method = %s AND endpoint = %s
+             FOR UPDATE
+        ''', [method, endpoint])
+        buckets, statuses = cr.fetchone()
+        
+        buckets = [a + b for a, b in zip(buckets or [0] * len(entry['buckets']), entry['buckets'])]
+        statuses = dict(statuses or {})
+        for status, count in entry['statuses'].items():
+          statuses[status] = statuses.get(status, 0) + count
+        
+        cr.execute('''
+          UPDATE brivo_api_metric
+             SET call_count = call_count + %s,
+                 error_count = error_count + %s,
+                 retry_count = retry_count + %s,
+                 total_time = total_time + %s,
+                 max_time = GREATEST(max_time, %s),
+                 bytes_sent = bytes_sent + %s,
+                 bytes_received = bytes_received + %s,
+                 buckets = %s,
+                 status_counts = %s,
+                 write_date = now() at time zone 'UTC'
+           WHERE method = %s AND endpoint = %s
+        ''', [entry['calls'], entry['errors'], entry['retries'], entry['total_ms'], entry['max_ms'],
+              entry['bytes_sent'], entry['bytes_received'], json.dumps(buckets), json.dumps(statuses),
+              method, endpoint])
+  except psycopg2.Error as err:
+    _logger.warning('Brivo metrics could not be flushed: %s', err)
@@ -0,0 +1,87 @@
+# All Rights Reserved
+# You may not use, distribute and modify this code without the express written consent of clubcloud, LLC. 
+import threading
+import time
+from collections import OrderedDict
+
+from . import const
+
+# Columns of res_partner holding a Brivo ID, per kind of ID
+COLUMNS = {
+  'user': 'brivo_id',
+  'credential': 'brivo_barcode_credential_id'
+}
+
+class BrivoIdIndex:
+  '''
+    Bounded LRU of Brivo IDs to partner IDs, per database, kind of ID and Brivo account,
+    shared by the threads of a worker. Only hits are cached, so a partner linked to a Brivo
+    ID is never hidden by an earlier miss. Entries expire after `BRIVO_ID_INDEX_TTL` seconds, which
+    bounds how long another worker's relinking goes unnoticed; this worker's own writes
+    evict their entries right away.
+  '''
+  def __init__(self, size, ttl):
+    self.size = size
+    self.ttl = ttl
+    self.lock = threading.Lock()
+    self.entries = OrderedDict()
+    self.hits = self.misses = 0
+  
+  def resolve(self, cr, kind, brivo_ids, account_id=False):
+    '''
+      Map Brivo IDs of `kind` ('user' or 'credential') of a Brivo account to partner IDs,
+      reading the ones not cached in a single indexed query.
+      Output:
+        A dict { brivo ID: partner ID }, without the Brivo IDs of no partner.
+    '''
+    column = COLUMNS[kind]
+    brivo_ids = { int(i) for i in brivo_ids if i }
+    now = time.monotonic()
+    res = {}
+    
+    with self.lock:
+      for brivo_id in brivo_ids:
+        key = (cr.dbname, kind, account_id or 0, brivo_id)
+        entry = self.entries.get(key)
+        if entry and entry[1] > now:
+          self.entries.move_to_end(key)
+          res[brivo_id] = entry[0]
+      self.hits += len(res)
+      self.misses += len(brivo_ids) - len(res)
+    
+    missing = list(brivo_ids - set(res))
+    if not missing:
+      return res
+    
+    # The `> 0` condition lets PostgreSQL use the partial indexes on the Brivo IDs
+    cr.execute(f'''
+      SELECT {column}, id
+        FROM res_partner
+       WHERE {column} = ANY(%s)
+         AND {column} > 0
+         AND COALESCE(brivo_account_id, 0) = %s
+    ''', [missing, account_id or 0])
+    found = dict(cr.fetchall())
+    res.update(found)
+    
+    with self.lock:
+      for brivo_id, partner_id in found.items():
+        self.entries[(cr.dbname, kind, account_id or 0, brivo_id)] = (partner_id, now + self.ttl)
+      while len(self.entries) > self.size:
+        self.entries.popitem(last=False)
+    
+    return res
+  
+  def evict(self, dbname, kind, keys):
+    '''
+      Drop the entries of `keys`, pairs of (Brivo account ID, Brivo ID).
+    '''
+    with self.lock:
+      for account_id, brivo_id in keys:
+        self.entries.pop((dbname, kind, account_id or 0, brivo_id), None)
+  
+  def stats(self):
+    with self.lock:
+      return { 'size': len(self.entries), 'hits': self.hits, 'misses': self.misses }
+
+BRIVO_ID_INDEX = BrivoIdIndex(const.BRIVO_ID_INDEX_SIZE, const.BRIVO_ID_INDEX_TTL)
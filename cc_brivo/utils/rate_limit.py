@@ -0,0 +1,163 @@
+# All Rights Reserved
+# You may not use, distribute and modify this code without the express written consent of clubcloud, LLC. 
+import logging
+import threading
+import time
+
+import psycopg2
+import requests
+from psycopg2.pool import PoolError
+
+from . import const
+
+_logger = logging.getLogger(__name__)
+
+class BrivoCircuitOpenError(requests.RequestException):
+  '''
+    Raised instead of calling Brivo while the circuit breaker is open.
+  '''
+
+class BrivoRateLimitError(requests.RequestException):
+  '''
+    Raised when no rate limit slot frees up within `BRIVO_RATE_MAX_WAIT`.
+  '''
+
+class CircuitBreaker:
+  '''
+    Process-local circuit breaker. After `threshold` consecutive failures (5xx or network
+    errors), calls fail fast for `cooldown` seconds; then a single trial call is let through,
+    closing the circuit on success and reopening it on failure.
+  '''
+  def __init__(self, threshold=const.BRIVO_CIRCUIT_THRESHOLD, cooldown=const.BRIVO_CIRCUIT_COOLDOWN):
+    self.threshold = threshold
+    self.cooldown = cooldown
+    self.failures = 0
+    self.opened_at = None
+    self.trial = False
+    self.lock = threading.Lock()
+  
+  def allow(self):
+    with self.lock:
+      if self.opened_at is None:
+        return True
+      if not self.trial and time.time() - self.opened_at >= self.cooldown:
+        self.trial = True
+        return True
+      return False
+  
+  def record(self, ok):
+    with self.lock:
+      if ok:
+        if self.opened_at is not None:
+          _logger.info('Brivo circuit breaker closed')
+        self.failures = 0
+        self.opened_at = None
+        self.trial = False
+        return
+      
+      self.failures += 1
+      if self.trial or self.failures >= self.threshold:
+        if self.opened_at is None:
+          _logger.warning(f'Brivo circuit breaker opened after {self.failures} consecutive failures')
+        self.opened_at = time.time()
+        self.trial = False
+
+_BREAKERS : dict = {}
+_BREAKERS_LOCK = threading.Lock()
+
+def get_breaker(key):
+  '''
+    Returns the circuit breaker of this process for `key`.
+  '''
+  with _BREAKERS_LOCK:
+    return _BREAKERS.setdefault(key, CircuitBreaker())
+
+class _LocalBudget:
+  '''
+    Tokens taken from a shared bucket ahead of the calls of this process, so that most calls
+    do not touch the database. Tokens left unused after `BRIVO_RATE_BATCH_TTL` seconds are
+    dropped, which bounds how far a process can run ahead of the shared rate.
+  '''
+  def __init__(self):
+    self.tokens = 0
+    self.expires_at = 0.0
+    self.lock = threading.Lock()
+
+_BUDGETS : dict = {}
+_BUDGETS_LOCK = threading.Lock()
+
+def _get_budget(key):
+  with _BUDGETS_LOCK:
+    return _BUDGETS.setdefault(key, _LocalBudget())
+
+def acquire(registry, bucket_key, rate, burst):
+  '''
+    Takes a slot from a token bucket shared by all workers through the `brivo_rate_bucket` table.
+    
+    Slots are served from a process-local budget, refilled with one database round trip for
+    up to `BRIVO_RATE_BATCH_SIZE` tokens, so that the threads of a worker do not serialize on
+    the bucket row for every call. A refill atomically refills the bucket for the elapsed time
+    and takes the tokens. A negative balance is a queue: the caller sleeps for the time needed
+    to pay it back, and the other threads of the process wait for that refill. Safe to call
+    from worker threads, since it uses its own cursor.
+    Input:
+      - registry. The registry of the database.
+      - bucket_key. The bucket to take from, one per Brivo credential set.
+      - rate. Tokens added per second. A falsy rate disables the limit.
+      - burst. The capacity of the bucket.
+    Output:
+      True once a slot is available, False if it would take longer than `BRIVO_RATE_MAX_WAIT`
+      or if no database connection is left to take it.
+  '''
+  if not rate or rate <= 0:
+    return True
+  
+  burst = max(burst or 1, 1)
+  budget = _get_budget((registry.db_name, bucket_key))
+  with budget.lock:
+    if budget.tokens > 0 and time.monotonic() < budget.expires_at:
+      budget.tokens -= 1
+      return True
+    
+    count = max(min(const.BRIVO_RATE_BATCH_SIZE, burst, int(rate * const.BRIVO_RATE_BATCH_TTL)), 1)
+    try:
+      with registry.cursor() as cr:
+        tokens = _take(cr, bucket_key, rate, burst, count)
+        if tokens is None:
+          cr.execute('''
+            INSERT INTO brivo_rate_bucket (bucket_key, tokens, updated_at, create_date, write_date)
+            VALUES (%s, %s, now() at time zone 'UTC', now() at time zone 'UTC', now() at time zone 'UTC')
+            ON CONFLICT (bucket_key) DO NOTHING
+          ''', [bucket_key, burst])
+          tokens = _take(cr, bucket_key, rate, burst, count)
+        
+        # The last of the tokens taken is the one that has to be paid back before calling
+        wait = -tokens / rate if tokens < 0 else 0
+        if wait > const.BRIVO_RATE_MAX_WAIT:
+          # Give the slots back, the calls are not going to be made
+          cr.execute('UPDATE brivo_rate_bucket SET tokens = tokens + %s WHERE bucket_key = %s', [count, bucket_key])
+          return False
+    except PoolError as err:
+      # Calling anyway would let the threads that exhaust the pool bypass the shared limit
+      _logger.warning('Brivo rate limit bucket unreachable, the database connection pool is full: %s', err)
+      return False
+    except psycopg2.Error as err:
+      _logger.warning('Brivo rate limit bucket unavailable, calling without limit: %s', err)
+      return True
+    
+    if wait:
+      time.sleep(wait)
+    budget.tokens = count - 1
+    budget.expires_at = time.monotonic() + const.BRIVO_RATE_BATCH_TTL
+  return True
+
+def _take(cr, bucket_key, rate, burst, count=1):
+  cr.execute('''
+    UPDATE brivo_rate_bucket
+       SET tokens = LEAST(%s, tokens + EXTRACT(EPOCH FROM (clock_timestamp() at time zone 'UTC') - updated_at) * %s) - %s,
+           updated_at = clock_timestamp() at time zone 'UTC'
+     WHERE bucket_key = %s
+ RETURNING tokens
+  ''', [burst, rate, count, bucket_key])
+  row = cr.fetchone()
+  return row[0] if row else None
@@ -0,0 +1,212 @@
+# All Rights Reserved
+# You may not use, distribute and modify this code without the express written consent of clubcloud, LLC. 
+import hashlib
+import logging
+import threading
+import time
+from collections import Counter
+from datetime import datetime, timezone
+
+import psycopg2
+
+from . import const
+
+_logger = logging.getLogger(__name__)
+
+# Process-local token cache, keyed by (database name, credential key).
+# Values are dicts holding the access token, refresh token, expiry (UNIX time) and lifetime.
+_TOKENS : dict = {}
+_TOKENS_LOCK = threading.Lock()
+# One lock per cache key so that only one thread per process negotiates a token at a time.
+_KEY_LOCKS : dict = {}
+# Counters used to confirm that the auth call rate stays at roughly one per token lifetime.
+_STATS = Counter()
+
+def credential_key(settings):
+  '''
+    Computes a stable, non-reversible key for a set of Brivo credentials.
+    Input:
+      settings. An object exposing the five Brivo credential fields.
+    Output:
+      A hex digest identifying the credential set.
+  '''
+  parts = [
+    settings.brivo_app_client_id,
+    settings.brivo_app_client_secret,
+    settings.brivo_access_username,
+    settings.brivo_access_password,
+    settings.brivo_api_key
+  ]
+  return hashlib.sha256('\x1f'.join(p or '' for p in parts).encode('utf-8')).hexdigest()
+
+def token_stats():
+  '''
+    Returns a snapshot of the token cache counters of this process.
+  '''
+  return dict(_STATS)
+
+def _key_lock(cache_key):
+  with _TOKENS_LOCK:
+    return _KEY_LOCKS.setdefault(cache_key, threading.Lock())
+
+def _is_fresh(entry, now):
+  '''
+    A token is fresh while it has more than the refresh margin left. The margin
+    is capped to a fifth of the token lifetime so that short-lived tokens are still used.
+  '''
+  if not entry or not entry.get('access_token') or not entry.get('expires_at'):
+    return False
+  margin = min(const.BRIVO_TOKEN_REFRESH_MARGIN, (entry.get('lifetime') or 0) / 5)
+  return entry['expires_at'] - margin > now
+
+def _cached(cache_key, stale_token=None):
+  entry = _TOKENS.get(cache_key)
+  if entry and entry['access_token'] != stale_token and _is_fresh(entry, time.time()):
+    return entry['access_token']
+  return None
+
+def _to_epoch(value):
+  return value.replace(tzinfo=timezone.utc).timestamp() if value else None
+
+def _to_datetime(epoch):
+  return datetime.fromtimestamp(epoch, timezone.utc).replace(tzinfo=None)
+
+def get_access_token(registry, settings, fetch_token, stale_token=None):
+  '''
+    Returns a valid Brivo access token, negotiating a new one only when needed.
+    
+    Tokens are cached in memory per process and shared between processes through the
+    `brivo_auth_token` table, whose row lock serializes refreshes across workers.
+    Input:
+      - registry. The registry of the database, used to open a dedicated cursor. It is
+        safe to call this function from worker threads.
+      - settings. The record holding the Brivo credentials.
+      - fetch_token. A callable `(settings, data)` posting `data` to the OAuth token endpoint.
+      - stale_token. A token that Brivo rejected; it will not be returned again.
+    Output:
+      { 'status': 'SUCCESS', 'access_token': ... } or a failure object from `fetch_token`.
+  '''
+  cache_key = (registry.db_name, credential_key(settings))
+  
+  token = _cached(cache_key, stale_token)
+  if token:
+    _STATS['hits'] += 1
+    return { 'status': 'SUCCESS', 'access_token': token }
+  
+  with _key_lock(cache_key):
+    # Another thread may have refreshed the token while we were waiting
+    token = _cached(cache_key, stale_token)
+    if token:
+      _STATS['hits'] += 1
+      return { 'status': 'SUCCESS', 'access_token': token }
+    
+    try:
+      with registry.cursor() as cr:
+        return _get_shared_token(cr, cache_key, settings, fetch_token, stale_token)
+    except psycopg2.Error as err:
+      # The token table is unavailable (e.g. during a module upgrade), fall back to a direct grant.
+      _logger.warning('Brivo token table unavailable, authenticating without shared cache: %s', err)
+      res = _negotiate_token(settings, fetch_token, None)
+      if res.get('status', None) == 'FAILURE':
+        return res
+      _store_memory(cache_key, res)
+      return { 'status': 'SUCCESS', 'access_token': res['access_token'] }
+
+def invalidate_token(registry, settings, access_token):
+  '''
+    Drops `access_token` from the process cache, e.g. after Brivo answered 401.
+  '''
+  cache_key = (registry.db_name, credential_key(settings))
+  with _TOKENS_LOCK:
+    entry = _TOKENS.get(cache_key)
+    if entry and entry['access_token'] == access_token:
+      del _TOKENS[cache_key]
+      _STATS['invalidations'] += 1
+
+def _get_shared_token(cr, cache_key, settings, fetch_token, stale_token):
+  key = cache_key[1]
+  cr.execute('''
+    INSERT INTO brivo_auth_token (credential_key, refresh_count, password_grant_count, create_date, write_date)
+    VALUES (%s, 0, 0, now() at time zone 'UTC', now() at time zone 'UTC')
+    ON CONFLICT (credential_key) DO NOTHING
+  ''', [key])
+  cr.execute('''
+    SELECT access_token, refresh_token, expires_at, lifetime
+      FROM brivo_auth_token
+     WHERE credential_key = %s
+       FOR UPDATE
+  ''', [key])
+  access_token, refresh_token, expires_at, lifetime = cr.fetchone()
+  shared = {
+    'access_token': access_token,
+    'refresh_token': refresh_token,
+    'expires_at': _to_epoch(expires_at),
+    'lifetime': lifetime
+  }
+  
+  # Another worker already holds a good token
+  if access_token != stale_token and _is_fresh(shared, time.time()):
+    _STATS['shared_hits'] += 1
+    with _TOKENS_LOCK:
+      _TOKENS[cache_key] = shared
+    return { 'status': 'SUCCESS', 'access_token': access_token }
+  
+  res = _negotiate_token(settings, fetch_token, refresh_token)
+  if res.get('status', None) == 'FAILURE':
+    return res
+  
+  entry = _store_memory(cache_key, res, refresh_token)
+  cr.execute('''
+    UPDATE brivo_auth_token
+       SET access_token = %s,
+           refresh_token = %s,
+           expires_at = %s,
+           lifetime = %s,
+           refresh_count = refresh_count + %s,
+           password_grant_count = password_grant_count + %s,
+           write_date = now() at time zone 'UTC'
+     WHERE credential_key = %s
+  ''', [
+    entry['access_token'],
+    entry['refresh_token'],
+    _to_datetime(entry['expires_at']),
+    entry['lifetime'],
+    0 if res['grant_type'] == 'password' else 1,
+    1 if res['grant_type'] == 'password' else 0,
+    key
+  ])
+  _logger.info('Brivo access token renewed with %s grant. Token stats: %s', res['grant_type'], token_stats())
+  return { 'status': 'SUCCESS', 'access_token': entry['access_token'] }
+
+def _negotiate_token(settings, fetch_token, refresh_token):
+  '''
+    Obtains a new token, preferring the refresh grant and falling back to the password grant.
+  '''
+  if refresh_token:
+    res = fetch_token(settings, { 'grant_type': 'refresh_token', 'refresh_token': refresh_token })
+    if res.get('status', None) != 'FAILURE':
+      _STATS['refreshes'] += 1
+      return dict(res, grant_type='refresh_token')
+  
+  res = fetch_token(settings, {
+    'grant_type': 'password',
+    'username': settings.brivo_access_username,
+    'password': settings.brivo_access_password
+  })
+  if res.get('status', None) == 'FAILURE':
+    _STATS['failures'] += 1
+    return res
+  _STATS['password_grants'] += 1
+  return dict(res, grant_type='password')
+
+def _store_memory(cache_key, res, previous_refresh_token=None):
+  lifetime = int(res.get('expires_in') or const.BRIVO_TOKEN_DEFAULT_LIFETIME)
+  entry = {
+    'access_token': res['access_token'],
+    'refresh_token': res.get('refresh_token') or previous_refresh_token,
+    'expires_at': time.time() + lifetime,
+    'lifetime': lifetime
+  }
+  with _TOKENS_LOCK:
+    _TOKENS[cache_key] = entry
+  return entry
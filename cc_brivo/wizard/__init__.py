@@ -1,2 +1,4 @@
 from . import assign_brivo_group_wizard
-from . import manage_suspended_status_wizard
\ No newline at end of file
+from . import manage_suspended_status_wizard
+from . import start_brivo_onboarding_wizard
+from . import start_brivo_batch_wizard
\ No newline at end of file
@@ -1,7 +1,5 @@
 import logging
 from odoo import models, fields
-from ...ksc_club_cloud.utils.notifications import NotificationFeedback
-from ..utils.brivo import brivo_remove_from_group, brivo_add_to_group
 
 _logger = logging.getLogger(__name__)
 
@@ -14,30 +12,29 @@ class AssignBrivoGroupWizard(models.TransientModel):
   
   def action_confirm(self):
     '''
-      Transfer members with this membership from an old brivo group 
-      to the one selected. Then, link the brivo group to the membership.
+      Schedule the transfer of members with this membership from the old brivo group
+      to the one selected. Then, link the brivo group to the membership, so that
+      memberships confirmed from now on use the new group.
     '''
-    
-    old_brivo_group = self.sale_order_template_id.brivo_group_id.brivo_group_id
     members = self.env['sale.order'].search([
       ('subscription_state', '=', '3_progress'),
       ('sale_order_template_id', '=', self.sale_order_template_id.id),
-      ('partner_id.brivo_id', '!=', False)
+      ('partner_id.brivo_id', '>', 0)
       ]).mapped('partner_id')
     
     # Remove members from the old brivo group, then add them
-    # to the new brivo group.
-    _logger.info(f'Assign Brivo Group Wizard: Assigning {members.mapped('name')} to the new group')
-    for m in members:
-      if old_brivo_group:
-        brivo_remove_from_group(self.env, old_brivo_group, m.brivo_id)
-        
-      brivo_add_to_group(self.env, self.brivo_group_id.brivo_group_id, m.brivo_id)
+    # to the new brivo group, in the background.
+    _logger.info(f'Assign Brivo Group Wizard: Scheduling the reassignment of {len(members)} members to the new group')
+    reassignment = self.env['brivo.group.reassignment'].start(self.sale_order_template_id, members, self.brivo_group_id)
     
     # Set the brivo group on the membership
     self.sale_order_template_id.brivo_group_id = self.brivo_group_id
     
-    return NotificationFeedback.notification_feedback(self.env,
-                                                      'Brivo Group Reassignment Successful',
-                                                      'Successfully reassigned Brivo group.',
-                                                      'success')
\ No newline at end of file
+    return {
+      'name': 'Brivo Group Reassignment',
+      'type': 'ir.actions.act_window',
+      'view_mode': 'form',
+      'res_model': 'brivo.group.reassignment',
+      'res_id': reassignment.id,
+      'target': 'current'
+    }
@@ -1,6 +1,5 @@
 from odoo import models, fields
 from ...ksc_club_cloud.utils.notifications import NotificationFeedback
-from ..utils.brivo import brivo_query_suspended_status, brivo_toggle_suspended_status
 
 class ManageSuspendedStatusWizard(models.TransientModel):
   _name = 'manage.suspended.status.wizard'
@@ -8,29 +7,51 @@ class ManageSuspendedStatusWizard(models.TransientModel):
   
   partner_id = fields.Many2one('res.partner', string='Member')
   is_brivo_suspended = fields.Boolean()
+  brivo_state_date = fields.Datetime(related='partner_id.brivo_state_date', string='Checked On')
   
   def default_get(self, default_vals):
     '''
-      Query the suspended status of the customer on Brivo and populate
-      `is_brivo_suspended`.
+      Populate `is_brivo_suspended` from the cached Brivo state of the customer,
+      which is only queried on Brivo once it is stale.
     '''
     res = super().default_get(default_vals)
     
     partner = self.env['res.partner'].browse(self.env.context.get('default_partner_id'))
-    susp_query = brivo_query_suspended_status(self.env, partner.brivo_id)
     
-    res['is_brivo_suspended'] = susp_query['suspended']
+    res['is_brivo_suspended'] = partner._get_brivo_state()['suspended']
     
     return res
+  
+  def action_refresh(self):
+    '''
+      Refresh the Brivo state of the customer and reopen the wizard.
+    '''
+    self.partner_id._refresh_brivo_state()
+    
+    return self.partner_id.action_manage_suspended_status()
 
   def action_toggle_suspension(self):
     '''
       Make a call to toggle the suspended status of the Brivo user, and
-      then return a success notification.
+      then return a notification of its outcome: a warning when the member
+      has no Brivo user or the call failed.
     '''
-    brivo_toggle_suspended_status(self.env, self.partner_id.brivo_id, not self.is_brivo_suspended)
+    # Toggle from the cached state rather than the value shown when the wizard was opened
+    suspend = not self.partner_id._get_brivo_state()['suspended']
+    outcome = self.partner_id._set_brivo_suspended(suspend)[self.partner_id.id]
+    
+    if outcome['status'] == 'SKIPPED':
+      return NotificationFeedback.notification_feedback(self.env,
+                                                        'Suspension Toggle Skipped',
+                                                        'The member has no Brivo user, nothing was changed.',
+                                                        'warning')
+    if outcome['status'] == 'FAILURE':
+      return NotificationFeedback.notification_feedback(self.env,
+                                                        'Suspension Toggle Failed',
+                                                        f'Cannot change the suspended status of the user on Brivo: {outcome.get("error") or "unknown error"}',
+                                                        'warning')
     
     return NotificationFeedback.notification_feedback(self.env,
                                                       'Suspension Toggle Successful!',
                                                       'The user\'s suspension status was successfully changed.',
-                                                      'success')
\ No newline at end of file
+                                                      'success')
@@ -0,0 +1,29 @@
+from odoo import models, fields, api
+
+class StartBrivoBatchWizard(models.TransientModel):
+  _name = 'start.brivo.batch.wizard'
+  _description = 'Wizard for running a Brivo operation over many partners with the batch crons.'
+  
+  kind = fields.Selection(selection=lambda self: self.env['brivo.batch']._fields['kind'].selection,
+                          default='refresh_state', required=True)
+  record_count = fields.Integer(string='Records to Process', compute='_compute_record_count')
+  
+  @api.depends('kind')
+  def _compute_record_count(self):
+    for rec in self:
+      rec.record_count = len(self.env['brivo.batch']._get_batch_records(rec.kind)) if rec.kind else 0
+  
+  def action_confirm(self):
+    '''
+      Start the batch in the background and open it, to follow its progress.
+    '''
+    batch = self.env['brivo.batch'].start(self.kind)
+    
+    return {
+      'name': 'Brivo Batch',
+      'type': 'ir.actions.act_window',
+      'view_mode': 'form',
+      'res_model': 'brivo.batch',
+      'res_id': batch.id,
+      'target': 'current'
+    }
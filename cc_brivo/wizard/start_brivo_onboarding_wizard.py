@@ -0,0 +1,31 @@
+from odoo import models, fields, api
+
+class StartBrivoOnboardingWizard(models.TransientModel):
+  _name = 'start.brivo.onboarding.wizard'
+  _description = 'Wizard for provisioning the existing partners into Brivo.'
+  
+  scope = fields.Selection([
+    ('members', 'Members with an Active Membership'),
+    ('all', 'All Individuals')
+  ], default='members', required=True)
+  partner_count = fields.Integer(string='Partners to Onboard', compute='_compute_partner_count')
+  
+  @api.depends('scope')
+  def _compute_partner_count(self):
+    for rec in self:
+      rec.partner_count = len(self.env['brivo.onboarding']._get_partners_to_onboard(rec.scope))
+  
+  def action_confirm(self):
+    '''
+      Start the onboarding in the background and open it, to follow its progress.
+    '''
+    onboarding = self.env['brivo.onboarding'].start(self.scope)
+    
+    return {
+      'name': 'Brivo Onboarding',
+      'type': 'ir.actions.act_window',
+      'view_mode': 'form',
+      'res_model': 'brivo.onboarding',
+      'res_id': onboarding.id,
+      'target': 'current'
+    }